@@ -159,6 +159,9 @@ def main():
         if cfg.get_zpool_frequency_check() > 0 and cfg.do_timebased_actions():
             l3 = task.LoopingCall(lambda: our_engine.do_zpool_status_check())
             l3.start(cfg.get_zpool_frequency_check())
+        if cfg.get_load_check_interval() > 0 and cfg.do_timebased_actions():
+            l4 = task.LoopingCall(lambda: our_engine.do_load_check())
+            l4.start(cfg.get_load_check_interval())
 
         reactor.addSystemEventTrigger("before", "shutdown", on_shutdown)
 
@@ -19,6 +19,19 @@ class DefaultConfig:
 
         return random.choice(list(self.get_nodes()))[0]
 
+    def decide_targets_by_load(self, ffs, node_stats):
+        """Placement for new ffs (without explicit targets) and add_targets
+        with a 'count' instead of a target list, knowing the nodes' pools.
+        node_stats: {node: {free, size, capacity, fragmentation,
+        read_bytes, write_bytes, ...}} of the pool holding the node's
+        storage_prefix - see Engine.get_node_stats - for the nodes the ffs
+        may go to (not readonly, not yet holding it, holding its parent).
+        Return None to use decide_targets (new) / refuse (add_targets).
+
+        pick_targets_by_headroom(node_stats, 2) is a sensible choice.
+        """
+        return None
+
     def find_node(self, incoming_name):
         for node, node_info in self.get_nodes().items():
             if node == incoming_name:
@@ -59,6 +72,173 @@ class DefaultConfig:
         """How many rsync send_snapshots may run per sending system at a time?"""
         return 2
 
+    def get_replication_fanout(self, ffs):
+        """0: the main sends every snapshot to every replica (star).
+        k > 0: replicas form a tree below the main, each node sending to
+        (at most) k others once it has the snapshot - 1 is a chain.
+        The main sends each snapshot k times, regardless of the number of replicas.
+        """
+        return 0
+
+    def get_send_scheduling(self):
+        """How to order queued send_snapshots of the same priority.
+        'priority': first come, first served.
+        'shortest_first': smallest estimated transfer first (from the zfs
+        'written' sizes the nodes report), with waiting sends aging
+        towards the front so large ones don't starve.
+        'fair': weighted round robin between the groups of
+        get_fair_queuing_group, so frequently captured ffs can't starve the others.
+        """
+        return "priority"
+
+    def get_fair_queuing_group(self, ffs):
+        """Which group shares a fair slice of the send queue with 'fair' scheduling.
+        Default: every ffs on its own - return e.g. an owner to be fair between owners.
+        """
+        return ffs
+
+    def get_fair_queuing_weight(self, group):
+        """Relative share of a fair queuing group - a group with weight 2
+        gets twice as many sends as one with weight 1."""
+        return 1
+
+    def use_replicas_as_source(self):
+        """May snapshots be sent from any replica that has them (the least loaded one),
+        instead of always from the main? Only new snapshots have to come from the main then.
+        """
+        return False
+
+    def get_bandwidth_limit(self, source_node, target_node):
+        """Bandwidth budget in KiB/s for the transfers from source_node
+        to target_node - 0 = unlimited. A starting transfer gets its share,
+        split with those already running on the link.
+        Called whenever a transfer starts, so this may depend on the time of day.
+        """
+        return 0
+
+    def transfer_window_open(self, ffs, source_node, target_node, priority):
+        """May a send_snapshot start now? Held sends are rechecked every minute.
+        priority is the ffs:priority (None if unset, lower = more important).
+
+        E.g. to hold everything but prioritized ffs during working hours:
+            import datetime
+            return priority is not None or not (8 <= datetime.datetime.now().hour < 18)
+        """
+        return True
+
+    def get_concurrent_inbound_rsync_limit(self):
+        """How many send_snapshots may run into one receiving system at a time,
+        summed over all sending systems? 0 = unlimited"""
+        return 0
+
+    def get_adaptive_concurrency(self):
+        """Tune each node's ssh/rsync slots from observed latency, throughput
+        and errors? The limits above are then the upper bounds."""
+        return False
+
+    def get_send_snapshot_retry_limit(self):
+        """How often may a send_snapshot that failed on some units be retried
+        (only the failed units are transfered again) before we fault?"""
+        return 3
+
+    def get_move_preseed_rounds(self):
+        """How many capture & replicate rounds move_main may do while the old
+        main is still writable, before it turns read only for the final
+        (now small) delta. 0 = no pre-seeding, go read only right away."""
+        return 0
+
+    def get_move_preseed_threshold(self):
+        """Pre-seeding stops once a round transferred at most this many bytes"""
+        return 1024 ** 3
+
+    def get_pressure_time_to_full(self):
+        """Seconds - once a node's pool is forecast to be full within this,
+        the node goes into pressure retention
+        (see decide_snapshots_to_keep_under_pressure) until the forecast
+        is back above twice this. 0 = never."""
+        return 0
+
+    def decide_snapshots_to_keep_under_pressure(self, ffs_name, snapshots):
+        """Like decide_snapshots_to_keep, for nodes whose pool is about to fill up.
+        Default: the newer half of what decide_snapshots_to_keep keeps."""
+        keep = set(self.decide_snapshots_to_keep(ffs_name, snapshots))
+        keep = [x for x in snapshots if x in keep]
+        return keep[len(keep) // 2 :]
+
+    def get_drain_concurrency(self):
+        """How many moves (service_drain_node) or new replicas
+        (service_rebuild_node) may run at once per drained/rebuilt node"""
+        return 2
+
+    def get_drain_step_timeout(self):
+        """Seconds - a drain move / rebuild seed that has not finished after
+        this is given up on (listed under 'failed' in service_drain_status)
+        so the job can finish. 0 = wait forever."""
+        return 24 * 3600
+
+    def get_deletion_rate_limit(self):
+        """How many snapshots may be destroyed per node and hour?
+        Removals beyond that wait in the node's deletion queue
+        (see service_deletion_que). 0 = unlimited"""
+        return 0
+
+    def deletion_window_open(self, node):
+        """May queued snapshot removals be sent to node now?
+        Rechecked every minute. E.g. to destroy off-peak only:
+            import datetime
+            return not (8 <= datetime.datetime.now().hour < 20)
+        """
+        return True
+
+    def get_deletion_batch_size(self):
+        """How many snapshots of one ffs may be destroyed in one node call
+        (remove_snapshots). 1 = one remove_snapshot per snapshot"""
+        return 1
+
+    def get_concurrent_deletion_limit(self):
+        """How many snapshot removal calls may run on one node at a time?
+        0 = unlimited"""
+        return 0
+
+    def get_scrub_interval(self):
+        """Seconds between scrubs of each node's storage pool, started by
+        the engine (needs get_zpool_frequency_check). 0 = leave scrubbing
+        to the hosts - they're still taken into account once noticed."""
+        return 0
+
+    def get_concurrent_scrub_limit(self):
+        """How many nodes may scrub at once?"""
+        return 1
+
+    def get_scrub_max_shared_fraction(self):
+        """Two nodes don't scrub at once if more than this fraction of the
+        smaller one's ffs are on both - so one copy stays fast"""
+        return 0.5
+
+    def get_scrub_rsync_limit(self):
+        """How many send_snapshots may run from - and into - a scrubbing node"""
+        return 1
+
+    def get_load_check_interval(self):
+        """Seconds between load messages (iostat sample & load average)
+        to every node. 0 = disabled"""
+        return 0
+
+    def is_node_saturated(self, node, load):
+        """Should node get fewer send_snapshots (get_saturated_rsync_limit)?
+        load is {'loadavg': [1, 5, 15 minutes], 'cpus': n,
+        'pool': {read/write_ops, read/write_bytes per second,
+        read/write_wait_ns - average disk wait, if the node's zfs reports it}}.
+        Default: disks waiting more than 100ms, or a load of twice the cpus"""
+        wait = max(
+            load["pool"].get("read_wait_ns", 0), load["pool"].get("write_wait_ns", 0)
+        )
+        return wait > 100 * 1000 * 1000 or load["loadavg"][0] > 2 * load["cpus"]
+
+    def get_saturated_rsync_limit(self):
+        """How many send_snapshots may run from - and into - a saturated node"""
+        return 1
+
     def get_zpool_frequency_check(self):
         # in seconds
         return 0  # 0 = disabled, seconds otherwise
@@ -139,6 +319,26 @@ def must_return_type(typ):
     return deco
 
 
+def pick_targets_by_headroom(node_stats, count, candidates=None, full_capacity=80):
+    """The count nodes with the most headroom: pools below full_capacity percent
+    first, then by free bytes, discounted by the recent write+read bandwidth
+    (a pool busy with 100 MB/s counts half its free space).
+    None if fewer than count nodes have reported their pools.
+    """
+    if candidates is not None:
+        node_stats = {k: v for (k, v) in node_stats.items() if k in candidates}
+    if len(node_stats) < count:
+        return None
+
+    def key(node):
+        stats = node_stats[node]
+        bandwidth = stats.get("read_bytes", 0) + stats.get("write_bytes", 0)
+        headroom = stats["free"] / (1.0 + bandwidth / (100 * 1024 ** 2))
+        return (stats["capacity"] >= full_capacity, -headroom, node)
+
+    return sorted(node_stats, key=key)[:count]
+
+
 class CheckedConfig:
     def __init__(self, config):
         self.config = config
@@ -205,6 +405,14 @@ class CheckedConfig:
     def decide_targets(self, ffs_name):
         return [self.config.find_node(x) for x in self.config.decide_targets(ffs_name)]
 
+    def decide_targets_by_load(self, ffs_name, node_stats):
+        res = self.config.decide_targets_by_load(ffs_name, node_stats)
+        if res is None:
+            return None
+        if not isinstance(res, list):
+            raise ValueError("decide_targets_by_load must return a list or None")
+        return [self.config.find_node(x) for x in res]
+
     @must_return_type(dict)
     def get_enforced_properties(self):
         res = self.config.get_enforced_properties()
@@ -306,6 +514,177 @@ class CheckedConfig:
             )
         return res
 
+    @must_return_type(int)
+    def get_replication_fanout(self, ffs):
+        res = self.config.get_replication_fanout(ffs)
+        if res < 0:
+            raise ValueError("get_replication_fanout must be >= 0")
+        return res
+
+    @must_return_type(str)
+    def get_send_scheduling(self):
+        res = self.config.get_send_scheduling()
+        if res not in ("priority", "shortest_first", "fair"):
+            raise ValueError(
+                "get_send_scheduling must return 'priority', 'shortest_first' or 'fair'"
+            )
+        return res
+
+    @must_return_type(str)
+    def get_fair_queuing_group(self, ffs):
+        return self.config.get_fair_queuing_group(ffs)
+
+    @must_return_type((int, float))
+    def get_fair_queuing_weight(self, group):
+        res = self.config.get_fair_queuing_weight(group)
+        if res <= 0:
+            raise ValueError("get_fair_queuing_weight must be > 0")
+        return res
+
+    @must_return_type(bool)
+    def use_replicas_as_source(self):
+        return self.config.use_replicas_as_source()
+
+    @must_return_type(int)
+    def get_bandwidth_limit(self, source_node, target_node):
+        res = self.config.get_bandwidth_limit(source_node, target_node)
+        if res < 0:
+            raise ValueError("get_bandwidth_limit must be >= 0")
+        return res
+
+    @must_return_type(bool)
+    def transfer_window_open(self, ffs, source_node, target_node, priority):
+        return self.config.transfer_window_open(ffs, source_node, target_node, priority)
+
+    @must_return_type(int)
+    def get_concurrent_inbound_rsync_limit(self):
+        res = self.config.get_concurrent_inbound_rsync_limit()
+        if res < 0:
+            raise ValueError("get_concurrent_inbound_rsync_limit must be >= 0")
+        return res
+
+    @must_return_type(bool)
+    def get_adaptive_concurrency(self):
+        return self.config.get_adaptive_concurrency()
+
+    @must_return_type(int)
+    def get_send_snapshot_retry_limit(self):
+        res = self.config.get_send_snapshot_retry_limit()
+        if res < 0:
+            raise ValueError("get_send_snapshot_retry_limit must be >= 0")
+        return res
+
+    @must_return_type(int)
+    def get_move_preseed_rounds(self):
+        res = self.config.get_move_preseed_rounds()
+        if res < 0:
+            raise ValueError("get_move_preseed_rounds must be >= 0")
+        return res
+
+    @must_return_type(int)
+    def get_move_preseed_threshold(self):
+        res = self.config.get_move_preseed_threshold()
+        if res < 0:
+            raise ValueError("get_move_preseed_threshold must be >= 0")
+        return res
+
+    @must_return_type(int)
+    def get_pressure_time_to_full(self):
+        res = self.config.get_pressure_time_to_full()
+        if res < 0:
+            raise ValueError("get_pressure_time_to_full must be >= 0")
+        return res
+
+    def decide_snapshots_to_keep_under_pressure(self, ffs_name, snapshots):
+        return set(
+            self.config.decide_snapshots_to_keep_under_pressure(ffs_name, snapshots)
+        )
+
+    @must_return_type(int)
+    def get_drain_concurrency(self):
+        res = self.config.get_drain_concurrency()
+        if res < 1:
+            raise ValueError("get_drain_concurrency must be >= 1")
+        return res
+
+    @must_return_type(int)
+    def get_drain_step_timeout(self):
+        res = self.config.get_drain_step_timeout()
+        if res < 0:
+            raise ValueError("get_drain_step_timeout must be >= 0")
+        return res
+
+    @must_return_type(int)
+    def get_deletion_rate_limit(self):
+        res = self.config.get_deletion_rate_limit()
+        if res < 0:
+            raise ValueError("get_deletion_rate_limit must be >= 0")
+        return res
+
+    @must_return_type(bool)
+    def deletion_window_open(self, node):
+        return self.config.deletion_window_open(node)
+
+    @must_return_type(int)
+    def get_deletion_batch_size(self):
+        res = self.config.get_deletion_batch_size()
+        if res < 1:
+            raise ValueError("get_deletion_batch_size must be >= 1")
+        return res
+
+    @must_return_type(int)
+    def get_concurrent_deletion_limit(self):
+        res = self.config.get_concurrent_deletion_limit()
+        if res < 0:
+            raise ValueError("get_concurrent_deletion_limit must be >= 0")
+        return res
+
+    @must_return_type(int)
+    def get_scrub_interval(self):
+        res = self.config.get_scrub_interval()
+        if res < 0:
+            raise ValueError("get_scrub_interval must be >= 0")
+        return res
+
+    @must_return_type(int)
+    def get_concurrent_scrub_limit(self):
+        res = self.config.get_concurrent_scrub_limit()
+        if res < 1:
+            raise ValueError("get_concurrent_scrub_limit must be >= 1")
+        return res
+
+    @must_return_type((int, float))
+    def get_scrub_max_shared_fraction(self):
+        res = self.config.get_scrub_max_shared_fraction()
+        if not 0 <= res <= 1:
+            raise ValueError("get_scrub_max_shared_fraction must be in 0..1")
+        return res
+
+    @must_return_type(int)
+    def get_scrub_rsync_limit(self):
+        res = self.config.get_scrub_rsync_limit()
+        if res < 1:
+            raise ValueError("get_scrub_rsync_limit must be >= 1")
+        return res
+
+    @must_return_type(int)
+    def get_load_check_interval(self):
+        res = self.config.get_load_check_interval()
+        if res < 0:
+            raise ValueError("get_load_check_interval must be >= 0")
+        return res
+
+    @must_return_type(bool)
+    def is_node_saturated(self, node, load):
+        return self.config.is_node_saturated(node, load)
+
+    @must_return_type(int)
+    def get_saturated_rsync_limit(self):
+        res = self.config.get_saturated_rsync_limit()
+        if res < 1:
+            raise ValueError("get_saturated_rsync_limit must be >= 1")
+        return res
+
     @must_return_type(bool)
     def restart_on_code_changes(self):
         return self.config.restart_on_code_changes()
@@ -48,6 +48,20 @@ class needs_startup:
 
 
 class Engine:
+    # values for the ffs:transport property. '-' is 'unset' => rsync
+    valid_transports = set(["-", "rsync", "zfs_send"])
+    # zpool_status samples kept per node
+    pool_stats_history = 1000
+    # time to full forecasts fit the free space of this many seconds
+    forecast_window = 24 * 3600
+    # deletion rate limits and throughput are over this many seconds
+    deletion_window = 3600
+    # load samples older than this don't limit a node anymore
+    load_stale_after = 5 * 60
+    # requested scrubs that did not show up in this many zpool_status reports
+    # are given up on (and requested again once due)
+    scrub_start_reports = 3
+
     def __init__(self, config, sender=None, dry_run=False):
         """Config is a dictionary node_name -> node info
         send_function handles sending  messages to nodes
@@ -74,6 +88,33 @@ class Engine:
         self.trigger_message = None
         self.zpool_stati = {}
         self.zpool_disks = {}
+        # node -> deque of (time, {pool: capacity & io}), see node_zpool_status
+        self.pool_stats = {}
+        # nodes in pressure retention mode, see _check_pressure
+        self.pressure_nodes = set()
+        # node -> deque of (ffs, snapshot, queued time, urgent) waiting for removal,
+        # node -> [(ffs, [snapshots])] being removed,
+        # node -> deque of (time, snapshot count) sent / removed
+        # see _send_deletions
+        self.deletion_que = {}
+        self.deletions_in_flight = {}
+        self.deletions_sent = {}
+        self.deletions_done = {}
+        # node -> {since, requested, started} while its pool is scrubbing,
+        # node -> time its last scrub finished, see _schedule_scrubs
+        self.scrubs = {}
+        self.last_scrubs = {}
+        # node -> latest load sample, see node_load
+        self.node_loads = {}
+        # (ffs, target_node, snapshot) -> failed send_snapshot attempts
+        self.send_snapshot_failures = collections.Counter()
+        # (ffs, snapshot) -> capture time, (ffs, node, snapshot) -> arrival time
+        # for the replication lag (see client_service_replication_lag)
+        self.capture_times = {}
+        self.arrival_times = {}
+        # node -> job, see client_service_drain_node / client_service_rebuild_node
+        self.drains = {}
+        self.rebuilds = {}
         self.error_callback = lambda x: False
         self.write_authorized_keys()
         self.build_deployment_zip()
@@ -145,16 +186,26 @@ class Engine:
             self.node_capture_done(msg)
         elif msg["msg"] == "send_snapshot_done":
             self.node_send_snapshot_done(msg)
+        elif msg["msg"] == "send_snapshot_failed":
+            self.node_send_snapshot_failed(msg)
         elif msg["msg"] == "remove_snapshot_done":
             self.node_remove_snapshot_done(msg)
         elif msg["msg"] == "remove_snapshot_failed":
             self.node_remove_snapshot_failed(msg)
+        elif msg["msg"] == "remove_snapshots_done":
+            self.node_remove_snapshots_done(msg)
+        elif msg["msg"] == "remove_snapshots_failed":
+            self.node_remove_snapshots_failed(msg)
         elif msg["msg"] == "remove_done":
             self.node_remove_done(msg)
         elif msg["msg"] == "remove_failed":
             self.node_remove_failed(msg)
         elif msg["msg"] == "zpool_status":
             self.node_zpool_status(msg)
+        elif msg["msg"] == "zpool_scrub_started":
+            self.node_zpool_scrub_started(msg)
+        elif msg["msg"] == "load":
+            self.node_load(msg)
         elif msg["msg"] == "rename_done":
             self.node_rename_done(msg)
         elif msg["msg"] == "chown_and_chmod_done":
@@ -188,6 +239,16 @@ class Engine:
             return self.client_deploy()
         elif command == "service_que":
             return self.client_service_que()
+        elif command == "service_concurrency":
+            return self.client_service_concurrency()
+        elif command == "service_replication_lag":
+            return self.client_service_replication_lag(msg)
+        elif command == "service_drain_node":
+            return self.client_service_drain_node(msg)
+        elif command == "service_rebuild_node":
+            return self.client_service_rebuild_node(msg)
+        elif command == "service_drain_status":
+            return self.client_service_drain_status()
         elif command == "service_is_started":
             return self.client_service_is_started()
         elif command == "service_restart":
@@ -202,6 +263,10 @@ class Engine:
             return self.client_set_snapshot_interval(msg)
         elif command == "set_priority":
             return self.client_set_priority(msg)
+        elif command == "set_transport":
+            return self.client_set_transport(msg)
+        elif command == "set_max_lag":
+            return self.client_set_max_lag(msg)
         elif command == "list_snapshots":
             return self.client_list_snapshots(msg)
         elif command == "rollback":
@@ -210,6 +275,16 @@ class Engine:
             return self.client_service_inspect_model(msg)
         elif command == "service_list_disks":
             return self.client_service_list_disks(msg)
+        elif command == "service_pool_stats":
+            return self.client_service_pool_stats(msg)
+        elif command == "service_capacity_forecast":
+            return self.client_service_capacity_forecast()
+        elif command == "service_deletion_que":
+            return self.client_service_deletion_que()
+        elif command == "service_scrub_status":
+            return self.client_service_scrub_status()
+        elif command == "service_node_load":
+            return self.client_service_node_load()
         else:
             raise ValueError("invalid message from client, ignoring")
 
@@ -268,12 +343,247 @@ class Engine:
             }
         res = {}
         for node in self.sender.outgoing:
-            res[node] = [
-                {"status": x.status, "msg": x.msg, "runtime": x.get_runtime()}
-                for x in self.sender.prioritize(self.sender.outgoing[node])
-            ]
+            res[node] = []
+            for x in self.sender.prioritize(self.sender.outgoing[node]):
+                entry = {"status": x.status, "msg": x.msg, "runtime": x.get_runtime()}
+                progress = x.get_progress()
+                if progress is not None:  # bytes, files, bytes_per_second, eta
+                    entry["progress"] = progress
+                res[node].append(entry)
+        return res
+
+    def client_service_concurrency(self):
+        """Per node ssh/rsync slots and the recent adjustments
+        of the adaptive concurrency controller"""
+        controller = getattr(self.sender, "controller", None)
+        if controller is None:
+            res = {
+                "adaptive": False,
+                "ssh_limit": self.config.get_ssh_concurrent_connection_limit(),
+                "rsync_limit": self.config.get_concurrent_rsync_limit(),
+            }
+        else:
+            res = controller.get_status()
+            res["adaptive"] = True
+        res["inbound_rsync_limit"] = self.config.get_concurrent_inbound_rsync_limit()
+        return res
+
+    @needs_startup()
+    def client_service_replication_lag(self, msg):
+        """How far each target trails the main, in seconds since the capture
+        of the oldest snapshot it is still missing (0 = up to date, None = unknown)"""
+        if "ffs" in msg:
+            if msg["ffs"] not in self.model:
+                raise ValueError("Nonexistant ffs specified")
+            ffs_to_check = [msg["ffs"]]
+        else:
+            ffs_to_check = sorted(self.model)
+        now = time.time()
+        res = {}
+        for ffs in ffs_to_check:
+            try:
+                targets = self._replication_lag(ffs, now)
+            except NoMainAvailable:
+                continue
+            max_lag = self.get_ffs_max_lag(ffs)
+            for info in targets.values():
+                info["over_max_lag"] = (
+                    max_lag is not None
+                    and info["lag"] is not None
+                    and info["lag"] > max_lag
+                )
+            known = [x["lag"] for x in targets.values() if x["lag"] is not None]
+            res[ffs] = {
+                "max_lag": max_lag,
+                "lag": max(known) if known else 0,
+                "targets": targets,
+            }
         return res
 
+    def _ffs_by_priority(self, ffs_list):
+        """Lower ffs:priority first, unset counts as 1000"""
+
+        def key(ffs):
+            try:
+                prio = self.get_ffs_priority(ffs)
+            except NoMainAvailable:
+                prio = None
+            return (int(prio) if prio is not None else 1000, ffs)
+
+        return sorted(ffs_list, key=key)
+
+    def _pick_drain_target(self, ffs, node, planned):
+        """The freshest replica (fewest missing snapshots of the main),
+        ties go to the one with the least queued sends and planned moves"""
+        main_snapshots = self.model[ffs][node]["snapshots"]
+        candidates = []
+        for target in sorted(self.model[ffs]):
+            if target.startswith("_") or target == node:
+                continue
+            node_info = self.model[ffs][target]
+            if "snapshots" not in node_info or self.is_readonly_node(target):
+                continue
+            newest = -1
+            for ii, sn in enumerate(main_snapshots):
+                if sn in node_info["snapshots"]:
+                    newest = ii
+            missing = len(main_snapshots) - newest - 1
+            load = self._outbound_load(target) + planned[target]
+            candidates.append((missing, load, target))
+        if not candidates:
+            return None
+        return min(candidates)[2]
+
+    def _new_node_job(self, concurrency):
+        return {
+            "concurrency": concurrency,
+            "pending": [],
+            "running": [],
+            "done": [],
+            "failed": {},
+            "targets": {},
+            "started": {},
+        }
+
+    @needs_startup()
+    def client_service_drain_node(self, msg):
+        """Move every main off a node (e.g. for maintenance).
+        The new main is the freshest replica (then: least loaded),
+        at most msg['concurrency'] (default: config.get_drain_concurrency())
+        moves run at once, in ffs:priority order.
+        See service_drain_status for progress"""
+        if "node" not in msg:
+            raise CodingError("no node specified'")
+        node = self.config.find_node(msg["node"])
+        if node in self.drains and (
+            self.drains[node]["pending"] or self.drains[node]["running"]
+        ):
+            raise MoveInProgress("Node is already being drained")
+        concurrency = msg.get("concurrency", self.config.get_drain_concurrency())
+        if not isinstance(concurrency, int) or concurrency < 1:
+            raise ValueError("concurrency must be an integer >= 1")
+        job = self._new_node_job(concurrency)
+        job["unmovable"] = []
+        planned = collections.Counter()
+        to_move = []
+        for ffs in self.model:
+            try:
+                if self._get_main(ffs) == node:
+                    to_move.append(ffs)
+            except NoMainAvailable:
+                continue
+        for ffs in self._ffs_by_priority(to_move):
+            target = self._pick_drain_target(ffs, node, planned)
+            if target is None:
+                job["unmovable"].append(ffs)
+            else:
+                planned[target] += 1
+                job["targets"][ffs] = target
+                job["pending"].append(ffs)
+        self.drains[node] = job
+        self.config.inform(
+            "Draining %s: %i moves planned, %i ffs without replica"
+            % (node, len(job["pending"]), len(job["unmovable"]))
+        )
+        self._advance_node_jobs()
+        return {"ok": True, "moves": job["targets"], "unmovable": job["unmovable"]}
+
+    @needs_startup()
+    def client_service_rebuild_node(self, msg):
+        """(Re)create replicas on a (replaced) node for msg['ffs'],
+        in ffs:priority order, at most msg['concurrency'] seeding at once.
+        See service_drain_status for progress"""
+        if "node" not in msg:
+            raise CodingError("no node specified'")
+        if "ffs" not in msg:
+            raise CodingError("no ffs specified'")
+        node = self.config.find_node(msg["node"])
+        if not isinstance(msg["ffs"], list):
+            raise ValueError("ffs must be a list")
+        if node in self.rebuilds and (
+            self.rebuilds[node]["pending"] or self.rebuilds[node]["running"]
+        ):
+            raise NewInProgress("Node is already being rebuilt")
+        for ffs in msg["ffs"]:
+            if ffs not in self.model:
+                raise ValueError("Nonexistant ffs specified: %s" % ffs)
+        concurrency = msg.get("concurrency", self.config.get_drain_concurrency())
+        if not isinstance(concurrency, int) or concurrency < 1:
+            raise ValueError("concurrency must be an integer >= 1")
+        job = self._new_node_job(concurrency)
+        job["pending"] = self._ffs_by_priority(set(msg["ffs"]))
+        self.rebuilds[node] = job
+        self._advance_node_jobs()
+        return {"ok": True, "order": list(job["running"]) + list(job["pending"])}
+
+    def client_service_drain_status(self):
+        return {"drains": self.drains, "rebuilds": self.rebuilds}
+
+    def _node_job_step_done(self, kind, node, ffs):
+        if ffs not in self.model:
+            return True
+        if kind == "drain":
+            target = self.drains[node]["targets"][ffs]
+            try:
+                main = self._get_main(ffs)
+            except NoMainAvailable:
+                return False
+            return (
+                main == target
+                and not self.is_ffs_moving(ffs)
+                and not self.is_ffs_preseeding(ffs)
+            )
+        else:
+            if node not in self.model[ffs] or self.model[ffs][node].get("_new", False):
+                return False
+            try:
+                lag = self._replication_lag(ffs, time.time())
+            except NoMainAvailable:
+                return False
+            return node in lag and lag[node]["oldest_missing"] is None
+
+    def _start_node_job_step(self, kind, node, ffs):
+        if kind == "drain":
+            self.client_move_main(
+                {"ffs": ffs, "target": self.drains[node]["targets"][ffs]}
+            )
+        else:
+            self.client_add_targets({"ffs": ffs, "targets": [node]})
+
+    def _advance_node_jobs(self):
+        """Retire finished (or timed out) drain moves / rebuild seeds
+        and start pending ones.
+        An ffs that is busy (InProgress) stays pending and is retried next time"""
+        now = time.time()
+        timeout = self.config.get_drain_step_timeout()
+        for kind, jobs in (("drain", self.drains), ("rebuild", self.rebuilds)):
+            for node, job in sorted(jobs.items()):
+                for ffs in list(job["running"]):
+                    if self._node_job_step_done(kind, node, ffs):
+                        job["running"].remove(ffs)
+                        job["done"].append(ffs)
+                        self.config.inform("%s of %s: %s done" % (kind, node, ffs))
+                    elif timeout and now - job["started"][ffs] > timeout:
+                        job["running"].remove(ffs)
+                        job["failed"][ffs] = "timed out after %is" % timeout
+                        self.config.inform("%s of %s: %s timed out" % (kind, node, ffs))
+                busy = []
+                while job["pending"] and len(job["running"]) < job["concurrency"]:
+                    ffs = job["pending"].pop(0)
+                    try:
+                        self._start_node_job_step(kind, node, ffs)
+                    except ManualInterventionNeeded:
+                        raise
+                    except InProgress:
+                        busy.append(ffs)
+                        continue
+                    except (ValueError, KeyError, NodeIsReadonly, NoMainAvailable) as e:
+                        job["failed"][ffs] = str(e)
+                        continue
+                    job["running"].append(ffs)
+                    job["started"][ffs] = now
+                job["pending"][:0] = busy
+
     def client_deploy(self):
         return {"node.zip": base64.b64encode(self._node_zip).decode("utf-8")}
 
@@ -330,7 +640,10 @@ class Engine:
         if not isinstance(default_targets, list):
             self.fault("config.decide_targets returned non-list")
         if not msg["targets"]:
-            msg["targets"] = default_targets
+            by_load = self.config.decide_targets_by_load(
+                ffs, self._placement_candidates(ffs)
+            )
+            msg["targets"] = by_load if by_load is not None else default_targets
         targets = [self.config.find_node(x) for x in msg["targets"]]
         for node in targets:
             if self.is_readonly_node(node):
@@ -389,7 +702,10 @@ class Engine:
             raise NewInProgress(
                 "Target is still new - can not remove. Try again later."
             )
-        if self.is_ffs_moving(ffs):
+        if self.is_ffs_moving(ffs) or (
+            self.is_ffs_preseeding(ffs)
+            and target == self.model[ffs]["_preseeding"]["target"]
+        ):
             raise MoveInProgress(
                 "FFS is moving, can't remove targets during move. Try again later."
             )
@@ -403,15 +719,42 @@ class Engine:
         self.model[ffs][target] = {"removing": True}
         return {"ok": True}
 
+    def _placement_candidates(self, ffs):
+        """get_node_stats, restricted to the nodes ffs may be placed on -
+        not readonly, not yet holding it, holding the parent ffs (nested ffs)"""
+        parent = os.path.split(ffs)[0] if "/" in ffs else None
+        return {
+            node: stats
+            for (node, stats) in self.get_node_stats().items()
+            if not self.is_readonly_node(node)
+            and node not in self.model.get(ffs, {})
+            and (parent is None or node in self.model.get(parent, {}))
+        }
+
+    def _targets_by_load(self, ffs, count):
+        """count additional targets for ffs from config.decide_targets_by_load"""
+        if not isinstance(count, int) or count < 1:
+            raise ValueError("count must be an integer >= 1")
+        targets = self.config.decide_targets_by_load(
+            ffs, self._placement_candidates(ffs)
+        )
+        if targets is None:
+            raise ValueError(
+                "No load based placement available - config.decide_targets_by_load"
+            )
+        return targets[:count]
+
     @needs_startup()
     def client_add_targets(self, msg):
         if "ffs" not in msg:
             raise CodingError("No ffs specified")
-        if "targets" not in msg:
-            raise CodingError("target nots specified")
         ffs = msg["ffs"]
         if ffs not in self.model:
             raise ValueError("FFs unknown")
+        if "targets" not in msg and "count" in msg:
+            msg["targets"] = self._targets_by_load(ffs, msg["count"])
+        if "targets" not in msg:
+            raise CodingError("target nots specified")
         if not isinstance(msg["targets"], list):
             raise CodingError("targets must be alist")
 
@@ -433,7 +776,11 @@ class Engine:
             props = self.config.get_default_properties().copy()
             props.update(self.config.get_enforced_properties())
             props.update({"ffs:main": "off", "readonly": "on"})
-            properties_to_clone_to_new_targets = ["ffs:priority"]
+            properties_to_clone_to_new_targets = [
+                "ffs:priority",
+                "ffs:transport",
+                "ffs:max_lag",
+            ]
             main_props = self.model[ffs][self.model[ffs]["_main"]]["properties"]
             for k in properties_to_clone_to_new_targets:
                 if k in main_props:
@@ -558,6 +905,9 @@ class Engine:
     @needs_startup()
     def client_move_main(self, msg):
         # flow is as follows
+        # 0 - optional pre-seeding (config.get_move_preseed_rounds):
+        #     capture & replicate to target while the old main stays writable,
+        #     until a round's delta is below config.get_move_preseed_threshold
         # 1 - set ffs:moving=target on old main, set read only.
         # 2 - capture on old main
         # 3 - replicate
@@ -593,6 +943,53 @@ class Engine:
             raise NodeIsReadonly(current_main, "main")
         if self.is_readonly_node(target):
             raise ValueError("Target is on readonly node")
+        if self.is_ffs_preseeding(ffs):
+            raise MoveInProgress()
+        if msg.get("preseed", True) and self.config.get_move_preseed_rounds() > 0:
+            self.config.inform("Starting move pre-seeding for: %s" % ffs)
+            self.model[ffs]["_preseeding"] = {"target": target, "round": 0}
+            self._preseed_round(ffs)
+        else:
+            self._start_move(ffs, target)
+        return {"ok": True}
+
+    def _preseed_round(self, ffs):
+        preseed = self.model[ffs]["_preseeding"]
+        preseed["round"] += 1
+        preseed["snapshot"] = self.do_capture(ffs, False)
+        target = preseed["target"]
+        if not self._wants_snapshot(ffs, target, preseed["snapshot"]):
+            # ffs:postfix_only target - the capture won't send it there
+            self._send_snapshot(self._get_main(ffs), target, ffs, preseed["snapshot"])
+
+    def _preseed_round_done(self, ffs, msg):
+        """Pre-seed snapshot arrived on the new main. Another round while
+        the delta was large, the read only move steps otherwise"""
+        preseed = self.model[ffs]["_preseeding"]
+        delta = msg.get("bytes_transferred", None)
+        if delta is None:
+            size = (
+                self.model[ffs][msg["from"]]
+                .get("snapshot_sizes", {})
+                .get(msg["snapshot"], None)
+            )
+            if size is not None:
+                delta = size["written"]
+        self.logger.info(
+            "Pre-seed round %i of %s to %s done, delta=%s bytes"
+            % (preseed["round"], ffs, preseed["target"], delta)
+        )
+        if (
+            delta is not None and delta <= self.config.get_move_preseed_threshold()
+        ) or preseed["round"] >= self.config.get_move_preseed_rounds():
+            del self.model[ffs]["_preseeding"]
+            self._start_move(ffs, preseed["target"])
+        else:
+            self._preseed_round(ffs)
+
+    def _start_move(self, ffs, target):
+        """Move step 1"""
+        current_main = self._get_main(ffs)
         self.model[ffs]["_moving"] = target
         # self.model[ffs][current_main]['properties']['readonly'] = 'on'
         self.config.inform("Starting move for: %s" % ffs)
@@ -604,7 +1001,6 @@ class Engine:
                 "properties": {"readonly": "on", "ffs:moving_to": target},
             },
         )
-        return {"ok": True}
 
     @needs_startup()
     def client_rename(self, msg):
@@ -633,7 +1029,7 @@ class Engine:
                 raise ValueError(
                     "Rename of parent ffs is currently unsupported. Sorry, you'll have to manipulate the underlying zfs structure"
                 )
-        if self.is_ffs_moving(ffs):
+        if self.is_ffs_moving(ffs) or self.is_ffs_preseeding(ffs):
             raise MoveInProgress()
         if self.is_ffs_removing_any(ffs):
             raise RemoveInProgress()
@@ -726,6 +1122,76 @@ class Engine:
                 )
         return {"ok": True}
 
+    @needs_startup()
+    def client_set_max_lag(self, msg):
+        """Replication lag (seconds) snapshots should reach all targets within.
+        Sends close to their deadline go first. 0 = no limit"""
+        if "ffs" not in msg:
+            raise CodingError("no ffs specified'")
+        ffs = msg["ffs"]
+        if not isinstance(ffs, str):
+            raise ValueError("ffs parameter must be a string")
+        if ffs not in self.model:
+            raise ValueError("Nonexistant ffs specified")
+        if "max_lag" not in msg:
+            raise CodingError("no max_lag specified'")
+        max_lag = msg["max_lag"]
+        if not isinstance(max_lag, int):
+            raise ValueError("max_lag parameter must be an integer")
+        if max_lag < 0:
+            raise ValueError("max_lag must be positive")
+        if max_lag == 0:
+            max_lag = "-"
+        else:
+            max_lag = str(max_lag)
+        main = self._get_main(ffs)
+        if self.is_readonly_node(main):
+            raise NodeIsReadonly(main, "main")
+        # store on every node in order to remain stored on move
+        for node in sorted(self.model[ffs]):
+            if not node.startswith("_"):
+                self.send(
+                    node,
+                    {
+                        "msg": "set_properties",
+                        "ffs": ffs,
+                        "properties": {"ffs:max_lag": max_lag},
+                    },
+                )
+        return {"ok": True}
+
+    @needs_startup()
+    def client_set_transport(self, msg):
+        if "ffs" not in msg:
+            raise CodingError("no ffs specified'")
+        ffs = msg["ffs"]
+        if not isinstance(ffs, str):
+            raise ValueError("ffs parameter must be a string")
+        if ffs not in self.model:
+            raise ValueError("Nonexistant ffs specified")
+        if "transport" not in msg:
+            raise CodingError("no transport specified'")
+        transport = msg["transport"]
+        if transport not in self.valid_transports:
+            raise ValueError(
+                "transport must be one of %s" % (sorted(self.valid_transports),)
+            )
+        main = self._get_main(ffs)
+        if self.is_readonly_node(main):
+            raise NodeIsReadonly(main, "main")
+        # store on every node in order to remain stored on move
+        for node in sorted(self.model[ffs]):
+            if not node.startswith("_"):
+                self.send(
+                    node,
+                    {
+                        "msg": "set_properties",
+                        "ffs": ffs,
+                        "properties": {"ffs:transport": transport},
+                    },
+                )
+        return {"ok": True}
+
     @needs_startup()
     def client_list_snapshots(self, msg):
         if "ffs" not in msg:
@@ -796,9 +1262,146 @@ class Engine:
     def client_service_list_disks(self, _msg):
         return self.zpool_disks
 
+    def client_service_pool_stats(self, msg):
+        """The zpool capacity/io time series per node
+        (msg['node'] to restrict), oldest first"""
+        if "node" in msg:
+            nodes = [self.config.find_node(msg["node"])]
+        else:
+            nodes = sorted(self.pool_stats)
+        return {
+            node: [
+                {"time": t, "pools": pools}
+                for (t, pools) in self.pool_stats.get(node, [])
+            ]
+            for node in nodes
+        }
+
+    def client_service_capacity_forecast(self):
+        res = {}
+        for node in sorted(self.pool_stats):
+            res[node] = self.get_node_forecast(node)
+            res[node]["pressure"] = node in self.pressure_nodes
+        return res
+
+    def get_node_forecast(self, node):
+        """Least squares fit of the storage pool's free bytes over the last
+        forecast_window seconds: {free, fill_rate (bytes/s, > 0 = filling),
+        time_to_full (seconds, None if not filling or unknown)}"""
+        pool = self._storage_pool(node)
+        series = self.pool_stats.get(node, [])
+        samples = [(t, x[pool]["free"]) for (t, x) in series if pool in x]
+        if not samples:
+            return {"free": None, "fill_rate": None, "time_to_full": None}
+        cutoff = samples[-1][0] - self.forecast_window
+        samples = [(t, free) for (t, free) in samples if t >= cutoff]
+        free = samples[-1][1]
+        n = float(len(samples))
+        mean_t = sum([t for (t, _) in samples]) / n
+        mean_free = sum([f for (_, f) in samples]) / n
+        var_t = sum([(t - mean_t) ** 2 for (t, _) in samples])
+        if var_t == 0:
+            return {"free": free, "fill_rate": None, "time_to_full": None}
+        slope = sum([(t - mean_t) * (f - mean_free) for (t, f) in samples]) / var_t
+        fill_rate = -slope
+        time_to_full = free / fill_rate if fill_rate > 0 else None
+        return {"free": free, "fill_rate": fill_rate, "time_to_full": time_to_full}
+
+    def _check_pressure(self, node):
+        """Enter / leave pressure retention for node, prune if in it"""
+        threshold = self.config.get_pressure_time_to_full()
+        if not threshold:
+            self.pressure_nodes.discard(node)
+            return
+        time_to_full = self.get_node_forecast(node)["time_to_full"]
+        if node not in self.pressure_nodes:
+            if time_to_full is not None and time_to_full < threshold:
+                self.pressure_nodes.add(node)
+                self.error_callback(
+                    "Pool on %s forecast to be full in %.1f hours - pressure retention"
+                    % (node, time_to_full / 3600.0)
+                )
+        elif time_to_full is None or time_to_full > 2 * threshold:
+            self.pressure_nodes.discard(node)
+            self.config.inform("Pool on %s: pressure retention ended" % node)
+        if node in self.pressure_nodes:
+            self._pressure_prune(node)
+
+    def _pressure_prune(self, node):
+        """Remove what decide_snapshots_to_keep_under_pressure does not keep
+        from node - least important (highest ffs:priority) ffs first,
+        as urgent removals in the deletion lane (see _send_deletions).
+        Only replicas - the main's snapshots are what every replica's retention
+        is decided on, pruning them would cascade to all replicas."""
+        if self.is_readonly_node(node):
+            return
+        candidates = []
+        for ffs in self.model:
+            if (
+                node not in self.model[ffs]
+                or "snapshots" not in self.model[ffs][node]
+                or self.model[ffs][node].get("removing", False)
+                or not self.has_main(ffs)
+                or self._get_main(ffs) == node
+                or self.is_ffs_moving(ffs)
+                or self.is_ffs_renaming(ffs)
+                or self.is_ffs_new_any(ffs)
+            ):
+                continue
+            candidates.append(ffs)
+        for ffs in reversed(self._ffs_by_priority(candidates)):
+            main = self._get_main(ffs)
+            main_snapshots = self.model[ffs][main]["snapshots"]
+            if not main_snapshots:
+                continue
+            keep = self.config.decide_snapshots_to_keep_under_pressure(
+                ffs, main_snapshots
+            )
+            keep.add(main_snapshots[-1])
+            keep.update(self.model[ffs]["_snapshots_in_transit"].keys())
+            snapshots = self.model[ffs][node]["snapshots"]
+            to_remove = [x for x in snapshots if x not in keep]
+            if len(to_remove) == len(snapshots):  # never the last one
+                to_remove = to_remove[:-1]
+            for sn in to_remove:
+                self._queue_snapshot_removal(node, ffs, sn, urgent=True)
+                # and forget they existed for now.
+                snapshots.remove(sn)
+        self._send_deletions(node)
+
+    def _storage_pool(self, node):
+        """name of the zpool below the node's storage_prefix"""
+        return self.node_config[node]["storage_prefix"].strip("/").split("/")[0]
+
+    def get_node_stats(self, window=15 * 60):
+        """{node: latest stats of the pool holding the ffs} - read/write bytes
+        (& ops) are averaged over the last window seconds.
+        Nodes that have not reported (zpool checks disabled?) are missing."""
+        res = {}
+        now = time.time()
+        for node, series in self.pool_stats.items():
+            if not series:
+                continue
+            pool = self._storage_pool(node)
+            t, pools = series[-1]
+            if pool not in pools:
+                continue
+            stats = dict(pools[pool])
+            recent = [x[pool] for (t, x) in series if t >= now - window and pool in x]
+            for k in ("read_ops", "write_ops", "read_bytes", "write_bytes"):
+                values = [x[k] for x in recent if k in x]
+                if values:
+                    stats[k] = sum(values) / float(len(values))
+            res[node] = stats
+        return res
+
     def is_readonly_node(self, node):
         return self.config.get_nodes()[node].get("readonly_node", False)
 
+    def is_ffs_preseeding(self, ffs):
+        """move_main before step 1 - the old main is still writable"""
+        return "_preseeding" in self.model[ffs]
+
     def is_ffs_moving(self, ffs):
         if "_moving" in self.model[ffs]:
             self.config.inform("is_moving(%s) == True because of _moving" % ffs)
@@ -975,9 +1578,17 @@ class Engine:
                             % ffs,
                             exception=ManualInterventionNeeded,
                         )
+                    transport = node_info["properties"].get("ffs:transport", "-")
+                    if transport not in self.valid_transports:
+                        self.fault(
+                            "ffs:transport was not one of %s: %s on %s"
+                            % (sorted(self.valid_transports), ffs, node),
+                            exception=ManualInterventionNeeded,
+                        )
                     for must_be_numeric, must_be_positive in [
                         ("snapshot_interval", True),
                         ("priority", False),
+                        ("max_lag", True),
                     ]:
                         value = node_info["properties"].get(
                             "ffs:" + must_be_numeric, "-"
@@ -1012,7 +1623,12 @@ class Engine:
                 main_info = self.model[ffs][main]
                 for node, node_info in sorted(self.model[ffs].items()):
                     if node != main and not node.startswith("_"):
-                        for prop in ["ffs:snapshot_interval", "ffs:priority"]:
+                        for prop in [
+                            "ffs:snapshot_interval",
+                            "ffs:priority",
+                            "ffs:transport",
+                            "ffs:max_lag",
+                        ]:
                             node_prop = node_info["properties"].get(prop, "-")
                             # if node_prop != '-':
                             main_prop = main_info["properties"].get(prop, "-")
@@ -1391,12 +2007,10 @@ class Engine:
             remove_from_main = [x for x in main_snapshots if x not in keep_snapshots]
             for snapshot in remove_from_main:
                 if not self.is_readonly_node(main_node):
-                    self.send(
-                        main_node,
-                        {"msg": "remove_snapshot", "ffs": ffs, "snapshot": snapshot},
-                    )
+                    self._queue_snapshot_removal(main_node, ffs, snapshot)
                     # and forget they existed for now.
                     node_fss_info[main_node]["snapshots"].remove(snapshot)
+            self._send_deletions(main_node)
         for node in sorted(node_fss_info):
             if node != main_node and not node.startswith("_"):
                 if restrict_to_node is None or restrict_to_node == node:
@@ -1407,16 +2021,124 @@ class Engine:
                         too_many = too_many[:-1]
                     for snapshot in too_many:
                         if not self.is_readonly_node(node):
-                            self.send(
-                                node,
-                                {
-                                    "msg": "remove_snapshot",
-                                    "ffs": ffs,
-                                    "snapshot": snapshot,
-                                },
-                            )
+                            self._queue_snapshot_removal(node, ffs, snapshot)
                             # and forget they existed for now.
                         node_fss_info[node]["snapshots"].remove(snapshot)
+                    self._send_deletions(node)
+
+    def _queue_snapshot_removal(self, node, ffs, snapshot, urgent=False):
+        """Call _send_deletions(node) once everything is queued.
+        Urgent removals queue behind other urgent ones, but in front of the rest"""
+        que = self.deletion_que.setdefault(node, collections.deque())
+        entry = (ffs, snapshot, time.time(), urgent)
+        if not urgent:
+            que.append(entry)
+            return
+        ii = 0
+        while ii < len(que) and que[ii][3]:
+            ii += 1
+        que.insert(ii, entry)
+
+    def _send_deletions(self, node):
+        """Snapshot removals have their own lane per node, so big prune waves
+        don't compete with the replication: they are sent while
+        config.deletion_window_open, at most get_deletion_rate_limit snapshots
+        per deletion_window and get_concurrent_deletion_limit calls at a time.
+        Consecutive removals from one ffs are merged into remove_snapshots
+        calls of up to get_deletion_batch_size snapshots.
+
+        Urgent removals (pressure retention, see _pressure_prune) are first in
+        line and ignore the window, rate limit and batch size - they're still
+        accounted, and only wait for the concurrency limit."""
+        que = self.deletion_que.get(node)
+        if not que:
+            return
+        window_open = self.config.deletion_window_open(node)
+        now = time.time()
+        sent = self.deletions_sent.setdefault(node, collections.deque())
+        while sent and sent[0][0] < now - self.deletion_window:
+            sent.popleft()
+        rate_limit = self.config.get_deletion_rate_limit()
+        if rate_limit:
+            budget = rate_limit - sum([count for (_, count) in sent])
+        else:
+            budget = len(que)
+        concurrency = self.config.get_concurrent_deletion_limit()
+        batch_size = self.config.get_deletion_batch_size()
+        in_flight = self.deletions_in_flight.setdefault(node, [])
+        held = []  # renaming - node_rename_done requeues them under the new name
+        while que and (not concurrency or len(in_flight) < concurrency):
+            ffs, _, _, urgent = que[0]
+            if ffs in self.model and self.is_ffs_renaming(ffs):
+                held.append(que.popleft())
+                continue
+            if urgent:
+                limit = len(que)
+            elif window_open and budget > 0:
+                limit = min(batch_size, budget)
+            else:
+                break
+            snapshots = []
+            while (
+                que
+                and que[0][0] == ffs
+                and que[0][3] == urgent
+                and len(snapshots) < limit
+            ):
+                snapshots.append(que.popleft()[1])
+            if ffs not in self.model or node not in self.model[ffs]:
+                continue  # removed or renamed in the meantime
+            if len(snapshots) == 1:
+                msg = {"msg": "remove_snapshot", "ffs": ffs, "snapshot": snapshots[0]}
+            else:
+                msg = {"msg": "remove_snapshots", "ffs": ffs, "snapshots": snapshots}
+            self.send(node, msg)
+            in_flight.append((ffs, snapshots))
+            sent.append((now, len(snapshots)))
+            budget -= len(snapshots)
+        que.extendleft(reversed(held))
+
+    def _deletion_returned(self, node, ffs, snapshots, removed_count):
+        """Account a returned removal call - if it came from the deletion lane"""
+        in_flight = self.deletions_in_flight.get(node, [])
+        for ii, (in_flight_ffs, in_flight_snapshots) in enumerate(in_flight):
+            if in_flight_ffs == ffs and sorted(in_flight_snapshots) == sorted(
+                snapshots
+            ):
+                del in_flight[ii]
+                done = self.deletions_done.setdefault(node, collections.deque())
+                done.append((time.time(), removed_count))
+                self._send_deletions(node)
+                return
+
+    def client_service_deletion_que(self):
+        """Per node: queued snapshot removals (and how long the oldest waited),
+        snapshots being removed, and snapshots removed in the last
+        deletion_window seconds"""
+        res = {}
+        now = time.time()
+        nodes = (
+            set(self.deletion_que)
+            | set(self.deletions_in_flight)
+            | set(self.deletions_done)
+        )
+        for node in sorted(nodes):
+            que = self.deletion_que.get(node, [])
+            done = self.deletions_done.get(node, collections.deque())
+            while done and done[0][0] < now - self.deletion_window:
+                done.popleft()
+            res[node] = {
+                "queued": len(que),
+                "urgent_queued": len([x for x in que if x[3]]),
+                "oldest_queued_seconds": now - que[0][2] if que else 0,
+                "in_flight": sum(
+                    [len(x[1]) for x in self.deletions_in_flight.get(node, [])]
+                ),
+                "removed_in_window": sum([count for (_, count) in done]),
+                "window_seconds": self.deletion_window,
+                "window_open": self.config.deletion_window_open(node),
+            }
+        return res
 
     def _send_missing_snapshots(self):
         """Once we have parsed the ffs_lists into our model (see _parse_main_and_readonly),
@@ -1484,8 +2206,10 @@ class Engine:
                             break
                     missing = list(reversed(missing))
                     self.logger.info("Missing on %s for %s - %s", ffs, node, missing)
-                    for sn in missing:
-                        self._send_snapshot(main, node, ffs, sn)
+                    if missing:
+                        sending_node = self._pick_sending_node(ffs, node, missing)
+                        for sn in missing:
+                            self._send_snapshot(sending_node, node, ffs, sn)
 
     def _capture_replicated_without_any_snapshots(self):
         for ffs, node_ffs_info in self.model.items():
@@ -1524,16 +2248,311 @@ class Engine:
                     return None
         return prio
 
-    def _send_snapshot(self, sending_node, receiving_node, ffs, snapshot_name):
+    def get_ffs_max_lag(self, ffs):
+        """ffs:max_lag in seconds, None if unset"""
+        main = self._get_main(ffs)
+        max_lag = self.model[ffs][main]["properties"].get("ffs:max_lag", "-")
+        if max_lag == "-":
+            return None
+        return int(max_lag)
+
+    def _capture_time(self, ffs, snapshot):
+        """When was this snapshot taken? Recorded on capture_done,
+        otherwise read from the ffs-... snapshot name. None if unknown."""
+        if (ffs, snapshot) in self.capture_times:
+            return self.capture_times[ffs, snapshot]
+        try:
+            return self.parse_time_from_snapshot(snapshot)
+        except (ValueError, IndexError):
+            return None
+
+    def _replication_lag(self, ffs, now):
+        """{target: {lag, oldest_missing, last_arrival}} - see
+        client_service_replication_lag"""
+        main = self._get_main(ffs)
+        main_snapshots = self.model[ffs][main]["snapshots"]
+        res = {}
+        for node in sorted(self.model[ffs]):
+            if node.startswith("_") or node == main:
+                continue
+            node_info = self.model[ffs][node]
+            if "snapshots" not in node_info:  # new or being removed
+                continue
+            start = 0
+            for ii, sn in enumerate(main_snapshots):
+                if sn in node_info["snapshots"]:
+                    start = ii + 1
+            missing = [
+                sn
+                for sn in main_snapshots[start:]
+                if self._wants_snapshot(ffs, node, sn)
+            ]
+            arrivals = [
+                self.arrival_times[ffs, node, sn]
+                for sn in node_info["snapshots"]
+                if (ffs, node, sn) in self.arrival_times
+            ]
+            if missing:
+                captured = self._capture_time(ffs, missing[0])
+                lag = None if captured is None else max(0, now - captured)
+            else:
+                lag = 0
+            res[node] = {
+                "lag": lag,
+                "oldest_missing": missing[0] if missing else None,
+                "last_arrival": max(arrivals) if arrivals else None,
+            }
+        return res
+
+    def get_ffs_transport(self, ffs):
+        main = self._get_main(ffs)
+        transport = self.model[ffs][main]["properties"].get("ffs:transport", "-")
+        if transport == "-":
+            return "rsync"
+        return transport
+
+    def _find_incremental_base(self, sending_node, receiving_node, ffs, snapshot_name):
+        """Find the snapshot a zfs send -i for snapshot_name can be based on.
+
+        That's the newest snapshot the receiver has - or will have once the
+        sends already queued for it are done - provided the sender
+        has it as well, and it predates snapshot_name.
+        Returns None if there is no such common snapshot.
+        """
+        sender_snapshots = self.model[ffs][sending_node].get("snapshots", [])
+        if snapshot_name not in sender_snapshots:
+            return None
+        receiver_snapshots = list(self.model[ffs][receiving_node].get("snapshots", []))
+        for node in sorted(self.node_config):
+            for msg in self.sender.get_messages_for_node(node):
+                if (
+                    msg["msg"] == "send_snapshot"
+                    and msg["ffs"] == ffs
+                    and msg["target_node"] == receiving_node
+                    and msg["snapshot"] not in receiver_snapshots
+                ):
+                    receiver_snapshots.append(msg["snapshot"])
+        if not receiver_snapshots:
+            return None
+        base = receiver_snapshots[-1]
+        if base not in sender_snapshots:
+            return None
+        if sender_snapshots.index(base) >= sender_snapshots.index(snapshot_name):
+            return None
+        return base
+
+    def _shares_zfs_lineage(self, sending_node, receiving_node, ffs, snapshot):
+        """Is receiving_node's snapshot (or the one queued for it) the very
+        zfs snapshot sending_node has - same guid, i.e. it got there by zfs send?
+
+        Replicas filled by rsync / tar seeds carry the same snapshot names,
+        but their own guids - zfs receive -i would refuse them.
+        """
+        guid = self.model[ffs][sending_node].get("snapshot_guids", {}).get(snapshot)
+        if guid is None:
+            return False
+        if snapshot in self.model[ffs][receiving_node].get("snapshots", []):
+            return (
+                self.model[ffs][receiving_node].get("snapshot_guids", {}).get(snapshot)
+                == guid
+            )
+        for node in sorted(self.node_config):
+            for msg in self.sender.get_messages_for_node(node):
+                if (
+                    msg["msg"] == "send_snapshot"
+                    and msg["ffs"] == ffs
+                    and msg["target_node"] == receiving_node
+                    and msg["snapshot"] == snapshot
+                ):
+                    return (
+                        msg.get("transport", "rsync") == "zfs_send"
+                        and self.model[ffs][node]
+                        .get("snapshot_guids", {})
+                        .get(snapshot)
+                        == guid
+                    )
+        return False
+
+    def _wants_snapshot(self, ffs, node, snapshot):
+        postfix = (
+            self.model[ffs][node].get("properties", {}).get("ffs:postfix_only", True)
+        )
+        return postfix is True or snapshot.endswith("-" + postfix)
+
+    def _snapshot_queued_for(self, ffs, receiving_node, snapshot):
+        for node in sorted(self.node_config):
+            for msg in self.sender.get_messages_for_node(node):
+                if (
+                    msg["msg"] == "send_snapshot"
+                    and msg["ffs"] == ffs
+                    and msg["target_node"] == receiving_node
+                    and msg["snapshot"] == snapshot
+                ):
+                    return True
+        return False
+
+    def _replication_tree(self, ffs, snapshot):
+        """([main, replica, ...], fanout) - member i receives snapshot from
+        member (i - 1) // fanout.
+        None if we're replicating in a star (config / moves)"""
+        fanout = self.config.get_replication_fanout(ffs)
+        if not fanout or self.is_ffs_moving(ffs):
+            return None
+        main = self._get_main(ffs)
+        members = [main]
+        for node in sorted(self.model[ffs]):
+            if (
+                node.startswith("_")
+                or node == main
+                or self.is_readonly_node(node)
+                or self.model[ffs][node].get("_new", False)
+                or self.model[ffs][node].get("removing", False)
+                or not self._wants_snapshot(ffs, node, snapshot)
+            ):
+                continue
+            members.append(node)
+        return members, fanout
+
+    def _replication_parent(self, ffs, node, snapshot):
+        """Who sends snapshot to node - None for a star / non members"""
+        tree = self._replication_tree(ffs, snapshot)
+        if tree is None:
+            return None
+        members, fanout = tree
+        if node not in members[1:]:
+            return None
+        return members[(members.index(node) - 1) // fanout]
+
+    def _replication_children(self, ffs, node, snapshot):
+        tree = self._replication_tree(ffs, snapshot)
+        if tree is None or node not in tree[0]:
+            return []
+        members, fanout = tree
+        i = members.index(node)
+        return members[i * fanout + 1 : (i + 1) * fanout + 1]
+
+    def _forward_snapshot(self, ffs, node, snapshot):
+        """node just received snapshot - pass it on down the replication tree.
+        Unless the child is still catching up from another node -
+        that one sends it as well (if it has it), after the others"""
+        for child in self._replication_children(ffs, node, snapshot):
+            if snapshot not in self.model[ffs][child][
+                "snapshots"
+            ] and not self._snapshot_queued_for(ffs, child, snapshot):
+                sender = self._pinned_sender(ffs, child)
+                if sender is None or snapshot not in self.model[ffs][sender].get(
+                    "snapshots", []
+                ):
+                    sender = node
+                self._send_snapshot(sender, child, ffs, snapshot)
+
+    def _pinned_sender(self, ffs, receiving_node):
+        """The node with send_snapshots of ffs to receiving_node queued
+        or running - None if there are none"""
+        for node in sorted(self.node_config):
+            for msg in self.sender.get_messages_for_node(node):
+                if (
+                    msg["msg"] == "send_snapshot"
+                    and msg["ffs"] == ffs
+                    and msg["target_node"] == receiving_node
+                ):
+                    return node
+        return None
+
+    def _outbound_load(self, node):
+        """Queued and running send_snapshots of this node"""
+        return len(
+            [
+                x
+                for x in self.sender.get_messages_for_node(node)
+                if x["msg"] == "send_snapshot"
+            ]
+        )
+
+    def _pick_sending_node(self, ffs, receiving_node, snapshots):
+        """Who should send these snapshots (in this order) to receiving_node?
+
+        The main - unless config.use_replicas_as_source(), then the
+        least loaded node holding all of them (ties go to the main).
+        Sends already queued for this target pin the sender where it can.
+        New snapshots still come from the main (see node_capture_done) -
+        the outgoing queue runs the sends into one target one at a time,
+        in order, whichever node they come from.
+        """
+        main = self._get_main(ffs)
+        pinned = self._pinned_sender(ffs, receiving_node)
+        if pinned is not None and all(
+            sn in self.model[ffs][pinned]["snapshots"] for sn in snapshots
+        ):
+            return pinned
+        parent = self._replication_parent(ffs, receiving_node, snapshots[-1])
+        if parent is not None and all(
+            sn in self.model[ffs][parent]["snapshots"] for sn in snapshots
+        ):
+            return parent
+        # else: parent is lagging as well - don't wait for it.
+        if not self.config.use_replicas_as_source():
+            return main
+        candidates = [main]
+        for node in sorted(self.model[ffs]):
+            if (
+                node.startswith("_")
+                or node in (main, receiving_node)
+                or self.model[ffs][node].get("_new", False)
+                or self.model[ffs][node].get("removing", False)
+            ):
+                continue
+            if all(sn in self.model[ffs][node]["snapshots"] for sn in snapshots):
+                candidates.append(node)
+        return min(
+            candidates, key=lambda node: (self._outbound_load(node), node != main)
+        )
+
+    def _estimate_send_bytes(self, sending_node, receiving_node, ffs, snapshot_name):
+        """Bytes written between the receiver's last (incl. queued) snapshot
+        and snapshot_name, or up to snapshot_name for a full send.
+        None if the sender did not report sizes"""
+        sizes = self.model[ffs][sending_node].get("snapshot_sizes", {})
+        sender_snapshots = self.model[ffs][sending_node]["snapshots"]
+        if snapshot_name not in sender_snapshots:
+            return None
+        base = self._find_incremental_base(
+            sending_node, receiving_node, ffs, snapshot_name
+        )
+        start = 0 if base is None else sender_snapshots.index(base) + 1
+        total = 0
+        for sn in sender_snapshots[start : sender_snapshots.index(snapshot_name) + 1]:
+            if sn not in sizes:
+                return None
+            total += sizes[sn]["written"]
+        return total
+
+    def _is_empty_target(self, receiving_node, ffs):
+        """Does the receiver have no snapshot of this ffs,
+        and none is on it's way?"""
+        if self.model[ffs][receiving_node].get("snapshots", []):
+            return False
+        for node in sorted(self.node_config):
+            for msg in self.sender.get_messages_for_node(node):
+                if (
+                    msg["msg"] == "send_snapshot"
+                    and msg["ffs"] == ffs
+                    and msg["target_node"] == receiving_node
+                ):
+                    return False
+        return True
+
+    def _send_snapshot(self, sending_node, receiving_node, ffs, snapshot_name, retry=0):
         excluded_sub_ffs = set()
         for another_ffs in self.model:
             if another_ffs.startswith(ffs + "/"):
                 remainder = another_ffs[len(ffs) + 1 :]
                 if not "/" in remainder:  # don't nest
                     excluded_sub_ffs.add(remainder)
-        excluded_sub_ffs.update(
-            self.config.exclude_subdirs_callback(ffs, sending_node, receiving_node)
+        excluded_by_config = self.config.exclude_subdirs_callback(
+            ffs, sending_node, receiving_node
         )
+        excluded_sub_ffs.update(excluded_by_config)
         excluded_sub_ffs = sorted(list(excluded_sub_ffs))
         msg = {
             "msg": "send_snapshot",
@@ -1548,11 +2567,50 @@ class Engine:
             "target_storage_prefix": self.node_config[receiving_node]["storage_prefix"],
             "excluded_subdirs": excluded_sub_ffs,
         }
-        if self.node_config[sending_node].get("readonly_node", False):
+        if self.node_config[sending_node].get(
+            "readonly_node", False
+        ) or sending_node != self._get_main(ffs):
+            # replicas: read from the snapshot directly, no clone
             msg["source_is_readonly"] = True
+        # zfs send can't leave out directories - sub ffs are seperate
+        # datasets anyhow, but the config exclusions would be ignored.
+        empty_target = self._is_empty_target(receiving_node, ffs)
+        if self.get_ffs_transport(ffs) == "zfs_send" and not excluded_by_config:
+            if empty_target:
+                # a full stream - the replica's snapshots are then the
+                # sender's (same guids), so the next send can be incremental
+                msg["transport"] = "zfs_send"
+            else:
+                base = self._find_incremental_base(
+                    sending_node, receiving_node, ffs, snapshot_name
+                )
+                if base is not None and self._shares_zfs_lineage(
+                    sending_node, receiving_node, ffs, base
+                ):
+                    msg["transport"] = "zfs_send"
+                    msg["incremental_base"] = base
+                # otherwise: rsync
+        if empty_target:
+            # first transfer into a fresh replica - stream a tar instead
+            # of paying rsync's per file overhead (also the fallback
+            # should the full zfs stream fail)
+            msg["seed"] = True
         prio = self.get_ffs_priority(ffs)
         if prio is not None:
             msg["priority"] = int(prio)
+        estimated_bytes = self._estimate_send_bytes(
+            sending_node, receiving_node, ffs, snapshot_name
+        )
+        if estimated_bytes is not None:  # for shortest job first scheduling
+            msg["estimated_bytes"] = estimated_bytes
+        max_lag = self.get_ffs_max_lag(ffs)
+        if max_lag is not None:
+            captured = self._capture_time(ffs, snapshot_name)
+            if captured is not None:  # earliest deadline first, see prioritize
+                msg["max_lag"] = max_lag
+                msg["deadline"] = captured + max_lag
+        if retry:
+            msg["retry"] = retry
         self.send(sending_node, msg)
         self.model[ffs]["_snapshots_in_transit"][snapshot_name] += 1
 
@@ -1619,6 +2677,7 @@ class Engine:
                                 CodingError,
                             )
                         self._prune_snapshots_for_ffs(ffs)
+                        self._advance_node_jobs()
                     else:
                         self.config.inform("Not move step 7 response")
         elif (  # happens after ffs:main=off on the old main.
@@ -1671,9 +2730,12 @@ class Engine:
                     ffs, self.model[ffs][main]["snapshots"]
                 )
                 if to_send:  # we have snapshots to send
-                    for sn in self.model[ffs][main]["snapshots"]:
-                        if sn in to_send:  # to send is a set!
-                            self._send_snapshot(main, node, ffs, sn)
+                    ordered_to_send = [
+                        sn for sn in self.model[ffs][main]["snapshots"] if sn in to_send
+                    ]
+                    sending_node = self._pick_sending_node(ffs, node, ordered_to_send)
+                    for sn in ordered_to_send:
+                        self._send_snapshot(sending_node, node, ffs, sn)
                 else:  # this ffs was never captured, but we want to sync the status quo.
                     self.do_capture(ffs, False)
 
@@ -1698,6 +2760,18 @@ class Engine:
             if snapshot in self.model[ffs][sender]["snapshots"]:
                 self.fault("Snapshot was already in model", msg, CodingError)
             self.model[ffs][sender]["snapshots"].append(snapshot)
+            self.capture_times[ffs, snapshot] = time.time()
+            self.arrival_times[ffs, sender, snapshot] = self.capture_times[
+                ffs, snapshot
+            ]
+            if "written" in msg:
+                self.model[ffs][sender].setdefault("snapshot_sizes", {})[snapshot] = {
+                    "used": msg.get("used", 0),
+                    "written": msg["written"],
+                }
+            if "guid" in msg:
+                guids = self.model[ffs][sender].setdefault("snapshot_guids", {})
+                guids[snapshot] = msg["guid"]
 
             main = self._get_main(ffs)
             for node in sorted(self.node_config):
@@ -1712,7 +2786,10 @@ class Engine:
                         .get("ffs:postfix_only", True)
                     )
                     if postfix is True or snapshot.endswith("-" + postfix):
-                        self._send_snapshot(main, node, ffs, snapshot)
+                        parent = self._replication_parent(ffs, node, snapshot)
+                        if parent is None or parent == main:
+                            self._send_snapshot(main, node, ffs, snapshot)
+                        # else: the parent forwards it once it has it
             if not self.is_ffs_moving(ffs):
                 self._prune_snapshots_for_ffs(ffs, main)
             else:
@@ -1724,7 +2801,7 @@ class Engine:
             self.model[ffs][sender]["upcoming_snapshots"].remove(snapshot)
 
     def node_send_snapshot_done(self, msg):
-        main = msg["from"]
+        sender = msg["from"]  # the main - or a replica, see _pick_sending_node
         if "ffs" not in msg:
             self.fault("missing ffs parameter", msg, CodingError)
         ffs = msg["ffs"]
@@ -1733,8 +2810,8 @@ class Engine:
                 "send_snapshot_done from ffs not in model.", msg, InconsistencyError
             )
         node = msg["target_node"]
-        if main == node:
-            self.fault("Send done from main to main?!", msg, InconsistencyError)
+        if sender == node:
+            self.fault("Send done from node to itself?!", msg, InconsistencyError)
         if "snapshot" not in msg:
             self.fault("No snapshot in msg", msg, CodingError)
         snapshot = msg["snapshot"]
@@ -1742,6 +2819,25 @@ class Engine:
             self.fault("Snapshot was already in model", msg, CodingError)
 
         self.model[ffs][node]["snapshots"].append(snapshot)
+        self.arrival_times[ffs, node, snapshot] = time.time()
+        size = self.model[ffs][sender].get("snapshot_sizes", {}).get(snapshot, None)
+        if size is not None:  # good enough an estimate should node send it on
+            self.model[ffs][node].setdefault("snapshot_sizes", {})[snapshot] = size
+        guids = self.model[ffs][node].setdefault("snapshot_guids", {})
+        guid = self.model[ffs][sender].get("snapshot_guids", {}).get(snapshot, None)
+        if msg.get("transport", "rsync") == "zfs_send" and guid is not None:
+            guids[snapshot] = guid
+        else:  # rsync made a new zfs snapshot on the receiver
+            guids.pop(snapshot, None)
+        self.send_snapshot_failures.pop((ffs, node, snapshot), None)
+        # before the in transit count drops, so the snapshot is kept for the next hop
+        self._forward_snapshot(ffs, node, snapshot)
+        if (
+            self.is_ffs_preseeding(ffs)
+            and node == self.model[ffs]["_preseeding"]["target"]
+            and snapshot == self.model[ffs]["_preseeding"].get("snapshot", None)
+        ):
+            self._preseed_round_done(ffs, msg)
         self.model[ffs]["_snapshots_in_transit"][snapshot] -= 1
         if self.model[ffs]["_snapshots_in_transit"][snapshot] == 0:
             del self.model[ffs]["_snapshots_in_transit"][snapshot]
@@ -1749,24 +2845,28 @@ class Engine:
         os = self.count_outgoing_snapshots() - 1
         self.config.inform(
             "Send of %s@%s from %s to %s done, outstanding snapshot transfers: %i"
-            % (ffs, snapshot, main, node, os)
+            % (ffs, snapshot, sender, node, os)
         )
         self.logger.info(
-            "Send of %s@%s from %s to %s done, is_moving=%s, _moving=%s, _move_snapshot=%s"
+            "Send of %s@%s from %s to %s done (%s bytes, %s files), is_moving=%s, _moving=%s, _move_snapshot=%s"
             % (
                 ffs,
                 snapshot,
-                main,
+                sender,
                 node,
+                msg.get("bytes_transferred", "?"),
+                msg.get("files_transferred", "?"),
                 self.is_ffs_moving(ffs),
                 self.model[ffs].get("_moving", None),
                 self.model[ffs].get("_move_snapshot", None),
             )
         )
+        self._advance_node_jobs()
         if (
             self.is_ffs_moving(ffs)
             and node == self.model[ffs]["_moving"]
-            and msg["snapshot"] == self.model[ffs]["_move_snapshot"]
+            # pre-seeding may have entered step 1 right before this line
+            and msg["snapshot"] == self.model[ffs].get("_move_snapshot", None)
         ):
             self.config.inform(("Move step 3 done: %s" % ffs))
             self.send(
@@ -1779,9 +2879,60 @@ class Engine:
             )
         else:
             if not self.is_ffs_moving(ffs):
-                self._prune_snapshots_for_ffs(ffs, main)
+                self._prune_snapshots_for_ffs(ffs, sender)
                 self._prune_snapshots_for_ffs(ffs, node)
 
+    def node_send_snapshot_failed(self, msg):
+        """Some work units of an rsync failed (the rest made it and is
+        recorded on the sender). Resend, which only re-runs the failed units,
+        up to config.get_send_snapshot_retry_limit() times, then fault."""
+        sender = msg["from"]
+        if "ffs" not in msg:
+            self.fault("missing ffs parameter", msg, CodingError)
+        ffs = msg["ffs"]
+        if ffs not in self.model:
+            self.fault(
+                "send_snapshot_failed from ffs not in model.", msg, InconsistencyError
+            )
+        if "snapshot" not in msg:
+            self.fault("No snapshot in msg", msg, CodingError)
+        node = msg["target_node"]
+        snapshot = msg["snapshot"]
+        self.model[ffs]["_snapshots_in_transit"][snapshot] -= 1
+        if self.model[ffs]["_snapshots_in_transit"][snapshot] <= 0:
+            del self.model[ffs]["_snapshots_in_transit"][snapshot]
+        key = (ffs, node, snapshot)
+        self.send_snapshot_failures[key] += 1
+        failures = self.send_snapshot_failures[key]
+        description = (
+            "Send of %s@%s from %s to %s failed on %i of %i units (attempt %i)"
+            % (
+                ffs,
+                snapshot,
+                sender,
+                node,
+                len(msg.get("failed_units", [])),
+                msg.get("units", 0),
+                failures,
+            )
+        )
+        self.logger.error(
+            "%s, failure counts: %s" % (description, msg.get("failure_counts", {}))
+        )
+        if failures > self.config.get_send_snapshot_retry_limit():
+            del self.send_snapshot_failures[key]
+            self.fault("%s - giving up" % description, msg)
+        if (
+            node not in self.model[ffs]
+            or sender not in self.model[ffs]
+            or snapshot not in self.model[ffs][sender].get("snapshots", [])
+        ):
+            # target removed / snapshot gone in the mean time - nothing to retry
+            del self.send_snapshot_failures[key]
+            return
+        self.config.inform("%s, retrying" % description)
+        self._send_snapshot(sender, node, ffs, snapshot, retry=failures)
+
     def node_remove_done(self, msg):
         node = msg["from"]
         if "ffs" not in msg:
@@ -1814,6 +2965,10 @@ class Engine:
             )
 
     def node_remove_snapshot_done(self, msg):
+        self._forget_removed_snapshot(msg)
+        self._deletion_returned(msg["from"], msg["ffs"], [msg["snapshot"]], 1)
+
+    def _forget_removed_snapshot(self, msg):
         node = msg["from"]
         if "ffs" not in msg:
             self.fault("missing ffs parameter", msg, CodingError)
@@ -1826,8 +2981,50 @@ class Engine:
         # database.
         if msg["snapshot"] in self.model[ffs][node]["snapshots"]:
             self.model[ffs][node]["snapshots"].remove(msg["snapshot"])
+        self.model[ffs][node].get("snapshot_sizes", {}).pop(msg["snapshot"], None)
+        self.model[ffs][node].get("snapshot_guids", {}).pop(msg["snapshot"], None)
+        self.arrival_times.pop((ffs, node, msg["snapshot"]), None)
+        if not any(
+            msg["snapshot"] in self.model[ffs][x].get("snapshots", [])
+            for x in self.model[ffs]
+            if not x.startswith("_")
+        ):
+            self.capture_times.pop((ffs, msg["snapshot"]), None)
+
+    def node_remove_snapshots_done(self, msg):
+        for snapshot in msg["removed"]:
+            self._forget_removed_snapshot(
+                {"from": msg["from"], "ffs": msg["ffs"], "snapshot": snapshot}
+            )
+        self._deletion_returned(
+            msg["from"], msg["ffs"], msg["removed"], len(msg["removed"])
+        )
+
+    def node_remove_snapshots_failed(self, msg):
+        for snapshot in msg["removed"]:
+            self._forget_removed_snapshot(
+                {"from": msg["from"], "ffs": msg["ffs"], "snapshot": snapshot}
+            )
+        self._report_failed_removal(
+            {
+                "from": msg["from"],
+                "ffs": msg["ffs"],
+                "snapshot": ",".join(msg["failed"]),
+                "error_msg": msg["error_msg"],
+            }
+        )
+        self._deletion_returned(
+            msg["from"],
+            msg["ffs"],
+            msg["removed"] + msg["failed"],
+            len(msg["removed"]),
+        )
 
     def node_remove_snapshot_failed(self, msg):
+        self._report_failed_removal(msg)
+        self._deletion_returned(msg["from"], msg["ffs"], [msg["snapshot"]], 0)
+
+    def _report_failed_removal(self, msg):
         self.config.inform(
             "Non-fatal: Removal of snapshot %s@%s on %s failed with message: %s"
             % (msg["ffs"], msg["snapshot"], msg["from"], msg["error_msg"])
@@ -1853,7 +3050,158 @@ class Engine:
             if status["DEGRADED"] or status["UNAVAIL"]:
                 self.error_callback("Zpool status: %s - %s" % (node, status))
         self.zpool_stati[node] = status
-        self.zpool_disks[node] = msg["disks"]
+        self.zpool_disks[node] = msg.get("disks", {})
+        if msg.get("pools"):
+            if node not in self.pool_stats:
+                self.pool_stats[node] = collections.deque(
+                    maxlen=self.pool_stats_history
+                )
+            self.pool_stats[node].append((time.time(), msg["pools"]))
+            self._check_pressure(node)
+        self._update_scrub_state(node, msg["status"])
+        self._schedule_scrubs()
+
+    def node_zpool_scrub_started(self, msg):
+        if msg["from"] in self.scrubs:
+            self.scrubs[msg["from"]]["started"] = True
+
+    def _parse_scrub_status(self, status, pool):
+        """(scan in progress?, time the last scrub finished or None)
+        from the zpool status output of pool"""
+        in_progress = False
+        finished = None
+        current_pool = None
+        for line in status.split("\n"):
+            line = line.strip()
+            if line.startswith("pool:"):
+                current_pool = line[len("pool:") :].strip()
+            elif current_pool == pool and line.startswith("scan:"):
+                # resilvers hit the disks just as hard,
+                # a paused scrub is resumed from where it stopped
+                in_progress = "in progress" in line or "scrub paused" in line
+                m = re.match(r"scan: scrub (repaired|canceled).* on (.+)$", line)
+                if m:
+                    try:
+                        finished = time.mktime(
+                            time.strptime(m.groups()[1].strip(), "%a %b %d %H:%M:%S %Y")
+                        )
+                    except ValueError:
+                        pass
+        return in_progress, finished
+
+    def _update_scrub_state(self, node, status):
+        in_progress, finished = self._parse_scrub_status(
+            status, self._storage_pool(node)
+        )
+        if finished is not None:
+            self.last_scrubs[node] = max(finished, self.last_scrubs.get(node, 0))
+        if in_progress:
+            if node not in self.scrubs:  # started by the host
+                self.scrubs[node] = {
+                    "since": time.time(),
+                    "requested": False,
+                    "started": True,
+                }
+            self.scrubs[node]["started"] = True
+        elif node in self.scrubs and self.scrubs[node]["started"]:
+            del self.scrubs[node]
+            self.last_scrubs[node] = max(time.time(), self.last_scrubs.get(node, 0))
+        elif (
+            node in self.scrubs
+            and self.config.get_zpool_frequency_check()
+            and self.scrubs[node]["since"]
+            + self.scrub_start_reports * self.config.get_zpool_frequency_check()
+            < time.time()
+        ):
+            self.config.inform("Requested scrub on %s never started" % node)
+            del self.scrubs[node]
+
+    def _scrub_shared_fraction(self, node_a, node_b):
+        """fraction of the smaller node's ffs that are also on the other node"""
+        ffs_a = set([ffs for ffs in self.model if node_a in self.model[ffs]])
+        ffs_b = set([ffs for ffs in self.model if node_b in self.model[ffs]])
+        if not ffs_a or not ffs_b:
+            return 0
+        return len(ffs_a & ffs_b) / float(min(len(ffs_a), len(ffs_b)))
+
+    def _schedule_scrubs(self):
+        """Scrub the nodes that are due (longest unscrubbed first),
+        at most get_concurrent_scrub_limit at once (counting scrubs
+        the hosts started themselves), never two nodes sharing more than
+        get_scrub_max_shared_fraction of their ffs.
+        Scrubbing nodes get fewer rsync slots, see get_node_rsync_cap"""
+        interval = self.config.get_scrub_interval()
+        if not interval:
+            return
+        now = time.time()
+        limit = self.config.get_concurrent_scrub_limit()
+        max_shared = self.config.get_scrub_max_shared_fraction()
+        due = [
+            node
+            for node in self.zpool_stati
+            if node not in self.scrubs
+            and not self.is_readonly_node(node)
+            and self.last_scrubs.get(node, 0) + interval < now
+        ]
+        due.sort(key=lambda node: (self.last_scrubs.get(node, 0), node))
+        for node in due:
+            if len(self.scrubs) >= limit:
+                break
+            if any(
+                self._scrub_shared_fraction(node, other) > max_shared
+                for other in self.scrubs
+            ):
+                continue
+            self.scrubs[node] = {"since": now, "requested": True, "started": False}
+            self.send(node, {"msg": "zpool_scrub"})
+
+    def get_node_rsync_cap(self, node):
+        """Upper bound on the send_snapshots from/into node - None = no cap.
+        Scrubbing and saturated (see node_load) nodes get fewer"""
+        caps = []
+        if node in self.scrubs:
+            caps.append(self.config.get_scrub_rsync_limit())
+        load = self.node_loads.get(node)
+        if (
+            load is not None
+            and load["saturated"]
+            and load["time"] > time.time() - self.load_stale_after
+        ):
+            caps.append(self.config.get_saturated_rsync_limit())
+        if caps:
+            return min(caps)
+        return None
+
+    def do_load_check(self):
+        for node in self.node_config:
+            if not any(
+                msg["msg"] == "load" for msg in self.sender.get_messages_for_node(node)
+            ):
+                self.send(node, {"msg": "load"})
+
+    def node_load(self, msg):
+        # don't start checking before the newest code is downstream
+        if self.deployment_count < len(self.node_config):
+            return
+        node = msg["from"]
+        load = {"loadavg": msg["loadavg"], "cpus": msg["cpus"], "pool": msg["pool"]}
+        load["saturated"] = self.config.is_node_saturated(node, load)
+        load["time"] = time.time()
+        old = self.node_loads.get(node)
+        if old is not None and old["saturated"] != load["saturated"]:
+            self.logger.info(
+                "Node %s %s saturated: %s",
+                node,
+                "is" if load["saturated"] else "no longer",
+                load,
+            )
+        self.node_loads[node] = load
+
+    def client_service_node_load(self):
+        return self.node_loads
+
+    def client_service_scrub_status(self):
+        return {"scrubbing": self.scrubs, "last_scrub": self.last_scrubs}
 
     def do_zpool_status_check(self):
         do_not_send_to = set()
@@ -1942,6 +3290,12 @@ class Engine:
                                 # try to retrigger the snapshot every minute
                                 self.model[ffs]["_last_auto_snapshot_time"] = now
                                 self.do_capture(ffs, False, "auto", if_changed=True)
+            self._advance_node_jobs()
+            # deletion windows might have opened, rate limits recovered
+            for node in self.deletion_que:
+                self._send_deletions(node)
+            # transfer windows might have opened
+            self.sender.send_if_possible()
             return True
         return False
 
@@ -1992,6 +3346,11 @@ class Engine:
             )
         self.model[rename_target][node] = self.model[ffs][node]
         del self.model[ffs][node]
+        que = self.deletion_que.get(node)
+        if que:
+            self.deletion_que[node] = collections.deque(
+                (rename_target if x[0] == ffs else x[0],) + x[1:] for x in que
+            )
         if "_main" in self.model[ffs] and node == self.model[ffs]["_main"]:
             del self.model[ffs]["_main"]
             self.model[rename_target]["_main"] = node
@@ -5,6 +5,21 @@ import re
 import subprocess
 import time
 import hashlib
+import sys
+import tempfile
+import threading
+
+
+# how to call zfs for the zfs send/receive transport.
+# Overwritten in tests to use a fake zfs executable.
+zfs_cmd = ["sudo", "zfs"]
+
+
+# terminated by ssh.py when the connection goes away
+child_processes = []
+# robust_parallel_rsync's record of finished work units, per resumable transfer
+resume_state_dir = "/home/ffs/.ffs_resume"
+resume_max_age = 2 * 24 * 3600  # seconds, older partial transfers are discarded
 
 
 def check_call(cmd):
@@ -143,6 +158,62 @@ def list_snapshots():
         .split("\n")
     ]
 
+
+def list_snapshots_with_sizes():
+    """[(name, used, written, guid)], oldest first - sizes in bytes"""
+    result = []
+    for line in (
+        zfs_output(
+            [
+                "sudo",
+                "zfs",
+                "list",
+                "-t",
+                "snapshot",
+                "-H",
+                "-p",
+                "-s",
+                "creation",
+                "-o",
+                "name,used,written,guid",
+            ]
+        )
+        .strip()
+        .split("\n")
+    ):
+        if not line:
+            continue
+        name, used, written, guid = line.split("\t")
+        result.append((name, _parse_size(used), _parse_size(written), guid))
+    return result
+
+
+def _parse_size(value):
+    try:
+        return int(value)
+    except ValueError:  # '-'
+        return 0
+
+
+def get_snapshot_sizes(combined):
+    """{'used': bytes, 'written': bytes, 'guid': str} of one snapshot"""
+    result = {}
+    for line in (
+        zfs_output(
+            ["sudo", "zfs", "get", "-H", "-p", "-o", "property,value"]
+            + ["used,written,guid", combined]
+        )
+        .strip()
+        .split("\n")
+    ):
+        prop, value = line.split("\t")
+        if prop == "guid":  # identifies the zfs snapshot, not just its name
+            result[prop] = value
+        else:
+            result[prop] = _parse_size(value)
+    return result
+
+
 def list_snapshots_for_ffs_unordered(zfs):
     # nice idea, but does not guarantee order
     return os.listdir("/" + zfs + "/.zfs/snapshot")
@@ -176,15 +247,25 @@ def msg_list_ffs(msg):
     ffs_prefix = find_ffs_prefix(msg)
     ffs_list = list_ffs(msg["storage_prefix"])
     ffs_info = {
-        x[len(ffs_prefix) :]: {"snapshots": [], "properties": _get_zfs_properties(x)}
+        x[len(ffs_prefix) :]: {
+            "snapshots": [],
+            "properties": _get_zfs_properties(x),
+            "snapshot_sizes": {},
+            "snapshot_guids": {},
+        }
         for x in ffs_list
     }
-    snapshots = list_snapshots()
-    for x in snapshots:
+    snapshots = list_snapshots_with_sizes()
+    for x, used, written, guid in snapshots:
         if x.startswith(ffs_prefix) and not x.startswith(ffs_prefix + "."):
             ffs_name = x[len(ffs_prefix) : x.find("@")]
             snapshot_name = x[x.find("@") + 1 :]
             ffs_info[ffs_name]["snapshots"].append(snapshot_name)
+            ffs_info[ffs_name]["snapshot_sizes"][snapshot_name] = {
+                "used": used,
+                "written": written,
+            }
+            ffs_info[ffs_name]["snapshot_guids"][snapshot_name] = guid
     result["ffs"] = ffs_info
     return result
 
@@ -301,7 +382,9 @@ def msg_capture(msg):
         msg_chown_and_chmod(msg)  # fields do match
 
     check_call(["sudo", "zfs", "snapshot", combined])
-    return {"msg": "capture_done", "ffs": ffs, "snapshot": snapshot_name}
+    res = {"msg": "capture_done", "ffs": ffs, "snapshot": snapshot_name}
+    res.update(get_snapshot_sizes(combined))
+    return res
 
 
 def msg_capture_if_changed(msg):
@@ -341,14 +424,16 @@ def msg_capture_if_changed(msg):
             changed = True
     else:
         changed = True  # no snapshot - changed
-    if changed:
-        check_call(["sudo", "zfs", "snapshot", combined])
-    return {
+    res = {
         "msg": msg["msg"] + "_done",
         "ffs": ffs,
         "snapshot": snapshot_name,
         "changed": changed,
     }
+    if changed:
+        check_call(["sudo", "zfs", "snapshot", combined])
+        res.update(get_snapshot_sizes(combined))
+    return res
 
 
 def msg_remove(msg):
@@ -385,6 +470,7 @@ def msg_remove_snapshot(msg):
     combined = "%s@%s" % (full_ffs_path, snapshot_name)
     if combined not in list_snapshots():
         raise ValueError("invalid snapshot %s" % (combined,))
+    destroy_resume_clones(msg["storage_prefix"], full_ffs_path, [snapshot_name])
     try:
         check_call(["sudo", "zfs", "destroy", combined])
     except subprocess.CalledProcessError as e:
@@ -404,13 +490,130 @@ def msg_remove_snapshot(msg):
     }
 
 
+def msg_remove_snapshots(msg):
+    """Destroy several snapshots of one ffs in a single zfs call"""
+    ffs = msg["ffs"]
+    full_ffs_path = find_ffs_prefix(msg) + ffs
+    if full_ffs_path not in list_ffs(msg["storage_prefix"], False, True):
+        raise ValueError("invalid ffs")
+    existing = get_snapshots(ffs, msg["storage_prefix"])
+    # already gone is as good as removed
+    to_remove = [x for x in msg["snapshots"] if x in existing]
+    if to_remove:
+        destroy_resume_clones(msg["storage_prefix"], full_ffs_path, to_remove)
+        combined = "%s@%s" % (full_ffs_path, ",".join(to_remove))
+        try:
+            check_call(["sudo", "zfs", "destroy", combined])
+        except subprocess.CalledProcessError as e:
+            remaining = get_snapshots(ffs, msg["storage_prefix"])
+            return {
+                "msg": "remove_snapshots_failed",
+                "ffs": ffs,
+                "removed": [x for x in msg["snapshots"] if x not in remaining],
+                "failed": [x for x in to_remove if x in remaining],
+                "error_msg": str(e.output),
+            }
+    return {
+        "msg": "remove_snapshots_done",
+        "ffs": ffs,
+        "removed": msg["snapshots"],
+        "snapshots": get_snapshots(ffs, msg["storage_prefix"]),
+    }
+
+
+def zpool_capacity_info():
+    """pool -> {size, alloc, free (bytes), fragmentation, capacity (percent)}"""
+    raw = check_output(
+        ["sudo", "zpool", "list", "-H", "-p", "-o", "name,size,alloc,free,frag,cap"]
+    ).decode("utf-8")
+    output = {}
+    for line in raw.strip().split("\n"):
+        if not line:
+            continue
+        name, size, alloc, free, frag, cap = line.split("\t")
+        output[name] = {
+            "size": _parse_size(size),
+            "alloc": _parse_size(alloc),
+            "free": _parse_size(free),
+            "fragmentation": _parse_size(frag.rstrip("%")),
+            "capacity": _parse_size(cap.rstrip("%")),
+        }
+    return output
+
+
+def zpool_iostat_info(interval=1, latency=False):
+    """pool -> {read_ops, write_ops, read_bytes, write_bytes} per second,
+    sampled over interval seconds (not the averages since boot).
+    With latency, also the average time I/O waited on the disks
+    (read_wait_ns, write_wait_ns)"""
+    cmd = ["sudo", "zpool", "iostat", "-H", "-p", "-y"]
+    if latency:
+        cmd.append("-l")
+    raw = check_output(cmd + [str(interval), "1"]).decode("utf-8")
+    output = {}
+    for line in raw.strip().split("\n"):
+        parts = line.split("\t")
+        if latency:
+            # total_wait r/w, disk_wait r/w, then queue waits
+            if len(parts) < 11:
+                continue
+        elif len(parts) != 7:
+            continue
+        name, _alloc, _free, rops, wops, rbw, wbw = parts[:7]
+        output[name] = {
+            "read_ops": _parse_size(rops),
+            "write_ops": _parse_size(wops),
+            "read_bytes": _parse_size(rbw),
+            "write_bytes": _parse_size(wbw),
+        }
+        if latency:
+            output[name]["read_wait_ns"] = _parse_size(parts[9])
+            output[name]["write_wait_ns"] = _parse_size(parts[10])
+    return output
+
+
 def msg_zpool_status(msg):
     status = check_output(["sudo", "zpool", "status"]).decode("utf-8")
     try:
         disks = zpool_disk_info()
     except subprocess.CalledProcessError:
         disks = {'failed_to_retrieve_disk_list_check_sudoers': 0}
-    return {"msg": "zpool_status", "status": status, 'disks': disks}
+    try:
+        pools = zpool_capacity_info()
+        for name, io in zpool_iostat_info().items():
+            if name in pools:
+                pools[name].update(io)
+    except subprocess.CalledProcessError:
+        pools = {}
+    return {"msg": "zpool_status", "status": status, 'disks': disks, "pools": pools}
+
+
+def msg_load(msg):
+    """A short iostat sample of the pool holding the storage_prefix
+    and the load average - cheap enough to poll every minute"""
+    pool = msg["storage_prefix"].strip("/").split("/")[0]
+    try:
+        pools = zpool_iostat_info(latency=True)
+    except subprocess.CalledProcessError:  # zfs without iostat -l
+        pools = zpool_iostat_info()
+    return {
+        "msg": "load",
+        "loadavg": list(os.getloadavg()),
+        "cpus": os.cpu_count(),
+        "pool": pools.get(pool, {}),
+    }
+
+
+def msg_zpool_scrub(msg):
+    """Start a scrub of the pool holding the storage_prefix.
+    A scrub that is already running is as good as started."""
+    pool = msg["storage_prefix"].strip("/").split("/")[0]
+    try:
+        zfs_output(["sudo", "zpool", "scrub", pool])
+    except subprocess.CalledProcessError as e:
+        if b"currently scrubbing" not in e.output:
+            raise
+    return {"msg": "zpool_scrub_started", "pool": pool}
 
 
 def list_all_users():
@@ -469,21 +672,254 @@ def check_call_and_ignore_read_only_fs(cmd, *args, **kwargs):
 
 
 def clean_up_clones(storage_prefix):
+    """Remove left over send_snapshot clones.
+
+    Clones of resumable transfers (resume_*) are kept
+    unless they're older than resume_max_age.
+    """
     clone_dir = get_clone_dir(storage_prefix)
     try:
-        for fn in os.listdir("/" + clone_dir):
-            cmd = [
-                "sudo",
-                "zfs",
-                "destroy",
-                clone_dir + "/" + fn,
-                "-r",
-            ]  # don't care if some auuto snapshot tried to snapshot these clones...
-            p = subprocess.Popen(cmd).communicate()
+        lines = zfs_output(
+            ["sudo", "zfs", "list", "-H", "-p", "-o", "name,creation", "-d", "1"]
+            + [clone_dir]
+        )
+    except subprocess.CalledProcessError:
+        lines = ""
+    kept = set()
+    for line in lines.strip().split("\n"):
+        if not line.startswith(clone_dir + "/"):
+            continue
+        name, creation = line.split("\t")
+        fn = name[len(clone_dir) + 1 :]
+        if fn.startswith("resume_") and time.time() - int(creation) < resume_max_age:
+            kept.add(fn)
+            continue
+        cmd = [
+            "sudo",
+            "zfs",
+            "destroy",
+            clone_dir + "/" + fn,
+            "-r",
+        ]  # don't care if some auuto snapshot tried to snapshot these clones...
+        p = subprocess.Popen(cmd).communicate()
+    try:
+        for fn in os.listdir(resume_state_dir):
+            state_file = os.path.join(resume_state_dir, fn)
+            if fn[: -len(".units")] not in kept and (
+                time.time() - os.path.getmtime(state_file) > resume_max_age
+            ):
+                os.unlink(state_file)
     except OSError:
         pass
 
 
+def destroy_resume_clones(storage_prefix, full_ffs_path, snapshots):
+    """Destroy the resume clones (and unit states) of these snapshots.
+
+    A transfer of a snapshot that is being removed has been abandoned
+    (retry limit, target removed, a newer snapshot sent instead...) -
+    and its clone would pin the snapshot ('dependent clones')
+    """
+    clone_dir = get_clone_dir(storage_prefix)
+    try:
+        lines = zfs_output(
+            ["sudo", "zfs", "list", "-H", "-o", "name,origin", "-d", "1", clone_dir]
+        )
+    except subprocess.CalledProcessError:  # no clone dir
+        return
+    origins = set(["%s@%s" % (full_ffs_path, x) for x in snapshots])
+    for line in lines.strip().split("\n"):
+        if not line.startswith(clone_dir + "/"):
+            continue
+        name, origin = line.split("\t")
+        fn = name[len(clone_dir) + 1 :]
+        if fn.startswith("resume_") and origin in origins:
+            subprocess.Popen(
+                ["sudo", "zfs", "destroy", name, "-r"], stderr=subprocess.PIPE
+            ).communicate()
+            try:
+                os.unlink(os.path.join(resume_state_dir, fn + ".units"))
+            except OSError:
+                pass
+
+
+def prepare_clone(full_ffs_path, snapshot, clone):
+    """zfs clone snapshot - or reuse the clone an interrupted transfer left behind"""
+    for dummy_tries in range(2):
+        p = subprocess.Popen(
+            ["sudo", "zfs", "clone", full_ffs_path + "@" + snapshot, clone],
+            stderr=subprocess.PIPE,
+        )
+        stdout, stderr = p.communicate()
+        if p.returncode == 0:
+            return
+        if b"dataset already exists" in stderr:
+            origin = zfs_output(
+                ["sudo", "zfs", "get", "-H", "-o", "value", "origin", clone]
+            ).strip()
+            if origin == full_ffs_path + "@" + snapshot:
+                return
+            subprocess.Popen(["sudo", "zfs", "destroy", clone, "-r"]).communicate()
+        elif b"dataset does not exist" in stderr:
+            raise ValueError("invalid snapshot")
+        else:
+            raise ValueError("Could not clone. Error:%s" % stderr)
+    raise ValueError("Could not clone. Error:%s" % stderr)
+
+
+def throttled_copy(source, target, kib_per_second, block_size=64 * 1024):
+    """Copy source to target (file objects) at no more than kib_per_second"""
+    start = time.time()
+    copied = 0
+    try:
+        while True:
+            block = source.read(block_size)
+            if not block:
+                break
+            target.write(block)
+            copied += len(block)
+            ahead = copied / (kib_per_second * 1024.0) - (time.time() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+    except BrokenPipeError:  # receiver died - it's return code will tell
+        pass
+    finally:
+        try:
+            target.close()
+        except BrokenPipeError:
+            pass
+
+
+def _read_and_close(temp_file):
+    temp_file.seek(0)
+    res = temp_file.read()
+    temp_file.close()
+    return res
+
+
+def send_snapshot_via_zfs(full_ffs_path, base, snapshot, receive_cmd, bwlimit=None):
+    """zfs send -i base snapshot | receive_cmd.
+
+    base=None sends the full snapshot (into an empty target).
+    bwlimit (KiB/s) throttles the stream.
+    Returns None on success, an error description otherwise.
+    A failed zfs receive leaves the target untouched,
+    so the caller can fall back to rsync.
+    """
+    # files, not pipes - nobody reads them until the stream is done,
+    # a full pipe would stall it
+    send_stderr = tempfile.TemporaryFile()
+    receive_output = tempfile.TemporaryFile()
+    receive_stderr = tempfile.TemporaryFile()
+    if base is None:
+        send_args = ["send"]
+    else:
+        send_args = ["send", "-i", "%s@%s" % (full_ffs_path, base)]
+    send = subprocess.Popen(
+        zfs_cmd + send_args + ["%s@%s" % (full_ffs_path, snapshot)],
+        stdout=subprocess.PIPE,
+        stderr=send_stderr,
+    )
+    if bwlimit:
+        receive = subprocess.Popen(
+            receive_cmd,
+            stdin=subprocess.PIPE,
+            stdout=receive_output,
+            stderr=receive_stderr,
+        )
+        throttled_copy(send.stdout, receive.stdin, bwlimit)
+    else:
+        receive = subprocess.Popen(
+            receive_cmd, stdin=send.stdout, stdout=receive_output, stderr=receive_stderr
+        )
+    send.stdout.close()  # so send get's a SIGPIPE if receive exits
+    receive.wait()
+    send.wait()
+    send_stderr, receive_stdout, receive_stderr = [
+        _read_and_close(f) for f in (send_stderr, receive_output, receive_stderr)
+    ]
+    if send.returncode != 0 or receive.returncode != 0:
+        return (
+            "zfs send rc=%s stderr:\n%s\nzfs receive rc=%s stdout:\n%s\nstderr:\n%s"
+            % (
+                send.returncode,
+                send_stderr,
+                receive.returncode,
+                receive_stdout,
+                receive_stderr,
+            )
+        )
+    return None
+
+
+def ask_target(cmd, msg, expected_reply):
+    """Send one message to the receiving node (via ssh cmd).
+
+    Returns (reply, None) if it answered with expected_reply,
+    (None, error dict) otherwise.
+    """
+    p = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE
+    )
+    stdout, stderr = p.communicate(json.dumps(msg).encode("utf-8"))
+    content = "stdout:\n%s\n\nstderr:\n%s" % (stdout, stderr)
+    if p.returncode != 0:
+        return None, {"error": msg["msg"], "content": content}
+    try:
+        r = json.loads(stdout.decode("utf-8"))
+    except ValueError:
+        return None, {"error": msg["msg"] + "_no_json", "content": content}
+    if not isinstance(r, dict) or r.get("msg") != expected_reply:
+        return None, {"error": msg["msg"] + "_no_json", "content": content}
+    return r, None
+
+
+def run_robust_parallel_rsync(rsync_cmd):
+    """Run robust_parallel_rsync, passing its progress lines
+    on to our stderr right away - which ends up at the central
+    while we're still running. Returns returncode, stdout, stderr"""
+    p = subprocess.Popen(
+        ["python3", "/home/ffs/robust_parallel_rsync.py"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        stdin=subprocess.PIPE,
+    )
+    child_processes.append(p)
+    stderr = []
+
+    def forward_progress():
+        for line in p.stderr:
+            if line.startswith(b"FFS_PROGRESS "):
+                sys.stderr.write(line.decode("utf-8", errors="replace"))
+                sys.stderr.flush()
+            else:
+                stderr.append(line)
+
+    t = threading.Thread(target=forward_progress)
+    t.daemon = True
+    t.start()
+    p.stdin.write(json.dumps(rsync_cmd).encode("utf-8"))
+    p.stdin.close()
+    stdout = p.stdout.read()
+    p.wait()
+    t.join()
+    child_processes.remove(p)
+    return p.returncode, stdout, b"".join(stderr)
+
+
+def parse_rsync_summary(stdout):
+    """robust_parallel_rsync's last stdout line is a json summary
+    of the work units. None if it died before writing it"""
+    lines = stdout.decode("utf-8", errors="replace").strip().split("\n")
+    try:
+        summary = json.loads(lines[-1])
+    except ValueError:
+        return None
+    if not isinstance(summary, dict) or "failed_units" not in summary:
+        return None
+    return summary
+
+
 def msg_send_snapshot(msg):
     ffs_from = msg["ffs"]
     full_ffs_path = find_ffs_prefix(msg) + ffs_from
@@ -505,12 +941,39 @@ def msg_send_snapshot(msg):
         if "/" in x:
             raise ValueError("excluded_subdirs can only exclude *direct* subdirs")
     snapshot = msg["snapshot"]
+    zfs_send_error = None
+    if msg.get("transport", "rsync") == "zfs_send":
+        base = msg.get("incremental_base", None)  # None: full stream
+        if (base is not None and "@" in base) or "@" in snapshot:
+            raise ValueError("invalid snapshot name")
+        target_zfs = target_path[1:]
+        zfs_send_error = send_snapshot_via_zfs(
+            full_ffs_path,
+            base,
+            snapshot,
+            target_ssh_cmd
+            + ["%s@%s" % (target_user, target_host), "zfs_receive " + target_zfs],
+            msg.get("bwlimit", None),
+        )
+        if zfs_send_error is None:
+            return {
+                "msg": "send_snapshot_done",
+                "target_node": target_node,
+                "ffs": ffs_from,
+                "snapshot": snapshot,
+                "transport": "zfs_send",
+            }
+        # else: zfs refused the stream (e.g. a replica that was rsynced,
+        # not received) - fall back to rsync
     my_hash = hashlib.md5()
     my_hash.update(ffs_from.encode("utf-8"))
+    my_hash.update(snapshot.encode("utf-8"))
     my_hash.update(target_path.encode("utf-8"))
     my_hash.update(target_node.encode("utf-8"))
     my_hash = my_hash.hexdigest()
-    clone_name = "%f_%s" % (time.time(), my_hash)
+    # deterministic, so a retry of this transfer picks up where the last one stopped
+    clone_name = "resume_%s" % (my_hash,)
+    state_file = os.path.join(resume_state_dir, clone_name + ".units")
     clone_dir = get_clone_dir(msg["storage_prefix"])
     # step -1 - make sure we have an .ffs_sync_clones directory.
     subprocess.Popen(
@@ -526,59 +989,29 @@ def msg_send_snapshot(msg):
         source_path = "/" + full_ffs_path + "/.zfs/snapshot/" + snapshot
     else:
         source_path = "/" + clone_dir + "/" + clone_name
-        p = subprocess.Popen(
-            [
-                "sudo",
-                "zfs",
-                "clone",
-                full_ffs_path + "@" + snapshot,
-                clone_dir + "/" + clone_name,
-            ],
-            stderr=subprocess.PIPE,
-        )
-        stdout, stderr = p.communicate()
-        if p.returncode != 0:
-            if b"dataset does not exist" in stderr:
-                raise ValueError("invalid snapshot")
-            else:
-                raise ValueError("Could not clone. Error:%s" % stderr)
+        prepare_clone(full_ffs_path, snapshot, clone_dir + "/" + clone_name)
 
-    # step1 - set readonly=false on receiver
+    # step1 - set readonly=false on receiver (and mount)
     cmd = target_ssh_cmd + ["%s@%s" % (target_user, target_host), "-T"]
 
-    p = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE
-    )
-    #
-    stdout, stderr = p.communicate(
-        json.dumps(
-            {
-                "msg": "set_properties",
-                "ffs": target_ffs,
-                "properties": {"readonly": "off"},
-                "storage_prefix": target_storage_prefix,
-                "do_mount": True,
-            }
-        ).encode("utf-8")
+    reply, error = ask_target(
+        cmd,
+        {
+            "msg": "receive_begin",
+            "ffs": target_ffs,
+            "storage_prefix": target_storage_prefix,
+            "resume_key": clone_name,
+        },
+        "receive_begin_done",
     )
-    if p.returncode != 0:
-        return {
-            "error": "set_properties_read_only_off",
-            "content": "stdout:\n%s\n\nstderr:\n%s" % (stdout, stderr),
-        }
-    try:
-        r = json.loads(stdout.decode("utf-8"))
-        if not "msg" in r or r["msg"] != "set_properties_done":
-            return {
-                "error": "set_properties_read_only_off_no_json",
-                "content": "stdout:\n%s\n\nstderr:\n%s" % (stdout, stderr),
-            }
-
-    except ValueError:
-        return {
-            "error": "set_properties_read_only_off_no_json",
-            "content": "stdout:\n%s\n\nstderr:\n%s" % (stdout, stderr),
-        }
+    if error:
+        return error
+    if not reply.get("resumable", False):
+        # something else was received in between - start from scratch
+        try:
+            os.unlink(state_file)
+        except OSError:
+            pass
 
     # step2: rsync
     rsync_cmd = {
@@ -589,59 +1022,50 @@ def msg_send_snapshot(msg):
         "target_ssh_cmd": target_ssh_cmd,
         "cores": 4,  # limit to a 'sane' value - you will run into ssh-concurrent connection limits otherwise
         "excluded_subdirs": excluded_subdirs,
+        "resume_state": state_file,
     }
-    p = subprocess.Popen(
-        ["python3", "/home/ffs/robust_parallel_rsync.py"],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        stdin=subprocess.PIPE,
-    )
-    rsync_stdout, rsync_stderr = p.communicate(json.dumps(rsync_cmd).encode("utf-8"))
-    rc = p.returncode
+    if "bwlimit" in msg:
+        # the central's budget for this transfer (KiB/s) - shared by its
+        # parallel rsyncs. The tar seed and chunk streams are not throttled,
+        # so leave everything to rsync
+        rsync_cmd["bwlimit"] = str(max(1, int(msg["bwlimit"]) // rsync_cmd["cores"]))
+        rsync_cmd["large_file_threshold"] = None
+    elif msg.get("seed", False):  # first transfer to this target
+        rsync_cmd["seed"] = True
+    if not os.path.exists(resume_state_dir):
+        os.makedirs(resume_state_dir)
+    rc, rsync_stdout, rsync_stderr = run_robust_parallel_rsync(rsync_cmd)
+    summary = parse_rsync_summary(rsync_stdout)
     if rc != 0:
+        content = "stdout:\n%s\n\nstderr:\n%s" % (rsync_stdout, rsync_stderr)
+        if summary is None or not summary["failed_units"]:
+            return {"error": "rsync_failure", "content": content}
+        # only some units failed - the finished ones are recorded in
+        # state_file, so the engine may retry and only re-run the failed ones
         return {
-            "error": "rsync_failure",
-            "content": "stdout:\n%s\n\nstderr:\n%s" % (rsync_stdout, rsync_stderr),
-        }
-    p = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE
-    )
-    # step4: restore readonly
-    stdout, stderr = p.communicate(
-        json.dumps(
-            {
-                "msg": "set_properties",
-                "ffs": target_ffs,
-                "properties": {"readonly": "on"},
-                "storage_prefix": target_storage_prefix,
-            }
-        ).encode("utf-8")
-    )
-    if p.returncode != 0:
-        return {
-            "error": "set_properties_read_only_on",
-            "content": "stdout:\n%s\n\nstderr:\n%s" % (stdout, stderr),
+            "msg": "send_snapshot_failed",
+            "target_node": target_node,
+            "ffs": ffs_from,
+            "snapshot": snapshot,
+            "units": summary["units"],
+            "failed_units": summary["failed_units"],
+            "blocked_units": summary["blocked_units"],
+            "failure_counts": summary["failure_counts"],
+            "content": content,
         }
-    # step5: make a snapshot on receiver
-    p = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE
+    # step4: restore readonly & make a snapshot on receiver
+    reply, error = ask_target(
+        cmd,
+        {
+            "msg": "receive_commit",
+            "ffs": target_ffs,
+            "snapshot": snapshot,
+            "storage_prefix": target_storage_prefix,
+        },
+        "receive_commit_done",
     )
-    #
-    stdout, stderr = p.communicate(
-        json.dumps(
-            {
-                "msg": "capture",
-                "ffs": target_ffs,
-                "snapshot": snapshot,
-                "storage_prefix": target_storage_prefix,
-            }
-        ).encode("utf-8")
-    )
-    if p.returncode != 0:
-        return {
-            "error": "snapshot_after_rsync",
-            "content": "stdout:\n%s\n\nstderr:\n%s" % (stdout, stderr),
-        }
+    if error:
+        return error
     # step 6: clean up *our* clone dir (close in time)
     if not msg.get(
         "source_is_readonly", False
@@ -652,6 +1076,10 @@ def msg_send_snapshot(msg):
         )
         stdout, stderr = p.communicate()
         # output of step6 is ignored
+    try:
+        os.unlink(state_file)
+    except OSError:
+        pass
     res = {
         "msg": "send_snapshot_done",
         "target_node": target_node,
@@ -662,9 +1090,81 @@ def msg_send_snapshot(msg):
         "source_is_readonly", False
     ):  # read from snapshot directly - for readonly pools
         res["clone_name"] = clone_name
+    if zfs_send_error is not None:
+        res["transport"] = "rsync"
+        res["zfs_send_error"] = zfs_send_error
+    if summary is not None:
+        res["bytes_transferred"] = summary.get("bytes", 0)
+        res["files_transferred"] = summary.get("files", 0)
     return res
 
 
+def _receiving_ffs(msg):
+    """full zfs name of a receive_begin/receive_commit target
+    - without listing every dataset on the node"""
+    ffs = msg["ffs"]
+    if not ffs or ffs.startswith(".") or "@" in ffs or "/." in ffs:
+        raise ValueError("invalid ffs")
+    return find_ffs_prefix(msg) + ffs
+
+
+def msg_receive_begin(msg):
+    """Prepare an ffs for an incoming rsync: readonly=off & mounted.
+
+    Same effect as set_properties(readonly=off, do_mount=True),
+    but only one zfs query.
+
+    With a resume_key, the ffs is tagged (ffs:receiving) with it, and
+    'resumable' tells whether the last transfer into this ffs that
+    did not commit was the same one - so its partial state may be reused.
+    """
+    full_ffs_path = _receiving_ffs(msg)
+    resume_key = msg.get("resume_key", "-")
+    if not re.match("^[A-Za-z0-9_-]+$", resume_key):
+        raise ValueError("invalid resume_key")
+    try:
+        lines = zfs_output(
+            [
+                "sudo",
+                "zfs",
+                "get",
+                "-H",
+                "-o",
+                "property,value",
+                "readonly,mounted,ffs:receiving",
+                full_ffs_path,
+            ]
+        )
+    except subprocess.CalledProcessError:
+        raise ValueError("invalid ffs")
+    props = dict(x.split("\t")[:2] for x in lines.strip().split("\n"))
+    resumable = resume_key != "-" and props.get("ffs:receiving") == resume_key
+    to_set = []
+    if props.get("readonly") != "off":
+        to_set.append("readonly=off")
+    if props.get("ffs:receiving", "-") != resume_key:
+        to_set.append("ffs:receiving=" + resume_key)
+    if to_set:
+        check_call(["sudo", "zfs", "set"] + to_set + [full_ffs_path])
+    if props.get("mounted") != "yes":
+        ensure_zfs_mounted(full_ffs_path)
+    return {"msg": "receive_begin_done", "ffs": msg["ffs"], "resumable": resumable}
+
+
+def msg_receive_commit(msg):
+    """Finish an incoming rsync: readonly=on & snapshot.
+
+    Same effect as set_properties(readonly=on) followed by capture.
+    """
+    full_ffs_path = _receiving_ffs(msg)
+    snapshot_name = msg["snapshot"]
+    if not snapshot_name or "@" in snapshot_name or "/" in snapshot_name:
+        raise ValueError("invalid snapshot name")
+    check_call(["sudo", "zfs", "set", "readonly=on", "ffs:receiving=-", full_ffs_path])
+    check_call(["sudo", "zfs", "snapshot", "%s@%s" % (full_ffs_path, snapshot_name)])
+    return {"msg": "receive_commit_done", "ffs": msg["ffs"], "snapshot": snapshot_name}
+
+
 def msg_deploy(msg):
     import base64
     import zipfile
@@ -730,20 +1230,199 @@ def iterate_parent_paths(path):
         yield "/".join(parts[:i])
 
 
+ffs_root_cache_filename = "/home/ffs/.ffs_root_cache.json"
+ffs_root_cache_ttl = 30  # seconds
+
+
+def list_ffs_roots():
+    """All datasets with a non-inherited ffs:root=on - in one zfs call"""
+    lines = zfs_output(
+        [
+            "sudo",
+            "zfs",
+            "get",
+            "-H",
+            "-t",
+            "filesystem,volume",
+            "-o",
+            "name,value,source",
+            "ffs:root",
+        ]
+    )
+    result = set()
+    for line in lines.strip().split("\n"):
+        parts = line.split("\t")
+        if (
+            len(parts) == 3
+            and parts[1] == "on"
+            and not parts[2].startswith("inherited")
+        ):
+            result.add(parts[0])
+    return result
+
+
+def _read_ffs_root_cache():
+    try:
+        with open(ffs_root_cache_filename) as op:
+            cache = json.load(op)
+        if time.time() - cache["time"] < ffs_root_cache_ttl:
+            return set(cache["roots"])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return set()
+
+
+def _write_ffs_root_cache(roots):
+    """Atomic, so parallel rprsync calls never see half a file"""
+    try:
+        fd, tmp = tempfile.mkstemp(
+            dir=os.path.dirname(ffs_root_cache_filename), prefix=".ffs_root_cache"
+        )
+        with os.fdopen(fd, "w") as op:
+            json.dump({"time": time.time(), "roots": sorted(roots)}, op)
+        os.rename(tmp, ffs_root_cache_filename)
+    except OSError:
+        pass
+
+
 def is_inside_ffs_root(path):
-    zfs = list_zfs()
+    """Is path (or one of its parents) a dataset with ffs:root=on?
+
+    Every parallel rprsync call asks this, so the roots are cached
+    across processes for ffs_root_cache_ttl seconds.
+    Only positive answers come from the cache - anything not
+    found in there is checked against zfs again.
+    """
     if not path.startswith("/"):
         return False
-    for pp in iterate_parent_paths(path):
-        if pp[1:] in zfs:
-            try:
-                if get_zfs_property(pp[1:], "ffs:root") == "on":
-                    return True
-                else:
-                    pass
-            except KeyError:
-                continue
-    return False
+    parents = [pp[1:] for pp in iterate_parent_paths(path)]
+    cached = _read_ffs_root_cache()
+    if any(pp in cached for pp in parents):
+        return True
+    roots = list_ffs_roots()
+    _write_ffs_root_cache(roots)
+    return any(pp in roots for pp in parents)
+
+
+def receive_tar(target_path, compressor, do_sudo):
+    """The receiving end of robust_parallel_rsync's seed_with_tar.
+
+    Extracts stdin into target_path, which must be empty.
+    """
+    decompressors = {"zstd": ["zstd", "-d", "-c"], "gzip": ["gzip", "-d", "-c"]}
+    if compressor not in decompressors:
+        raise ValueError("invalid compressor")
+    sudo = ["sudo"] if do_sudo else []
+    p = subprocess.Popen(
+        sudo + ["ls", "-A", target_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    stdout, stderr = p.communicate()
+    if p.returncode != 0:
+        raise ValueError("could not list target: %s" % stderr)
+    if stdout.strip():
+        raise ValueError("Target not empty, refusing to seed: '%s'" % target_path)
+    decompress = subprocess.Popen(decompressors[compressor], stdout=subprocess.PIPE)
+    tar = subprocess.Popen(
+        sudo + ["tar", "--extract", "--file=-", "--directory", target_path],
+        stdin=decompress.stdout,
+    )
+    decompress.stdout.close()
+    tar.communicate()
+    decompress.wait()
+    if decompress.returncode != 0 or tar.returncode != 0:
+        raise ValueError(
+            "untar failed: %s %s" % (decompress.returncode, tar.returncode)
+        )
+
+
+def receive_chunk(target_path, options, do_sudo):
+    """The receiving end of robust_parallel_rsync's large file chunks.
+
+    op=sums: print the sha256 of a byte range ('missing' if there's no such file)
+    op=write: write stdin to a byte range, print its sha256
+    op=finalize: set size, owner, rights and mtime
+    """
+    sudo = ["sudo"] if do_sudo else []
+    checks = {
+        "offset": "^[0-9]+$",
+        "length": "^[0-9]+$",
+        "size": "^[0-9]+$",
+        "mode": "^[0-7]{3,4}$",
+        "owner": r"^[A-Za-z0-9_.][A-Za-z0-9_.-]*:[A-Za-z0-9_.][A-Za-z0-9_.-]*$",
+        "mtime": r"^[0-9]+(\.[0-9]+)?$",
+        "rights": "^([ugoa]+[+=-][rwxXst]*,?)+$",
+    }
+    for k, v in options.items():
+        if k != "op" and not re.match(checks[k], v):
+            raise ValueError("invalid chunk option %s" % k)
+    if "/../" in target_path or target_path.endswith("/.."):
+        raise ValueError("invalid path")
+    op = options.get("op")
+    if op == "sums":
+        if subprocess.call(sudo + ["test", "-f", target_path]) != 0 or (
+            subprocess.call(sudo + ["test", "-L", target_path]) == 0
+        ):
+            print("missing")
+            return
+        dd = subprocess.Popen(
+            sudo
+            + [
+                "dd",
+                "if=" + target_path,
+                "bs=4M",
+                "skip=" + options["offset"],
+                "count=" + options["length"],
+                "iflag=skip_bytes,count_bytes",
+                "status=none",
+            ],
+            stdout=subprocess.PIPE,
+        )
+        h = hashlib.sha256()
+        for block in iter(lambda: dd.stdout.read(4 * 1024 * 1024), b""):
+            h.update(block)
+        dd.wait()
+        if dd.returncode != 0:
+            raise ValueError("reading chunk failed")
+        print(h.hexdigest())
+    elif op == "write":
+        if subprocess.call(sudo + ["test", "-L", target_path]) == 0:
+            subprocess.check_call(sudo + ["rm", target_path])
+        dd = subprocess.Popen(
+            sudo
+            + [
+                "dd",
+                "of=" + target_path,
+                "bs=4M",
+                "seek=" + options["offset"],
+                "oflag=seek_bytes",
+                "conv=notrunc",
+                "status=none",
+            ],
+            stdin=subprocess.PIPE,
+        )
+        h = hashlib.sha256()
+        received = 0
+        for block in iter(lambda: sys.stdin.buffer.read(4 * 1024 * 1024), b""):
+            h.update(block)
+            received += len(block)
+            dd.stdin.write(block)
+        dd.stdin.close()
+        dd.wait()
+        if dd.returncode != 0 or received != int(options["length"]):
+            raise ValueError("writing chunk failed")
+        print(h.hexdigest())
+    elif op == "finalize":
+        subprocess.check_call(sudo + ["truncate", "-s", options["size"], target_path])
+        if "owner" in options:
+            subprocess.check_call(sudo + ["chown", options["owner"], target_path])
+        subprocess.check_call(sudo + ["chmod", options["mode"], target_path])
+        if "rights" in options:
+            subprocess.check_call(sudo + ["chmod", options["rights"], target_path])
+        subprocess.check_call(
+            sudo + ["touch", "-m", "-d", "@" + options["mtime"], target_path]
+        )
+    else:
+        raise ValueError("invalid chunk op")
 
 
 def shell_cmd_rprsync(cmd_line):
@@ -767,6 +1446,10 @@ def shell_cmd_rprsync(cmd_line):
     chmod_after = False
     todo = []
     do_sudo = True
+    untar = cmd_line.startswith("rprsync_untar ")
+    compressor = None
+    chunk = cmd_line.startswith("rprsync_chunks ")
+    chunk_options = {}
     if "@@@" in cmd_line:
         parts = cmd_line.split("@@@")
         target_path = parts[0][parts[0].find("/") :]
@@ -785,10 +1468,31 @@ def shell_cmd_rprsync(cmd_line):
                 chmod_after = True
             elif p.startswith("no_sudo"):
                 do_sudo = False
+            elif p.startswith("compressor=") and untar:
+                compressor = p[p.find("=") + 1 :]
+            elif chunk and p[: p.find("=")] in (
+                "op",
+                "offset",
+                "length",
+                "size",
+                "mode",
+                "owner",
+                "mtime",
+                "rights",
+            ):
+                chunk_options[p[: p.find("=")]] = p[p.find("=") + 1 :]
             else:
                 raise ValueError("Invalid @ command")
 
     path_ok(target_path)
+    if chunk:
+        receive_chunk(target_path, chunk_options, do_sudo)
+        return
+    if untar:
+        receive_tar(target_path, compressor, do_sudo)
+        for cmd in todo:
+            subprocess.check_call(cmd)
+        return
     reset_rights = False
     if target_path.endswith("/."):
         try:
@@ -812,6 +1516,27 @@ def shell_cmd_rprsync(cmd_line):
     # subprocess.check_call(['sudo','chmod', '%.3o'  % (org_rights & 0o777), target_path])
 
 
+def shell_cmd_zfs_receive(cmd_line):
+    """The receiving end of a zfs send transfer.
+
+    cmd_line is 'zfs_receive pool/prefix/ffs' - the ffs must exist
+    and lie inside (but not be) an ffs:root.
+    """
+    parts = cmd_line.split()
+    if len(parts) != 2:
+        raise ValueError("invalid zfs_receive command")
+    target_zfs = parts[1]
+    if "@" in target_zfs or target_zfs.startswith("/") or "/." in target_zfs:
+        raise ValueError("invalid target")
+    if target_zfs not in list_zfs():
+        raise ValueError("target is not a zfs: '%s'" % target_zfs)
+    if not is_inside_ffs_root("/" + os.path.split(target_zfs)[0]):
+        raise ValueError("Path rejected: '%s" % target_zfs)
+    p = subprocess.Popen(zfs_cmd + ["receive", "-F", target_zfs])
+    p.communicate()
+    return p.returncode
+
+
 def check_storage_prefix(msg):
     if "storage_prefix" not in msg:
         raise ValueError("No storage_prefix in msg")
@@ -848,8 +1573,14 @@ def dispatch(msg):
             result = msg_remove(msg)
         elif msg["msg"] == "remove_snapshot":
             result = msg_remove_snapshot(msg)
+        elif msg["msg"] == "remove_snapshots":
+            result = msg_remove_snapshots(msg)
         elif msg["msg"] == "zpool_status":
             result = msg_zpool_status(msg)
+        elif msg["msg"] == "zpool_scrub":
+            result = msg_zpool_scrub(msg)
+        elif msg["msg"] == "load":
+            result = msg_load(msg)
         elif msg["msg"] == "chown_and_chmod":
             result = msg_chown_and_chmod(msg)
         elif msg["msg"] == "send_snapshot":
@@ -860,6 +1591,10 @@ def dispatch(msg):
             result = msg_rename(msg)
         elif msg["msg"] == "rollback":
             result = msg_rollback(msg)
+        elif msg["msg"] == "receive_begin":
+            result = msg_receive_begin(msg)
+        elif msg["msg"] == "receive_commit":
+            result = msg_receive_commit(msg)
 
         else:
             result = {"error": "message_not_understood"}
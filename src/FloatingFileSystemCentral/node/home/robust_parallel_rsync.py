@@ -7,6 +7,18 @@ import multiprocessing
 import itertools
 import json
 import shlex
+import heapq
+import queue
+import hashlib
+import pwd
+import grp
+import tempfile
+import shutil
+import signal
+import atexit
+import time
+import random
+import re
 
 
 def print_usage(error):
@@ -25,7 +37,23 @@ def print_usage(error):
             'cores': 2,
             'excluded_subdirs': ['a', 'b',...], #optional
             'bwlimit': "1.5m",
+            'seed': True, # optional, stream a tar if the target is empty
+            'seed_compressor': 'zstd', # optional, zstd or gzip
+            'partition': True, # optional, False = one rsync per top level dir
+            'large_file_threshold': 8 * 1024**3, # optional, None = no chunking
+            'chunk_size': 512 * 1024**2, # optional
+            'ssh_multiplex': True, # optional, share one ssh connection
+            'resume_state': '/path/file', # optional, finished units are recorded
+                                          # here and skipped on the next run
+            'retries': 3, # optional, attempts per work unit
+            'progress_interval': 30, # optional, seconds between progress lines
         }
+
+    Progress is written to stderr as 'FFS_PROGRESS {json}' lines.
+    The last line on stdout is a json summary:
+        {'units': n, 'failed_units': [unit keys], 'blocked_units': n,
+         'failure_counts': {unit key: failed attempts},
+         'bytes': bytes transferred, 'files': files transferred}
     """
     )
     print("error: %s" % error)
@@ -37,6 +65,12 @@ def grouper(n, iterable, padvalue=None):
     return itertools.zip_longest(*[iter(iterable)] * n, fillvalue=padvalue)
 
 
+def backoff(attempt, base=1.0, cap=60.0):
+    """Exponential backoff with full jitter - so parallel units that failed
+    together (e.g. a network hickup) don't retry in lock step"""
+    time.sleep(random.uniform(0, min(cap, base * 2 ** attempt)))
+
+
 def do_rsync(args):
     """the actual work horse"""
     sub_dir, recursive, cmd, excluded_subdirs = args
@@ -86,14 +120,17 @@ def do_rsync(args):
         "--super",
         "--owner",
         "--group",
+        "--stats",  # for the progress reports
     ]
     if "chmod_rights" in cmd:
         rsync_cmd += ["--chmod=" + cmd["chmod_rights"]]
+    if "resume_state" in cmd:  # keep partially transfered files for the next attempt
+        rsync_cmd.append("--partial")
     if recursive:
         rsync_cmd.append("--recursive")
     else:
         rsync_cmd.append("--dirs")
-    if "bwlimit" in cmd:  # bwlimit is used in testing.
+    if "bwlimit" in cmd:  # per work unit - the node splits the transfer's budget
         rsync_cmd.append("--bwlimit=%s" % cmd["bwlimit"])
     for d in excluded_subdirs:
         rsync_cmd.append("--exclude=%s" % d)
@@ -110,71 +147,783 @@ def do_rsync(args):
     )
     if "no_sudo" in cmd:
         rsync_cmd[-1] += "@@@no_sudo="
-    retries = 3  # actually total number of transmission attempst
-    while retries > 0:
+    failures = 0
+    for attempt in range(cmd.get("retries", 3)):
+        if attempt:
+            backoff(attempt - 1)
         p = subprocess.Popen(rsync_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         stdout, stderr = p.communicate()
         stdout += ("\n" + " ".join(rsync_cmd)).encode("utf8", errors="replace")
         stdout += b"\n rsync returncode: " + str(p.returncode).encode("utf-8")
         if p.returncode == 0:
             break
-        import time
+        failures += 1
 
-        time.sleep(1)  # probably smart to wait a second.
-        retries -= 1
+    return "rsync", p.returncode, stdout, stderr, failures
 
-    return "rsync", p.returncode, stdout, stderr
 
+compressors = {
+    "zstd": (["zstd", "-c", "-T0"], ["zstd", "-d", "-c"]),
+    "gzip": (["gzip", "-c"], ["gzip", "-d", "-c"]),
+}
 
-def parallel_chown_chmod_and_rsync(cmd):
-    def iter_subdirs():
-        try:
-            excluded_dirs = set(cmd.get("excluded_subdirs", []))
-            dirs = os.listdir(cmd["source_path"])
-            yield ".", False, cmd, excluded_dirs
-            for d in dirs:
-                # if '(' in d: # let the recursive sort this one out.
-                # continue
-                fd = os.path.join(cmd["source_path"], d)
-                if (
-                    os.path.isdir(fd)
-                    and not os.path.ismount(fd)
-                    and not os.path.islink(fd)
-                    and not d  # which is only true if we're sending from a non-clone
-                    in excluded_dirs
-                ):  # but since we're sending from a clone, we need to rely on the engine to tell us what to exclude
-                    yield d + "/", True, cmd, []
-        except PermissionError:  # source dir unreadable - fall back to non-parallel processing and let rsync handle the permission implications
-            yield ".", True, cmd, excluded_dirs
 
+def seed_with_tar(cmd):
+    """Fill an empty target with one tar stream over a single ssh connection.
+
+    rsync's per file overhead dominates initial transfers of trees
+    with many small files. The receiving end (rprsync_untar) refuses
+    non-empty targets - tar can't --delete.
+    Same semantics as do_rsync: top level excluded_subdirs are skipped,
+    file systems are not crossed, owner/group are kept (by name),
+    chmod_rights are applied afterwards.
+
+    Returns ('seed', rc, stdout, stderr, (bytes, files)) - bytes
+    of the (uncompressed) tar stream, files as listed by tar.
+    """
+    compressor = cmd.get("seed_compressor", "zstd")
+    if compressor not in compressors:
+        raise ValueError("invalid seed_compressor")
+    tar_cmd = []
+    if not "no_sudo" in cmd:
+        tar_cmd.append("sudo")
+    # the listing (one line per entry, dirs end in /) counts the files
+    tar_index = tempfile.NamedTemporaryFile()
+    tar_cmd += ["tar", "--create", "--file=-", "--one-file-system", "--anchored"]
+    tar_cmd += ["--verbose", "--index-file=%s" % tar_index.name]
+    for d in cmd.get("excluded_subdirs", []):
+        tar_cmd.append("--exclude=./%s" % d)
+    tar_cmd += ["--directory", cmd["source_path"], "."]
+    # no shell on the receiving end - the path is taken verbatim
+    receive_cmd = "rprsync_untar %s@@@compressor=%s" % (cmd["target_path"], compressor)
+    if "chmod_rights" in cmd:
+        receive_cmd += "@@@chmod=%s@@@chmod_after" % cmd["chmod_rights"]
+    if "no_sudo" in cmd:
+        receive_cmd += "@@@no_sudo="
+    ssh_cmd = cmd.get("target_ssh_cmd", ["ssh"]) + [
+        "%s@%s" % (cmd["target_user"], cmd["target_host"]),
+        receive_cmd,
+    ]
+    # tar may warn a lot ('file changed as we read it') - a pipe nobody
+    # reads until the end would fill up and stall the whole stream
+    tar_stderr = tempfile.TemporaryFile()
+    compress_stderr = tempfile.TemporaryFile()
+    ssh_stdout = tempfile.TemporaryFile()
+    ssh_stderr = tempfile.TemporaryFile()
+    try:
+        tar = subprocess.Popen(tar_cmd, stdout=subprocess.PIPE, stderr=tar_stderr)
+        compress = subprocess.Popen(
+            compressors[compressor][0],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=compress_stderr,
+        )
+        ssh = subprocess.Popen(
+            ssh_cmd,
+            stdin=compress.stdout,
+            stdout=ssh_stdout,
+            stderr=ssh_stderr,
+        )
+        compress.stdout.close()
+    except OSError as e:  # e.g. no zstd installed
+        return "seed", 127, b"", str(e).encode("utf-8"), (0, 0)
+    # relay tar -> compressor ourselves, counting what's streamed
+    streamed = 0
+    try:
+        while True:
+            block = tar.stdout.read(1024 * 1024)
+            if not block:
+                break
+            compress.stdin.write(block)
+            streamed += len(block)
+    except BrokenPipeError:  # the receiving end gave up - rc tells
+        pass
+    tar.stdout.close()
+    try:
+        compress.stdin.close()
+    except BrokenPipeError:
+        pass
+    ssh.wait()
+    tar.wait()
+    compress.wait()
+    stdout, stderr = [_read_and_close(f) for f in (ssh_stdout, ssh_stderr)]
+    for f in (tar_stderr, compress_stderr):
+        stderr += _read_and_close(f)
+    files = len(
+        [x for x in _read_and_close(tar_index).split(b"\n") if x and x[-1:] != b"/"]
+    )
+    stdout += ("\n" + " ".join(tar_cmd) + " | ... | " + " ".join(ssh_cmd)).encode(
+        "utf8", errors="replace"
+    )
+    rc = tar.returncode or compress.returncode or ssh.returncode
+    return "seed", rc, stdout, stderr, (streamed, files)
+
+
+def _read_and_close(temp_file):
+    temp_file.seek(0)
+    res = temp_file.read()
+    temp_file.close()
+    return res
+
+
+# a file costs about as much as this many bytes in rsync round trips / metadata
+per_file_weight = 32 * 1024
+# don't split below this - every unit is another ssh connection + rsync startup
+min_split_weight = 256 * 1024 * 1024
+# files above this are transfered in parallel chunks instead of by rsync
+default_large_file_threshold = 8 * 1024 ** 3
+default_chunk_size = 512 * 1024 ** 2
+
+
+def chunk_remote(cmd, rel_path, options, stdin=subprocess.DEVNULL):
+    """Start an ssh to the receiving end of the chunk transfer (rprsync_chunks)"""
+    # no shell on the receiving end - the path is taken verbatim
+    remote = "rprsync_chunks %s" % os.path.join(cmd["target_path"], rel_path)
+    for k, v in options:
+        remote += "@@@%s=%s" % (k, v)
+    if "no_sudo" in cmd:
+        remote += "@@@no_sudo="
+    ssh_cmd = cmd.get("target_ssh_cmd", ["ssh"]) + [
+        "%s@%s" % (cmd["target_user"], cmd["target_host"]),
+        remote,
+    ]
+    p = subprocess.Popen(
+        ssh_cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    return p, ssh_cmd
+
+
+def read_local_chunk(cmd, path, offset, length):
+    dd_cmd = [] if "no_sudo" in cmd else ["sudo"]
+    dd_cmd += [
+        "dd",
+        "if=" + path,
+        "bs=4M",
+        "skip=%i" % offset,
+        "count=%i" % length,
+        "iflag=skip_bytes,count_bytes",
+        "status=none",
+    ]
+    return subprocess.Popen(dd_cmd, stdout=subprocess.PIPE)
+
+
+def do_chunk(args):
+    """Transfer one byte range of a large file - if it differs from the target's.
+
+    Both ends hash the range (sha256), the range is only sent if the hashes
+    differ, and the receiver reports the hash of what it wrote, which must
+    match ours.
+    """
+    rel_path, offset, length, cmd = args
+    source = os.path.join(cmd["source_path"], rel_path)
+    h = hashlib.sha256()
+    dd = read_local_chunk(cmd, source, offset, length)
+    for block in iter(lambda: dd.stdout.read(4 * 1024 * 1024), b""):
+        h.update(block)
+    dd.wait()
+    if dd.returncode != 0:
+        return "chunk", dd.returncode, b"reading " + source.encode("utf-8"), b"", 1
+    local_hash = h.hexdigest().encode("utf-8")
+    range_options = [("offset", offset), ("length", length)]
+    failures = 0
+    for attempt in range(cmd.get("retries", 3)):
+        if attempt:
+            backoff(attempt - 1)
+        p, ssh_cmd = chunk_remote(cmd, rel_path, [("op", "sums")] + range_options)
+        stdout, stderr = p.communicate()
+        if p.returncode == 0 and stdout.strip() == local_hash:
+            return "chunk", 0, b"unchanged", b"", failures
+        if p.returncode == 0:
+            dd = read_local_chunk(cmd, source, offset, length)
+            p, ssh_cmd = chunk_remote(
+                cmd, rel_path, [("op", "write")] + range_options, stdin=dd.stdout
+            )
+            dd.stdout.close()
+            stdout, stderr = p.communicate()
+            dd.wait()
+            if p.returncode == 0 and dd.returncode == 0:
+                if stdout.strip() == local_hash:
+                    return "chunk", 0, b"written", b"", failures
+                stderr += b"\nchecksum mismatch after write"
+        stdout += ("\n" + " ".join(ssh_cmd)).encode("utf8", errors="replace")
+        failures += 1
+    return "chunk", p.returncode or 3, stdout, stderr, failures
+
+
+def do_chunk_finalize(args):
+    """Set size, owner, rights and mtime of a file transfered by do_chunk"""
+    rel_path, size, mode, owner, mtime, cmd = args
+    options = [("op", "finalize"), ("size", size), ("mode", mode), ("mtime", mtime)]
+    if "no_sudo" not in cmd:
+        options.append(("owner", owner))
+    if "chmod_rights" in cmd:
+        options.append(("rights", cmd["chmod_rights"]))
+    p, ssh_cmd = chunk_remote(cmd, rel_path, options)
+    stdout, stderr = p.communicate()
+    stdout += ("\n" + " ".join(ssh_cmd)).encode("utf8", errors="replace")
+    return "chunk_finalize", p.returncode, stdout, stderr, int(p.returncode != 0)
+
+
+def scan_tree(path, dev=None, large_file_threshold=None, large_files=None, rel=""):
+    """Estimate the transfer weight of every directory below path.
+
+    Returns {'weight': bytes + files * per_file_weight,
+             'children': {name: scan_tree(...)}}
+    Does not follow symlinks or cross file systems (rsync -x).
+    Unreadable directories count as weight 0 - rsync will sort them out.
+
+    Regular files larger than large_file_threshold are appended
+    to large_files as (relative path, stat) instead (see do_chunk).
+    """
+    res = {"weight": 0, "children": {}}
+    try:
+        if dev is None:
+            dev = os.lstat(path).st_dev
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if st.st_dev != dev:  # mount point
+                        continue
+                    sub = scan_tree(
+                        entry.path,
+                        dev,
+                        large_file_threshold,
+                        large_files,
+                        rel + entry.name + "/",
+                    )
+                    res["children"][entry.name] = sub
+                    res["weight"] += sub["weight"] + per_file_weight
+                elif (
+                    large_file_threshold is not None
+                    and entry.is_file(follow_symlinks=False)
+                    and st.st_size > large_file_threshold
+                ):
+                    large_files.append((rel + entry.name, st))
+                    res["weight"] += per_file_weight
+                else:
+                    res["weight"] += st.st_size + per_file_weight
+    except OSError:
+        pass
+    return res
+
+
+def build_units(cmd, cores):
+    """Partition the transfer into rsync work units.
+
+    A unit is {'args': do_rsync arguments,
+    'weight': estimated cost of the unit and all its children,
+    'children': units that may only start once this one is done}.
+
+    The root is a non recursive (--dirs) sync of the top level,
+    which creates the sub directories the other units sync into.
+    Below that, a directory becomes one recursive unit - unless its
+    weight exceeds total / (cores * granularity), in which case it is
+    split into a --dirs unit for itself and units for its sub directories.
+    That way one huge top level directory no longer degrades
+    into a single stream.
+    """
+    source_path = cmd["source_path"]
+    excluded_dirs = set(cmd.get("excluded_subdirs", []))
+    try:
+        dirs = os.listdir(source_path)
+    except PermissionError:  # source dir unreadable - fall back to non-parallel processing and let rsync handle the permission implications
+        return {
+            "args": (".", True, cmd, excluded_dirs),
+            "weight": 0,
+            "children": [],
+        }
+    root = {
+        "args": (".", False, cmd, list(excluded_dirs)),
+        "weight": 0,
+        "children": [],
+    }
+    large_file_threshold = cmd.get("large_file_threshold", default_large_file_threshold)
+    large_files = []
+    if cmd.get("partition", True) or large_file_threshold is not None:
+        tree = scan_tree(source_path, None, large_file_threshold, large_files)
+        large_files = [
+            (rel, st)
+            for (rel, st) in large_files
+            if rel.split("/")[0] not in excluded_dirs
+        ]
+    else:
+        tree = {"children": {}}
+    if cmd.get("partition", True):
+        total = sum(
+            sub["weight"]
+            for name, sub in tree["children"].items()
+            if name not in excluded_dirs
+        )
+        split_above = max(
+            total / (max(cores, 1) * cmd.get("partition_granularity", 4)),
+            cmd.get("partition_min_weight", min_split_weight),
+        )
+    else:
+        split_above = None
+
+    def unit(sub_dir, sub_tree):
+        if (
+            split_above is None
+            or sub_tree["weight"] <= split_above
+            or not sub_tree["children"]
+        ):
+            return {
+                "args": (sub_dir, True, cmd, []),
+                "weight": sub_tree["weight"],
+                "children": [],
+            }
+        return {
+            "args": (sub_dir, False, cmd, []),
+            "weight": sub_tree["weight"],
+            "children": [
+                unit(sub_dir + name + "/", x)
+                for name, x in sorted(sub_tree["children"].items())
+            ],
+        }
+
+    for d in dirs:
+        # if '(' in d: # let the recursive sort this one out.
+        # continue
+        fd = os.path.join(source_path, d)
+        if (
+            os.path.isdir(fd)
+            and not os.path.ismount(fd)
+            and not os.path.islink(fd)
+            and not d  # which is only true if we're sending from a non-clone
+            in excluded_dirs
+        ):  # but since we're sending from a clone, we need to rely on the engine to tell us what to exclude
+            root["children"].append(
+                unit(d + "/", tree["children"].get(d, {"weight": 0, "children": {}}))
+            )
+    for rel, st in large_files:
+        add_chunk_units(root, rel, st, cmd)
+    return root
+
+
+def add_chunk_units(root, rel, st, cmd):
+    """Move a large file from the rsync units to chunk units.
+
+    Every rsync unit containing the file excludes it (anchored, so
+    --delete leaves the target's copy alone). The chunks run once the
+    unit covering the file's directory has created it, the finalize unit
+    once all chunks are done.
+    """
+    covering = root
+    while True:
+        sub_dir = covering["args"][0]
+        prefix = "" if sub_dir == "." else sub_dir
+        covering["args"][3].append("/" + rel[len(prefix) :])
+        for child in covering["children"]:
+            if "func" not in child and rel.startswith(child["args"][0]):
+                covering = child
+                break
+        else:
+            break
+    chunk_size = cmd.get("chunk_size", default_chunk_size)
+    try:
+        owner = pwd.getpwuid(st.st_uid).pw_name
+    except KeyError:
+        owner = str(st.st_uid)
+    try:
+        group = grp.getgrgid(st.st_gid).gr_name
+    except KeyError:
+        group = str(st.st_gid)
+    finalize = {
+        "func": do_chunk_finalize,
+        "args": (
+            rel,
+            st.st_size,
+            "%.4o" % (st.st_mode & 0o7777),
+            owner + ":" + group,
+            "%i.%.9i" % divmod(st.st_mtime_ns, 10 ** 9),
+            cmd,
+        ),
+        "weight": 0,
+        "children": [],
+        "waiting": 0,
+    }
+    for offset in range(0, st.st_size, chunk_size):
+        length = min(chunk_size, st.st_size - offset)
+        covering["children"].append(
+            {
+                "func": do_chunk,
+                "args": (rel, offset, length, cmd),
+                "weight": length,
+                "children": [],
+                "then": finalize,
+            }
+        )
+        finalize["waiting"] += 1
+
+
+def unit_key(unit):
+    """Identifies a unit across runs - function + args, minus cmd & excludes"""
+    func = unit.get("func", do_rsync)
+    args = [x for x in unit["args"] if not isinstance(x, (dict, list, set))]
+    return json.dumps([func.__name__] + args)
+
+
+def load_resume_state(cmd):
+    try:
+        with open(cmd["resume_state"]) as op:
+            return set(x.strip() for x in op if x.strip())
+    except (KeyError, OSError):
+        return set()
+
+
+def record_finished(cmd, unit):
+    if "resume_state" in cmd:
+        with open(cmd["resume_state"], "a") as op:
+            op.write(unit_key(unit) + "\n")
+
+
+progress_prefix = "FFS_PROGRESS "
+default_progress_interval = 30
+
+
+def parse_rsync_stats(stdout):
+    """(bytes, files) transferred according to rsync --stats.
+    Numbers may carry thousands separators (rsync >= 3.1)"""
+
+    def number(pattern):
+        m = re.search(pattern, stdout)
+        if m is None:
+            return 0
+        return int(re.sub(rb"[^0-9]", b"", m.group(1)) or 0)
+
+    return (
+        number(rb"Total transferred file size: ([0-9,.]+)"),
+        number(rb"Number of (?:regular )?files transferred: ([0-9,.]+)"),
+    )
+
+
+class Progress:
+    """Sums up what the finished units transfered and periodically
+    writes it to stderr as 'FFS_PROGRESS {json}'
+    - the node forwards these to the central.
+
+    The ETA extrapolates from the (estimated) weight of the finished units.
+    """
+
+    def __init__(self, root, interval=default_progress_interval):
+        self.interval = interval
+        self.start = time.time()
+        self.last_report = self.start
+        self.bytes = 0
+        self.files = 0
+        self.done_weight = 0
+        self.total_weight = 0
+        seen = set()
+        todo = [root]
+        while todo:
+            unit = todo.pop()
+            if id(unit) in seen:
+                continue
+            seen.add(id(unit))
+            self.total_weight += self.own_weight(unit)
+            todo.extend(unit["children"])
+            if "then" in unit:
+                todo.append(unit["then"])
+
+    @staticmethod
+    def own_weight(unit):
+        # a split unit's weight includes its rsync children
+        return max(
+            0,
+            unit["weight"]
+            - sum(c["weight"] for c in unit["children"] if "func" not in c),
+        )
+
+    def unit_done(self, unit, res):
+        mode, rc, stdout = res[:3]
+        if mode == "rsync":
+            b, f = parse_rsync_stats(stdout)
+            self.bytes += b
+            self.files += f
+        elif mode == "chunk" and stdout == b"written":
+            self.bytes += unit["args"][2]
+        elif mode == "chunk_finalize" and rc == 0:
+            self.files += 1
+        self.done_weight += self.own_weight(unit)
+        if time.time() - self.last_report >= self.interval:
+            self.report()
+
+    def record(self):
+        elapsed = time.time() - self.start
+        if self.done_weight and self.total_weight:
+            eta = elapsed * (self.total_weight - self.done_weight) / self.done_weight
+        else:
+            eta = None
+        return {
+            "bytes": self.bytes,
+            "files": self.files,
+            "elapsed": elapsed,
+            "bytes_per_second": self.bytes / elapsed if elapsed > 0 else 0,
+            "done_weight": self.done_weight,
+            "total_weight": self.total_weight,
+            "eta": eta,
+        }
+
+    def report(self):
+        self.last_report = time.time()
+        sys.stderr.write(progress_prefix + json.dumps(self.record()) + "\n")
+        sys.stderr.flush()
+
+
+def run_units(root, cores, progress=None):
+    """Run the units, largest ready unit first.
+
+    Idle workers pull the next unit from one shared heap as soon as they
+    are done, so a few large units don't leave the other cores idle.
+    A unit's children become ready once it finished successfully
+    (otherwise there's a race on creating their target directories),
+    a 'then' unit once all units pointing to it did.
+
+    Units recorded as finished in cmd['resume_state'] by an earlier,
+    interrupted run are not run again.
+
+    Finished units are passed to progress.unit_done (if given).
+
+    Returns [(unit_key, result)] for every unit that ran (or was skipped).
+    """
+    results = []
+    done = queue.Queue()
+    ready = []
+    tie_breaker = itertools.count()  # keeps listdir order among equal weights
+    cmd = root["args"][2]
+    finished = load_resume_state(cmd)
+
+    def push(unit):
+        heapq.heappush(ready, (-unit["weight"], next(tie_breaker), unit))
+
+    push(root)
+    running = 0
+    p = multiprocessing.Pool(cores)
+    try:
+        while ready or running:
+            while ready and running < cores:
+                _, _, unit = heapq.heappop(ready)
+                if unit_key(unit) in finished:
+                    done.put((unit, ("skipped", 0, b"", b"", 0)))
+                    running += 1
+                    continue
+                p.apply_async(
+                    unit.get("func", do_rsync),
+                    (unit["args"],),
+                    callback=lambda res, unit=unit: done.put((unit, res)),
+                    error_callback=lambda e, unit=unit: done.put(
+                        (unit, ("rsync", 1, b"", str(e).encode("utf-8"), 1))
+                    ),
+                )
+                running += 1
+            try:
+                unit, res = done.get(
+                    timeout=progress.interval if progress is not None else None
+                )
+            except queue.Empty:  # nothing finished - report the elapsed time anyway
+                progress.report()
+                continue
+            running -= 1
+            results.append((unit_key(unit), res))
+            if progress is not None:
+                progress.unit_done(unit, res)
+            if res[1] == 0:
+                if res[0] != "skipped":
+                    record_finished(cmd, unit)
+                for child in unit["children"]:
+                    push(child)
+                if "then" in unit:
+                    unit["then"]["waiting"] -= 1
+                    if unit["then"]["waiting"] == 0:
+                        push(unit["then"])
+    except BaseException:
+        # e.g. SystemExit from on_terminate - don't wait for the workers
+        p.terminate()
+        p.join()
+        raise
+    p.close()
+    p.join()
+    return results
+
+
+# sshd's default MaxSessions - more multiplexed sessions get refused
+max_multiplexed_sessions = 10
+
+
+def die_with_parent():
+    """preexec_fn: SIGTERM the child once we're gone - even on SIGKILL"""
+    try:
+        import ctypes
+
+        PR_SET_PDEATHSIG = 1
+        ctypes.CDLL("libc.so.6").prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+    except Exception:
+        pass
+
+
+def start_ssh_master(cmd):
+    """Start a ControlMaster connection to the target.
+
+    Returns a cleanup function, and rewrites cmd['target_ssh_cmd']
+    so all work units (rsync -e, chunks, seed) share the master's
+    connection instead of doing their own handshake.
+    On any failure, cmd is left alone and we run without multiplexing.
+    """
+    ssh_cmd = cmd.get("target_ssh_cmd", ["ssh"])
+    dest = "%s@%s" % (cmd["target_user"], cmd["target_host"])
+    sock_dir = tempfile.mkdtemp(prefix="rprsync_")
+    sock = os.path.join(sock_dir, "master")
+    try:
+        master = subprocess.Popen(
+            ssh_cmd + ["-M", "-S", sock, "-N", "-o", "ControlPersist=no", dest],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            preexec_fn=die_with_parent,
+        )
+    except OSError:
+        shutil.rmtree(sock_dir, ignore_errors=True)
+        return lambda: None
+
+    def check():
+        return (
+            subprocess.call(
+                ssh_cmd + ["-S", sock, "-O", "check", dest],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            == 0
+        )
+
+    cleaned_up = []
+
+    def cleanup():
+        if cleaned_up:
+            return
+        cleaned_up.append(True)
+        if master.poll() is None:
+            subprocess.call(
+                ssh_cmd + ["-S", sock, "-O", "exit", dest],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            try:
+                master.terminate()
+                master.wait(5)
+            except (OSError, subprocess.TimeoutExpired):
+                master.kill()
+        shutil.rmtree(sock_dir, ignore_errors=True)
+
+    deadline = time.time() + cmd.get("ssh_master_timeout", 15)
+    while master.poll() is None and time.time() < deadline:
+        if check():
+            break
+        time.sleep(0.1)
+    else:
+        cleanup()
+        sys.stderr.write("ssh master failed, not multiplexing\n")
+        return lambda: None
+    atexit.register(cleanup)
+    cmd["target_ssh_cmd"] = ssh_cmd + ["-S", sock, "-o", "ControlMaster=no"]
+    return cleanup
+
+
+def on_terminate(dummy_signum, dummy_frame):
+    sys.exit(3)  # which runs the finally clause / atexit handlers
+
+
+def parallel_chown_chmod_and_rsync(cmd):
     cores = cmd.get("cores", 2)
     if cores == -1:
-        cores = None
-    # do the first one - that creates the subdirs and top level files without recursion
-    # non-parallel
+        cores = os.cpu_count()
+    if cmd.get("ssh_multiplex", True) and cores < max_multiplexed_sessions:
+        signal.signal(signal.SIGTERM, on_terminate)
+        signal.signal(signal.SIGHUP, on_terminate)
+        signal.signal(signal.SIGINT, on_terminate)
+        cleanup = start_ssh_master(cmd)
+    else:
+        cleanup = lambda: None
+    try:
+        do_parallel_chown_chmod_and_rsync(cmd, cores)
+    finally:
+        cleanup()
+
+
+def do_parallel_chown_chmod_and_rsync(cmd, cores):
+    if cmd.get("seed", False):
+        return_mode, rc, stdout, stderr, (streamed, files) = seed_with_tar(cmd)
+        if rc == 0:
+            print("OK")
+            # same summary as below - one unit, the tar stream
+            summary = {
+                "units": 1,
+                "failed_units": [],
+                "blocked_units": 0,
+                "failure_counts": {},
+                "bytes": streamed,
+                "files": files,
+            }
+            print(json.dumps(summary))
+            sys.exit(0)
+        # target was not empty, or the stream broke off.
+        # rsync will sort it out.
+        sys.stderr.write("seeding failed, falling back to rsync\n")
+        sys.stderr.write(stdout.decode("utf8", errors="replace"))
+        sys.stderr.write(stderr.decode("utf8", errors="replace"))
+
+    # the root unit creates the subdirs and top level files without recursion
+    # before anything else runs
     # otherwise there's a race condition that might be triggered
     # because the sub-dir rsyncs see 'dir does not exist', but till they get around to
     # create it, it does, and then they explode
-    it = list(iter_subdirs())
-    first = it[0]
-    result = [do_rsync(first)]
-    p = multiprocessing.Pool(cores)
-    result.extend(p.map(do_rsync, it[1:]))
-    p.close()
-    p.join()
-    # result = map(chown_chmod_and_rsync, list(iter_subdirs()))
+    root = build_units(cmd, cores)
+    progress = Progress(root, cmd.get("progress_interval", default_progress_interval))
+    result = run_units(root, cores, progress)
+    progress.report()
     rc = 0
-    for return_mode, rsync_return_code, stdout, stderr in result:
+    summary = {
+        "units": count_units(root),
+        "failed_units": [],
+        "blocked_units": 0,
+        "failure_counts": {},
+        "bytes": progress.bytes,
+        "files": progress.files,
+    }
+    for key, (return_mode, rsync_return_code, stdout, stderr, failures) in result:
+        if failures:
+            summary["failure_counts"][key] = failures
         if rsync_return_code != 0:
             rc = 2
+            summary["failed_units"].append(key)
             sys.stderr.write(return_mode + "\n")
-            sys.stderr.write(stdout.decode("utf8"))
-            sys.stderr.write(stderr.decode("utf8"))
+            sys.stderr.write(stdout.decode("utf8", errors="replace"))
+            sys.stderr.write(stderr.decode("utf8", errors="replace"))
+    # the children of failed units never ran
+    summary["blocked_units"] = summary["units"] - len(result)
     if rc == 0:
         print("OK")
+    print(json.dumps(summary))
     sys.exit(rc)
 
 
+def count_units(root):
+    seen = set()
+    todo = [root]
+    while todo:
+        unit = todo.pop()
+        if id(unit) in seen:
+            continue
+        seen.add(id(unit))
+        todo.extend(unit["children"])
+        if "then" in unit:
+            todo.append(unit["then"])
+    return len(seen)
+
+
 def main():
     try:
         cmd = sys.stdin.read()
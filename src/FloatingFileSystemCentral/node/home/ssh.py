@@ -76,6 +76,9 @@ if True:
     if cmd_line.startswith("rprsync"):  # robust parallel rsync
         logger.info(cmd_line)
         node.shell_cmd_rprsync(cmd_line)
+    elif cmd_line.startswith("zfs_receive"):  # zfs send transport
+        logger.info(cmd_line)
+        sys.exit(node.shell_cmd_zfs_receive(cmd_line))
     else:
         json_input = ""
         j = sys.stdin.read()
@@ -1,5 +1,6 @@
 import json
 import pprint
+import collections
 from twisted.internet import reactor, protocol, error
 import time
 import os
@@ -13,6 +14,23 @@ class MessageInProgress:
         self.msg = msg.copy()
         self.status = "unsent"
         self.send_time = 0
+        self.queued_time = time.time()
+        # virtual start/finish time for fair queuing, see prioritize
+        self.fair_start = None
+        self.fair_finish = None
+        self.progress = None  # last FFS_PROGRESS record of a send_snapshot
+
+    def get_progress(self):
+        """bytes/files so far, bytes per second and ETA in seconds
+        (None if unknown) - or None if the node did not report any"""
+        if self.progress is None:
+            return None
+        return {
+            "bytes": self.progress.get("bytes", 0),
+            "files": self.progress.get("files", 0),
+            "bytes_per_second": self.progress.get("bytes_per_second", 0),
+            "eta": self.progress.get("eta", None),
+        }
 
     def get_runtime(self):
         if self.status == "in_progress":
@@ -31,10 +49,165 @@ def format_msg(msg):
     return pprint.pformat(x)
 
 
+class ConcurrencyController:
+    """Additive increase / multiplicative decrease of the per node
+    ssh and rsync slots, below the static config limits.
+    There is always one ssh slot more than rsync slots (unless just one
+    is configured), so sends can't block everything else
+    (compare get_concurrent_rsync_limit).
+
+    Each returned job is judged against the node's history:
+    errors and jobs far slower than the usual latency (ssh) or
+    transfers far below the usual throughput (rsync) halve the slots,
+    every other job adds 1/slots - i.e. one slot per 'round' of jobs.
+    """
+
+    decrease_factor = 0.5
+    # a job is 'slow' if it took more than this times the average
+    slow_factor = 3.0
+    # ...and a transfer 'slow' below this fraction of the average throughput
+    throughput_factor = 0.5
+    # don't judge latencies below this - ssh startup jitter
+    min_latency = 1.0
+    # nor the throughput of smaller transfers - their runtime is mostly
+    # clone/ssh/file list setup, their bytes/second says nothing about the link
+    min_judged_bytes = 256 * 1024 ** 2
+    ewma_weight = 0.2
+    max_adjustments_kept = 100
+
+    def __init__(self, max_ssh, max_rsync):
+        self.max = {"ssh": max_ssh, "rsync": max_rsync}
+        # never above the configured limits
+        self.min = {"ssh": min(2, max_ssh), "rsync": min(1, max_rsync)}
+        self.slots = {}  # node -> {'ssh': float, 'rsync': float}
+        self.latency = {}  # (node, msg type) -> ewma seconds
+        self.throughput = {}  # node -> ewma bytes / second of one transfer
+        self.adjustments = collections.deque(maxlen=self.max_adjustments_kept)
+
+    def _slots(self, node):
+        if node not in self.slots:
+            # start in the middle - the static limits are the upper bounds
+            self.slots[node] = {
+                k: float(max(self.min[k], (v + 1) // 2)) for (k, v) in self.max.items()
+            }
+        return self.slots[node]
+
+    def get_limit(self, node, kind):
+        slots = self._slots(node)
+        if kind == "rsync":
+            # with a single ssh slot configured, there's none to spare
+            return min(int(slots["rsync"]), max(1, int(slots["ssh"]) - 1))
+        return int(slots[kind])
+
+    def _ewma(self, store, key, value):
+        w = self.ewma_weight
+        if key in store:
+            store[key] = (1 - w) * store[key] + w * value
+        else:
+            store[key] = value
+
+    def _adjust(self, node, kind, new_value, reason):
+        slots = self._slots(node)
+        new_value = max(float(self.min[kind]), min(float(self.max[kind]), new_value))
+        if int(new_value) != int(slots[kind]):
+            self.adjustments.append(
+                {
+                    "time": time.time(),
+                    "node": node,
+                    "kind": kind,
+                    "old": int(slots[kind]),
+                    "new": int(new_value),
+                    "reason": reason,
+                }
+            )
+        slots[kind] = new_value
+
+    def job_done(self, node, msg, runtime, result):
+        slots = self._slots(node)
+        kind = "rsync" if msg["msg"] == "send_snapshot" else "ssh"
+        if "error" in result or result.get("ssh_process_return_code", 0) == 255:
+            self._adjust(
+                node,
+                kind,
+                slots[kind] * self.decrease_factor,
+                "error: %s" % result.get("error", "ssh failed"),
+            )
+            return
+        if (
+            kind == "rsync"
+            and result.get("bytes_transferred", 0) >= self.min_judged_bytes
+            and runtime > 0
+        ):
+            rate = result["bytes_transferred"] / runtime
+            usual = self.throughput.get(node)
+            self._ewma(self.throughput, node, rate)
+            if usual is not None and rate < usual * self.throughput_factor:
+                self._adjust(
+                    node,
+                    kind,
+                    slots[kind] * self.decrease_factor,
+                    "throughput %.0f bytes/s, usually %.0f" % (rate, usual),
+                )
+                return
+        elif kind == "ssh":
+            key = (node, msg["msg"])
+            usual = self.latency.get(key)
+            self._ewma(self.latency, key, runtime)
+            if (
+                usual is not None
+                and runtime > self.min_latency
+                and runtime > usual * self.slow_factor
+            ):
+                self._adjust(
+                    node,
+                    kind,
+                    slots[kind] * self.decrease_factor,
+                    "%s took %.1fs, usually %.1fs" % (msg["msg"], runtime, usual),
+                )
+                return
+        self._adjust(node, kind, slots[kind] + 1.0 / slots[kind], "ok")
+        if kind == "rsync":  # which was also a well behaved ssh session
+            self._adjust(node, "ssh", slots["ssh"] + 1.0 / slots["ssh"], "ok")
+
+    def get_status(self):
+        return {
+            "limits": {
+                node: {k: self.get_limit(node, k) for k in slots}
+                for (node, slots) in self.slots.items()
+            },
+            "upper_bounds": dict(self.max),
+            "adjustments": list(self.adjustments),
+        }
+
+
 class OutgoingMessages:
+    # shortest job first: a send's size key halves for every hour it waits
+    sjf_aging_half_life = 3600
+    # sends without an estimate queue as if they were this large
+    unknown_size_estimate = 1024 ** 4
+    # sends with less than this fraction of their ffs:max_lag left
+    # jump their priority class, earliest deadline first
+    deadline_boost_fraction = 0.5
+
     def __init__(self, logger, engine, ssh_cmd):
         self.max_per_host = engine.config.get_ssh_concurrent_connection_limit()
         self.max_rsync_per_host = engine.config.get_concurrent_rsync_limit()
+        # 0 = unlimited
+        self.max_inbound_rsync_per_host = (
+            engine.config.get_concurrent_inbound_rsync_limit()
+        )
+        if engine.config.get_adaptive_concurrency():
+            self.controller = ConcurrencyController(
+                self.max_per_host, self.max_rsync_per_host
+            )
+        else:
+            self.controller = None
+        scheduling = engine.config.get_send_scheduling()
+        self.shortest_job_first = scheduling == "shortest_first"
+        self.fair_queuing = scheduling == "fair"
+        # node -> virtual time, node -> {group: last virtual finish time}
+        self.fair_virtual_time = {}
+        self.fair_last_finish = {}
         self.wait_time_between_requests = engine.config.get_ssh_rate_limit()
         self.last_message_times = {}
         self.logger = logger
@@ -70,7 +243,39 @@ class OutgoingMessages:
         self.send_if_possible()
 
     def prioritize(self, messages):
-        "new,  capture, send, remove_snapshot. Within, order by priority."
+        """new,  capture, send, remove_snapshot. Within, order by priority.
+        Retried sends go before fresh ones of the same priority
+        - they only have the failed units left.
+
+        With shortest job first scheduling, sends of the same priority
+        are ordered by their estimated bytes - including the sends to the same
+        target that have to happen before them - aged by their waiting time.
+
+        Sends nearing their replication lag deadline (ffs:max_lag) go first,
+        earliest deadline first.
+
+        With fair scheduling, sends of the same priority are ordered by
+        their (start time) fair queuing finish tags between the config's fair
+        queuing groups - a send arriving for a quiet group waits for at most
+        one (weighted) send of every other group, no matter how many they queue"""
+        messages = list(messages)
+        now = time.time()
+        if self.fair_queuing:
+            self._assign_fair_tags(messages)
+        size_keys = {}
+        if self.shortest_job_first:
+            cumulative = collections.Counter()
+            for msg in messages:
+                if msg.msg["msg"] != "send_snapshot":
+                    continue
+                group = (msg.msg["ffs"], msg.msg.get("target_node"))
+                cumulative[group] += msg.msg.get(
+                    "estimated_bytes", self.unknown_size_estimate
+                )
+                wait = max(0, now - msg.queued_time)
+                size_keys[id(msg)] = cumulative[group] * 2 ** (
+                    -wait / self.sjf_aging_half_life
+                )
 
         def key(msg):
             order = 100
@@ -88,13 +293,103 @@ class OutgoingMessages:
                 order = 7
             elif msg.msg["msg"] == "send_snapshot":
                 order = 8
-            elif msg.msg["msg"] == "remove_snapshot":
+            elif msg.msg["msg"] in ("remove_snapshot", "remove_snapshots"):
                 order = 9
             prio = int(msg.msg.get("priority", 1000))
-            return (order, prio)
+            retry = 0 if msg.msg.get("retry", 0) else 1
+            deadline = msg.msg.get("deadline", None)
+            if deadline is not None and deadline - now < (
+                msg.msg.get("max_lag", 0) * self.deadline_boost_fraction
+            ):
+                urgency = (0, deadline)
+            else:
+                urgency = (1, 0)
+            return (order,) + urgency + (
+                prio,
+                retry,
+                msg.fair_finish or 0,
+                size_keys.get(id(msg), 0),
+            )
 
         return sorted(messages, key=key)
 
+    def _assign_fair_tags(self, messages):
+        """Start time fair queuing: a new send starts (virtually) once its
+        group's previous send finished, or at the current virtual time - the
+        earliest start among the waiting sends - if the group was idle.
+        It finishes 1/weight later."""
+        config = self.engine.config
+        waiting = [
+            x
+            for x in messages
+            if x.msg["msg"] == "send_snapshot" and x.status == "unsent"
+        ]
+        for node in set([x.node_name for x in waiting]):
+            tagged = [
+                x.fair_start
+                for x in waiting
+                if x.node_name == node and x.fair_start is not None
+            ]
+            virtual_time = self.fair_virtual_time.get(node, 0)
+            if tagged:
+                virtual_time = max(virtual_time, min(tagged))
+            self.fair_virtual_time[node] = virtual_time
+        for x in waiting:
+            if x.fair_start is not None:
+                continue
+            group = config.get_fair_queuing_group(x.msg["ffs"])
+            last_finish = self.fair_last_finish.setdefault(x.node_name, {})
+            x.fair_start = max(
+                self.fair_virtual_time[x.node_name], last_finish.get(group, 0)
+            )
+            x.fair_finish = x.fair_start + 1.0 / config.get_fair_queuing_weight(group)
+            last_finish[group] = x.fair_finish
+
+    def get_limits(self, node):
+        """(ssh, rsync) slots for this node"""
+        if self.controller is None:
+            ssh, rsync = self.max_per_host, self.max_rsync_per_host
+        else:
+            ssh = self.controller.get_limit(node, "ssh")
+            rsync = self.controller.get_limit(node, "rsync")
+        cap = self.engine.get_node_rsync_cap(node)
+        if cap is not None:
+            rsync = min(rsync, cap)
+        return ssh, rsync
+
+    def get_inbound_limit(self, node):
+        """send_snapshots that may run into node at once - 0 = unlimited"""
+        limit = self.max_inbound_rsync_per_host
+        cap = self.engine.get_node_rsync_cap(node)
+        if cap is not None:
+            limit = min(limit, cap) if limit else cap
+        return limit
+
+    def transfer_window_open(self, msg):
+        prio = msg.msg.get("priority", None)
+        return self.engine.config.transfer_window_open(
+            msg.msg["ffs"], msg.node_name, msg.msg.get("target_node"), prio
+        )
+
+    def get_bwlimit(self, node_name, in_progress, msg):
+        """Split the link's budget across the transfers running on it,
+        msg included. A lone transfer gets all of it - the ones
+        already running keep the share they started with.
+        None if unlimited"""
+        target = msg.msg.get("target_node")
+        budget = self.engine.config.get_bandwidth_limit(node_name, target)
+        if not budget:
+            return None
+        on_link = 1 + len(
+            [
+                x
+                for x in in_progress
+                if x.msg["msg"] == "send_snapshot"
+                and x.msg.get("target_node") == target
+            ]
+        )
+        return max(1, budget // on_link)
+
     def send_if_possible(self):
         def any_parent_being_sent(ffs, new_in_progress):
             suffix, _ = os.path.split(ffs)
@@ -113,7 +408,39 @@ class OutgoingMessages:
                     return True
             return False
 
-        for dummy_node_name, outbox in self.outgoing.items():
+        # receiving nodes are shared by all outboxes
+        inbound_in_progress = collections.Counter(
+            x.msg.get("target_node")
+            for outbox in self.outgoing.values()
+            for x in outbox
+            if x.status == "in_progress" and x.msg["msg"] == "send_snapshot"
+        )
+        # sends into one target ffs may come from several nodes (replicas as
+        # source, replication trees) - only one may write at a time, and
+        # in the order they were queued (retries first, they're requeued
+        # behind their successors)
+        next_send_to_target = {}
+        for outbox in self.outgoing.values():
+            for x in outbox:
+                if x.msg["msg"] != "send_snapshot" or x.status not in (
+                    "unsent",
+                    "in_progress",
+                ):
+                    continue
+                target = (x.msg["ffs"], x.msg.get("target_node"))
+                rank = (
+                    x.status != "in_progress",
+                    0 if x.msg.get("retry", 0) else 1,
+                    x.job_id,
+                )
+                if (
+                    target not in next_send_to_target
+                    or rank < next_send_to_target[target][0]
+                ):
+                    next_send_to_target[target] = (rank, x)
+
+        for node_name, outbox in self.outgoing.items():
+            max_per_host, max_rsync_per_host = self.get_limits(node_name)
             unsent = [x for x in outbox if x.status == "unsent"]
             in_progress = [x for x in outbox if x.status == "in_progress"]
             transfers_in_progress = set(
@@ -126,20 +453,42 @@ class OutgoingMessages:
             ]
             if unsent:
                 if (
-                    len(in_progress) < self.max_per_host
+                    len(in_progress) < max_per_host
                 ):  # no need to check anything if we're already at max send capacity
                     for x in self.prioritize(unsent):
-                        if len(in_progress) < self.max_per_host:
+                        if len(in_progress) < max_per_host:
                             if x.msg["msg"] == "send_snapshot":
                                 if (
-                                    len(transfers_in_progress)
-                                    >= self.max_rsync_per_host
+                                    len(transfers_in_progress) >= max_rsync_per_host
                                 ):  # no more concurrent sends than this
                                     continue
                                 if (
                                     x.msg["ffs"] in transfers_in_progress
                                 ):  # only one send per receiving ffs!
                                     continue
+                                if (
+                                    next_send_to_target[
+                                        (x.msg["ffs"], x.msg.get("target_node"))
+                                    ][1]
+                                    is not x
+                                ):  # another node writes / wrote first
+                                    continue
+                                inbound_limit = self.get_inbound_limit(
+                                    x.msg.get("target_node")
+                                )
+                                if (
+                                    inbound_limit
+                                    and inbound_in_progress[x.msg.get("target_node")]
+                                    >= inbound_limit
+                                ):  # receiver is busy - maybe another target isn't
+                                    continue
+                                if not self.transfer_window_open(x):
+                                    continue
+                                bwlimit = self.get_bwlimit(node_name, in_progress, x)
+                                if bwlimit is not None:  # in KiB/s
+                                    x.msg["bwlimit"] = bwlimit
+                                else:
+                                    x.msg.pop("bwlimit", None)
                             elif x.msg["msg"] == "new" and (
                                 any_parent_being_sent(x.msg["ffs"], new_in_progress)
                                 or any_sibling_being_being_sent_before(
@@ -161,6 +510,7 @@ class OutgoingMessages:
                             x.send_time = time.time()
                             if x.msg["msg"] == "send_snapshot":
                                 transfers_in_progress.add(x.msg["ffs"])
+                                inbound_in_progress[x.msg.get("target_node")] += 1
                             if x.msg["msg"] == "new":
                                 new_in_progress.append(x.msg["ffs"])
                         else:
@@ -172,29 +522,41 @@ class OutgoingMessages:
         m = msg.msg.copy()
         m["to"] = msg.node_name
         p = LoggingProcessProtocol(
-            m, msg.job_id, self.job_returned, self.logger, self.running_processes
+            m,
+            msg.job_id,
+            self.job_returned,
+            self.logger,
+            self.running_processes,
+            self.job_progress,
         )
         self.running_processes.append(p)
         reactor.spawnProcess(p, ssh_cmd[0], ssh_cmd, {})
 
-    def job_returned(self, job_id, result):
-        found = None
+    def find_job(self, job_id):
         for msgs in self.outgoing.values():
             for m in msgs:
                 # non sent messages don't have a job_id
                 if hasattr(m, "job_id") and m.job_id == job_id:
-                    found = m
-                    break
-            if found:
-                break
-        if not found:
+                    return m
+        return None
+
+    def job_progress(self, job_id, record):
+        m = self.find_job(job_id)
+        if m is not None and m.status == "in_progress":
+            m.progress = record
+
+    def job_returned(self, job_id, result):
+        m = self.find_job(job_id)
+        if m is None:
             self.logger.error("Job_id %s return, but no such job found", job_id)
             return
-        if found.status != "in_progress":
+        if m.status != "in_progress":
             self.logger.error(
                 "Job_id %s return, but not in progress! - was %s", job_id, m.status
             )
             return
+        if self.controller is not None:
+            self.controller.job_done(m.node_name, m.msg, m.get_runtime(), result)
         try:
             result["from"] = m.node_name
             self.engine.incoming_node(result)
@@ -254,12 +616,24 @@ class OutgoingMessagesDryRun(OutgoingMessages):
 
 
 class LoggingProcessProtocol(protocol.ProcessProtocol):
-    def __init__(self, cmd, job_id, job_done_callback, logger, running_processes):
+    progress_prefix = b"FFS_PROGRESS "
+
+    def __init__(
+        self,
+        cmd,
+        job_id,
+        job_done_callback,
+        logger,
+        running_processes,
+        progress_callback=None,
+    ):
         self.cmd = cmd
         self.job_id = job_id
         self.job_done_calleback = job_done_callback
+        self.progress_callback = progress_callback
         self.stdout = b""
         self.stderr = b""
+        self.partial_stderr_line = b""
         self.logger = logger
         self.running_processes = running_processes
         self.terminated = False
@@ -278,7 +652,22 @@ class LoggingProcessProtocol(protocol.ProcessProtocol):
         self.stdout += data
 
     def errReceived(self, data):
-        self.stderr += data
+        """Progress lines go to progress_callback, everything else is kept"""
+        lines = (self.partial_stderr_line + data).split(b"\n")
+        self.partial_stderr_line = lines.pop()
+        for line in lines:
+            if line.startswith(self.progress_prefix):
+                try:
+                    record = json.loads(
+                        line[len(self.progress_prefix) :].decode("utf-8")
+                    )
+                except ValueError:
+                    self.stderr += line + b"\n"
+                    continue
+                if self.progress_callback is not None:
+                    self.progress_callback(self.job_id, record)
+            else:
+                self.stderr += line + b"\n"
 
     def processEnded(self, reason):
         # self.logger.debug(
@@ -293,6 +682,7 @@ class LoggingProcessProtocol(protocol.ProcessProtocol):
             )
             return
 
+        self.stderr += self.partial_stderr_line
         exit_code = reason.value.exitCode
         # logger.debug("Result: %s" % repr(self.stdout)[:30])
         try:
@@ -29,6 +29,9 @@ class FakeMessageSender:
     def get_messages_for_node(self, receiver):
         return [x for x in self.outgoing if x["to"] == receiver]
 
+    def send_if_possible(self):
+        pass
+
 
 class EngineTests(unittest.TestCase):
     def assertMsgEqualMinusSnapshot(self, actual, supposed):
@@ -847,6 +850,34 @@ class PostStartupTests(EngineTests):
         fm.outgoing.clear()
         return e, fm.outgoing
 
+    def zpool_status(self, e, node, scan="none requested", **pool):
+        """node answers a zpool_status - scan being its pool's scan line,
+        pool the stats (free, capacity, ...) of the pool holding its ffs"""
+        msg = {
+            "from": node,
+            "msg": "zpool_status",
+            "status": "  pool: %s\n state: ONLINE\n  scan: %s\nconfig:\n"
+            % (node, scan),
+        }
+        if pool:
+            msg["pools"] = {node: pool}
+        e.incoming_node(msg)
+
+    def sends_started(self, e, node, target, count=6):
+        """Queue count send_snapshots from node to target in an OutgoingMessages
+        dispatching for e - how many does send_if_possible start?"""
+        om = OutgoingMessageForTesting()
+        om.engine = e
+        om.max_per_host = 10
+        om.max_rsync_per_host = 4
+        for ii in range(count):
+            om.send_message(
+                node,
+                {},
+                {"msg": "send_snapshot", "ffs": "ffs_%i" % ii, "target_node": target},
+            )
+        return len([x for x in om.outgoing[node] if x.status == "in_progress"])
+
 
 class PreStartupRaisesTests(EngineTests):
     def test_new(self):
@@ -1789,6 +1820,7 @@ class CaptureTest(PostStartupTests):
                 "ffs": "one",
                 "snapshot": "a",
                 "target_host": "gamma",
+                "seed": True,
             },
         )
 
@@ -1932,6 +1964,7 @@ class CaptureTest(PostStartupTests):
                 "ffs": "one",
                 "target_host": "alpha",
                 "snapshot": snapshot_name,
+                "seed": True,
             },
         )
         outgoing_messages.clear()
@@ -2102,6 +2135,7 @@ class CaptureTest(PostStartupTests):
                 "ffs": "one",
                 "target_host": "alpha",
                 "snapshot": snapshot_name,
+                "seed": True,
             },
         )
 
@@ -2556,6 +2590,7 @@ class AddTargetTests(PostStartupTests):
                 "to": "beta",
                 "target_host": "gamma",
                 "snapshot": "1",
+                "seed": True,
             },
         )
         self.assertMsgEqualMinusSnapshot(
@@ -2740,6 +2775,7 @@ class AddTargetTests(PostStartupTests):
                 "snapshot": "send-2",
                 "to": "beta",
                 "target_host": "gamma",
+                "seed": True,
             },
         )
         self.assertMsgEqualMinusSnapshot(
@@ -2903,6 +2939,7 @@ class AddTargetTests(PostStartupTests):
                 "ffs": "one",
                 "to": "beta",
                 "target_host": "gamma",
+                "seed": True,
             },
         )
 
@@ -4109,6 +4146,7 @@ class TestStartupTriggeringActions(EngineTests):
                 "target_host": "beta",
                 "ffs": "one",
                 "snapshot": "2",
+                "seed": True,
             },
         )
         self.assertMsgEqualMinusSnapshot(
@@ -4617,6 +4655,9 @@ class MockEngine:
     def incoming_node(self, msg):
         self.node_messages.append(message)
 
+    def get_node_rsync_cap(self, node):
+        return None
+
 
 class OutgoingMessageForTesting(ssh_message_que.OutgoingMessages):
     def __init__(self):
@@ -4737,6 +4778,275 @@ class OutgoingMessageTests(unittest.TestCase):
         # this reflects the submission order, not the send order!
         self.assertEqual(sent[2].msg["msg"], "send_snapshot")
 
+    def test_inbound_rsync_limit_across_senders(self):
+        om = OutgoingMessageForTesting()
+        om.max_inbound_rsync_per_host = 1
+        om.send_message(
+            "alpha", {}, {"msg": "send_snapshot", "ffs": "one", "target_node": "gamma"}
+        )
+        om.send_message(
+            "beta", {}, {"msg": "send_snapshot", "ffs": "two", "target_node": "gamma"}
+        )
+        om.send_message(
+            "beta", {}, {"msg": "send_snapshot", "ffs": "three", "target_node": "delta"}
+        )
+        alpha = om.outgoing["alpha"]
+        beta = om.outgoing["beta"]
+        self.assertEqual(alpha[0].status, "in_progress")
+        # gamma is busy, but beta may send to delta in the mean time
+        self.assertEqual(beta[0].status, "unsent")
+        self.assertEqual(beta[1].status, "in_progress")
+        om.job_returned(alpha[0].job_id, {"msg": "send_snapshot_done"})
+        self.assertEqual(beta[0].status, "in_progress")
+
+    def test_transfer_window_holds_sends(self):
+        om = OutgoingMessageForTesting()
+        window = {"open": False}
+        calls = []
+
+        def transfer_window_open(ffs, source_node, target_node, priority):
+            calls.append((ffs, source_node, target_node, priority))
+            return window["open"] or priority is not None
+
+        om.engine.config.config.transfer_window_open = transfer_window_open
+        om.send_message(
+            "alpha", {}, {"msg": "send_snapshot", "ffs": "one", "target_node": "beta"}
+        )
+        om.send_message(
+            "alpha",
+            {},
+            {
+                "msg": "send_snapshot",
+                "ffs": "two",
+                "target_node": "beta",
+                "priority": 10,
+            },
+        )
+        om.send_message("alpha", {}, {"msg": "capture", "ffs": "one"})
+        out = om.outgoing["alpha"]
+        self.assertEqual(
+            [x.status for x in out], ["unsent", "in_progress", "in_progress"]
+        )
+        self.assertTrue(("one", "alpha", "beta", None) in calls)
+        window["open"] = True
+        om.send_if_possible()
+        self.assertEqual(out[0].status, "in_progress")
+
+    def test_one_writer_per_target_across_senders(self):
+        om = OutgoingMessageForTesting()
+        om.max_per_host = 10
+        om.max_rsync_per_host = 4
+        om.max_inbound_rsync_per_host = 0
+
+        def send(node, ffs, snapshot, **kwargs):
+            msg = {"msg": "send_snapshot", "ffs": ffs, "snapshot": snapshot}
+            msg["target_node"] = "delta"
+            msg.update(kwargs)
+            om.send_message(node, {}, msg)
+
+        # catch up from a replica, the new snapshot from the main
+        send("beta", "one", "1")
+        send("alpha", "one", "2")
+        send("alpha", "two", "2")
+        beta, alpha = om.outgoing["beta"], om.outgoing["alpha"]
+        self.assertEqual(beta[0].status, "in_progress")
+        self.assertEqual([x.status for x in alpha], ["unsent", "in_progress"])
+        # a retry of 1 goes before 2
+        send("beta", "one", "1", retry=1)
+        beta.remove(beta[0])
+        om.send_if_possible()
+        self.assertEqual(beta[0].status, "in_progress")
+        self.assertEqual(alpha[0].status, "unsent")
+        beta.clear()
+        om.send_if_possible()
+        self.assertEqual(alpha[0].status, "in_progress")
+
+    def test_scrubbing_nodes_get_fewer_rsync_slots(self):
+        om = OutgoingMessageForTesting()
+        om.max_per_host = 10
+        om.max_rsync_per_host = 4
+        om.max_inbound_rsync_per_host = 0
+        scrubbing = set(["gamma"])
+        om.engine.get_node_rsync_cap = lambda node: 1 if node in scrubbing else None
+        self.assertEqual(om.get_limits("alpha"), (10, 4))
+        self.assertEqual(om.get_limits("gamma"), (10, 1))
+        self.assertEqual(om.get_inbound_limit("beta"), 0)
+        self.assertEqual(om.get_inbound_limit("gamma"), 1)
+        for ffs, target in [("one", "gamma"), ("two", "gamma"), ("three", "beta")]:
+            om.send_message(
+                "alpha", {}, {"msg": "send_snapshot", "ffs": ffs, "target_node": target}
+            )
+        out = om.outgoing["alpha"]
+        self.assertEqual(
+            [x.status for x in out], ["in_progress", "unsent", "in_progress"]
+        )
+        scrubbing.clear()
+        om.send_if_possible()
+        self.assertEqual(out[1].status, "in_progress")
+
+    def test_bandwidth_budget_split_across_link(self):
+        om = OutgoingMessageForTesting()
+        om.max_rsync_per_host = 4
+        om.max_inbound_rsync_per_host = 2
+        om.engine.config.config.get_bandwidth_limit = (
+            lambda source, target: 1000 if target == "beta" else 0
+        )
+        om.send_message(
+            "alpha", {}, {"msg": "send_snapshot", "ffs": "one", "target_node": "beta"}
+        )
+        om.send_message(
+            "alpha", {}, {"msg": "send_snapshot", "ffs": "two", "target_node": "gamma"}
+        )
+        om.send_message(
+            "alpha",
+            {},
+            {"msg": "send_snapshot", "ffs": "three", "target_node": "beta"},
+        )
+        out = om.outgoing["alpha"]
+        # alone on the alpha->beta link - all of it
+        self.assertEqual(out[0].msg["bwlimit"], 1000)
+        self.assertFalse("bwlimit" in out[1].msg)
+        # the second transfer on it
+        self.assertEqual(out[2].status, "in_progress")
+        self.assertEqual(out[2].msg["bwlimit"], 500)
+
+    def test_progress(self):
+        om = OutgoingMessageForTesting()
+        om.send_message("alpha", {}, {"msg": "send_snapshot", "ffs": "one"})
+        out = om.outgoing["alpha"]
+        self.assertEqual(out[0].get_progress(), None)
+        p = ssh_message_que.LoggingProcessProtocol(
+            {}, out[0].job_id, None, om.logger, [], om.job_progress
+        )
+        # lines may arrive split over several reads
+        p.errReceived(b'some warning\nFFS_PROGRESS {"bytes": 1000, ')
+        self.assertEqual(out[0].get_progress(), None)
+        p.errReceived(b'"files": 3, "bytes_per_second": 100.0, "eta": 20.0}\nother')
+        self.assertEqual(
+            out[0].get_progress(),
+            {"bytes": 1000, "files": 3, "bytes_per_second": 100.0, "eta": 20.0},
+        )
+        self.assertEqual(p.stderr, b"some warning\n")
+
+
+class ConcurrencyControllerTests(EngineTests):
+    def test_additive_increase_up_to_static_limit(self):
+        c = ssh_message_que.ConcurrencyController(6, 4)
+        self.assertEqual(c.get_limit("alpha", "ssh"), 3)
+        self.assertEqual(c.get_limit("alpha", "rsync"), 2)
+        for i in range(100):
+            c.job_done("alpha", {"msg": "capture"}, 0.5, {"msg": "capture_done"})
+        self.assertEqual(c.get_limit("alpha", "ssh"), 6)
+        # other nodes are unaffected
+        self.assertEqual(c.get_limit("beta", "ssh"), 3)
+        self.assertEqual([x["new"] for x in c.get_status()["adjustments"]], [4, 5, 6])
+
+    def test_error_halves(self):
+        c = ssh_message_que.ConcurrencyController(10, 8)
+        for i in range(100):
+            c.job_done(
+                "alpha",
+                {"msg": "send_snapshot"},
+                10,
+                {"msg": "send_snapshot_done", "bytes_transferred": 1000},
+            )
+        self.assertEqual(c.get_limit("alpha", "rsync"), 8)
+        c.job_done("alpha", {"msg": "send_snapshot"}, 10, {"error": "rsync_failure"})
+        self.assertEqual(c.get_limit("alpha", "rsync"), 4)
+        self.assertEqual(
+            c.get_status()["adjustments"][-1]["reason"], "error: rsync_failure"
+        )
+        for i in range(10):
+            c.job_done("alpha", {"msg": "capture"}, 10, {"error": "x"})
+        self.assertEqual(c.get_limit("alpha", "ssh"), 2)
+        # always one ssh slot to spare
+        self.assertEqual(c.get_limit("alpha", "rsync"), 1)
+
+    def test_min_does_not_exceed_configured_limits(self):
+        c = ssh_message_que.ConcurrencyController(1, 1)
+        self.assertEqual(c.get_limit("alpha", "ssh"), 1)
+        self.assertEqual(c.get_limit("alpha", "rsync"), 1)
+        for i in range(10):
+            c.job_done("alpha", {"msg": "capture"}, 10, {"error": "x"})
+        self.assertEqual(c.get_limit("alpha", "ssh"), 1)
+        self.assertEqual(c.get_limit("alpha", "rsync"), 1)
+
+    def test_slow_jobs_decrease(self):
+        c = ssh_message_que.ConcurrencyController(10, 8)
+        for i in range(20):
+            c.job_done("alpha", {"msg": "capture"}, 1.5, {"msg": "capture_done"})
+        before = c.get_limit("alpha", "ssh")
+        c.job_done("alpha", {"msg": "capture"}, 30, {"msg": "capture_done"})
+        self.assertEqual(c.get_limit("alpha", "ssh"), before // 2)
+        for i in range(20):
+            c.job_done(
+                "alpha",
+                {"msg": "send_snapshot"},
+                10,
+                {"msg": "send_snapshot_done", "bytes_transferred": 10 * 1024 ** 3},
+            )
+        before = int(c.slots["alpha"]["rsync"])
+        c.job_done(
+            "alpha",
+            {"msg": "send_snapshot"},
+            10,
+            {"msg": "send_snapshot_done", "bytes_transferred": 1024 ** 3},
+        )
+        self.assertEqual(int(c.slots["alpha"]["rsync"]), before // 2)
+
+    def test_small_sends_are_not_judged(self):
+        c = ssh_message_que.ConcurrencyController(10, 8)
+        for i in range(50):
+            # large sends at 1 GB/s, interleaved with tiny ones that
+            # spend their 5 seconds in setup
+            c.job_done(
+                "alpha",
+                {"msg": "send_snapshot"},
+                10,
+                {"msg": "send_snapshot_done", "bytes_transferred": 10 * 1024 ** 3},
+            )
+            c.job_done(
+                "alpha",
+                {"msg": "send_snapshot"},
+                5,
+                {"msg": "send_snapshot_done", "bytes_transferred": 4096},
+            )
+        self.assertEqual(c.get_limit("alpha", "rsync"), 8)
+        self.assertFalse(
+            [x for x in c.get_status()["adjustments"] if x["reason"] != "ok"]
+        )
+
+    def test_outgoing_messages_use_controller(self):
+        om = OutgoingMessageForTesting()
+        om.controller = ssh_message_que.ConcurrencyController(
+            om.max_per_host, om.max_rsync_per_host
+        )
+        limit = om.controller.get_limit("alpha", "ssh")
+        self.assertTrue(limit < om.max_per_host)
+        for i in range(om.max_per_host):
+            om.send_message("alpha", {}, {"msg": "deploy", "i": i})
+        sent = [x for x in om.outgoing["alpha"] if x.status != "unsent"]
+        self.assertEqual(len(sent), limit)
+        om.job_returned(sent[0].job_id, {"error": "something"})
+        self.assertEqual(om.controller.get_limit("alpha", "ssh"), 2)
+
+    def test_service_concurrency(self):
+        e, outgoing_messages = self.get_engine({"alpha": {"_one": ["1"]}})
+        self.assertEqual(
+            e.client_service_concurrency(),
+            {
+                "adaptive": False,
+                "ssh_limit": 6,
+                "rsync_limit": 2,
+                "inbound_rsync_limit": 0,
+            },
+        )
+        e.sender.controller = ssh_message_que.ConcurrencyController(6, 2)
+        e.sender.controller.job_done("alpha", {"msg": "capture"}, 1, {"error": "x"})
+        res = e.client_service_concurrency()
+        self.assertTrue(res["adaptive"])
+        self.assertEqual(res["limits"], {"alpha": {"ssh": 2, "rsync": 1}})
+
 
 class RenameTests(PostStartupTests):
     def test_rename_non_replicated(self):
@@ -5770,6 +6080,79 @@ class FailureTests(PostStartupTests):
         self.assertEqual(len(informs), 1)
         self.assertEqual(len(complaints), 0)
 
+    def _send_snapshot_failed(self, e):
+        e.incoming_node(
+            {
+                "msg": "send_snapshot_failed",
+                "ffs": "one",
+                "snapshot": "2",
+                "from": "beta",
+                "target_node": "alpha",
+                "units": 12,
+                "failed_units": ['["do_rsync", "sub", true]'],
+                "blocked_units": 3,
+                "failure_counts": {'["do_rsync", "sub", true]': 3},
+                "content": "",
+            }
+        )
+
+    def test_send_snapshot_partial_failure_retries(self):
+        cfg = self._get_test_config()
+        informs = []
+        cfg.inform = lambda x: informs.append(x)
+        e, outgoing_messages = self.get_engine(
+            {"beta": {"_one": ["1", "2"]}, "alpha": {"one": ["1"]}}, config=cfg
+        )
+        self.assertEqual(len(outgoing_messages), 1)
+        self.assertEqual(outgoing_messages[0]["msg"], "send_snapshot")
+        self.assertFalse("retry" in outgoing_messages[0])
+        outgoing_messages.clear()
+        informs.clear()
+        self._send_snapshot_failed(e)
+        self.assertFalse(e.faulted)
+        self.assertEqual(len(informs), 1)
+        self.assertEqual(len(outgoing_messages), 1)
+        self.assertMsgEqualMinusSnapshot(
+            outgoing_messages[0],
+            {
+                "msg": "send_snapshot",
+                "to": "beta",
+                "ffs": "one",
+                "snapshot": "2",
+                "target_host": "alpha",
+                "retry": 1,
+            },
+        )
+        self.assertEqual(e.model["one"]["_snapshots_in_transit"]["2"], 1)
+        e.incoming_node(
+            {
+                "msg": "send_snapshot_done",
+                "ffs": "one",
+                "snapshot": "2",
+                "from": "beta",
+                "target_node": "alpha",
+            }
+        )
+        self.assertEqual(e.model["one"]["alpha"]["snapshots"], ["1", "2"])
+        self.assertFalse(e.send_snapshot_failures)
+
+    def test_send_snapshot_failure_faults_after_retry_limit(self):
+        class RetryOnceConfig(default_config.DefaultConfig):
+            def get_send_snapshot_retry_limit(self):
+                return 1
+
+        e, outgoing_messages = self.get_engine(
+            {"beta": {"_one": ["1", "2"]}, "alpha": {"one": ["1"]}},
+            config=RetryOnceConfig(),
+        )
+        outgoing_messages.clear()
+        self._send_snapshot_failed(e)
+        self.assertEqual(outgoing_messages[0]["retry"], 1)
+        self.assertRaises(
+            engine.ManualInterventionNeeded, self._send_snapshot_failed, e
+        )
+        self.assertTrue(e.faulted)
+
 
 class ReadOnlyHostTests(PostStartupTests):
     def ge(self):
@@ -6045,6 +6428,34 @@ class PriorityTests(PostStartupTests):
         self.assertEqual(ordered[5], msgs[1])
         self.assertEqual(ordered[6], msgs[0])
 
+    def test_prio_retried_sends_first(self):
+        e, outgoing_messages = self.get_engine(
+            {"beta": {"_one": ["1"]}, "alpha": {"one": ["1"]}}
+        )
+
+        o = ssh_message_que.OutgoingMessages(None, e, None)
+        msgs = [
+            ssh_message_que.MessageInProgress(
+                "node1",
+                {},
+                {"msg": "send_snapshot", "ffs": "b", "snapshot": "a", "priority": 10},
+            ),
+            ssh_message_que.MessageInProgress(
+                "node1",
+                {},
+                {"msg": "send_snapshot", "ffs": "c", "snapshot": "a", "retry": 1},
+            ),
+            ssh_message_que.MessageInProgress(
+                "node1", {}, {"msg": "capture", "ffs": "b"}
+            ),
+            ssh_message_que.MessageInProgress(
+                "node1", {}, {"msg": "send_snapshot", "ffs": "d", "snapshot": "a"}
+            ),
+        ]
+        ordered = list(o.prioritize(msgs))
+        # but only within their priority
+        self.assertEqual(ordered, [msgs[2], msgs[0], msgs[1], msgs[3]])
+
     def test_prio_inheritance(self):
         e, outgoing_messages = self.get_engine(
             {
@@ -6087,6 +6498,2302 @@ class PriorityTests(PostStartupTests):
         self.assertTrue(outgoing_messages[0]["msg"] == "send_snapshot")
 
 
+class TransportTests(PostStartupTests):
+    def capture(
+        self, e, outgoing_messages, ffs="one", main="alpha", guid=None, postfix=""
+    ):
+        e.incoming_client({"msg": "capture", "ffs": ffs, "postfix": postfix})
+        sn = outgoing_messages[-1]["snapshot"]
+        outgoing_messages.clear()
+        msg = {"msg": "capture_done", "from": main, "ffs": ffs, "snapshot": sn}
+        if guid is not None:
+            msg["guid"] = guid
+        e.incoming_node(msg)
+        return sn
+
+    def set_guids(self, e, ffs, node, guids):
+        e.model[ffs][node]["snapshot_guids"] = guids
+
+    def test_default_is_rsync(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["a"]}, "beta": {"one": ["a"]}}
+        )
+        sn = self.capture(e, outgoing_messages)
+        self.assertEqual(outgoing_messages[0]["msg"], "send_snapshot")
+        self.assertEqual(outgoing_messages[0]["snapshot"], sn)
+        self.assertFalse("transport" in outgoing_messages[0])
+        self.assertFalse("incremental_base" in outgoing_messages[0])
+
+    def test_zfs_send_with_common_snapshot(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["a", "b", ("ffs:transport", "zfs_send")]},
+                "beta": {"one": ["a", "b", ("ffs:transport", "zfs_send")]},
+            }
+        )
+        self.set_guids(e, "one", "alpha", {"a": "1", "b": "2"})
+        self.set_guids(e, "one", "beta", {"a": "1", "b": "2"})
+        sn = self.capture(e, outgoing_messages)
+        self.assertMsgEqualMinusSnapshot(
+            outgoing_messages[0],
+            {
+                "msg": "send_snapshot",
+                "to": "alpha",
+                "ffs": "one",
+                "snapshot": sn,
+                "target_host": "beta",
+                "transport": "zfs_send",
+                "incremental_base": "b",
+            },
+        )
+
+    def test_zfs_send_chains_on_queued_sends(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["a", ("ffs:transport", "zfs_send")]},
+                "beta": {"one": ["a", ("ffs:transport", "zfs_send")]},
+            }
+        )
+        self.set_guids(e, "one", "alpha", {"a": "1"})
+        self.set_guids(e, "one", "beta", {"a": "1"})
+        sn1 = self.capture(e, outgoing_messages, guid="2", postfix="-1")
+        self.assertEqual(outgoing_messages[0]["incremental_base"], "a")
+        # not via capture() - that would clear the queued send
+        e.incoming_client({"msg": "capture", "ffs": "one", "postfix": "-2"})
+        sn2 = outgoing_messages[-1]["snapshot"]
+        e.incoming_node(
+            {
+                "msg": "capture_done",
+                "from": "alpha",
+                "ffs": "one",
+                "snapshot": sn2,
+                "guid": "3",
+            }
+        )
+        self.assertEqual(outgoing_messages[-1]["snapshot"], sn2)
+        self.assertEqual(outgoing_messages[-1]["incremental_base"], sn1)
+
+    def test_zfs_send_not_chained_on_queued_rsync(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["a", "b", "c", ("ffs:transport", "zfs_send")]},
+                "beta": {"one": ["a", ("ffs:transport", "zfs_send")]},
+            }
+        )
+        # no guids known - b goes via rsync, so c can't build on it
+        self.assertEqual(len(outgoing_messages), 2)
+        self.assertFalse("transport" in outgoing_messages[0])
+        self.assertFalse("transport" in outgoing_messages[1])
+
+    def test_zfs_send_skips_rsync_seeded_replica(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["a", ("ffs:transport", "zfs_send")]},
+                "beta": {"one": [("ffs:transport", "zfs_send")]},
+                "gamma": {"one": [("ffs:transport", "zfs_send")]},
+            }
+        )
+        outgoing_messages.clear()
+        self.set_guids(e, "one", "alpha", {"a": "1"})
+        # beta got 'a' by rsync/tar seed - same name, different zfs snapshot
+        e.model["one"]["beta"]["snapshots"].append("a")
+        e.model["one"]["beta"]["snapshot_guids"] = {"a": "7"}
+        # gamma got it by a zfs send
+        e.model["one"]["gamma"]["snapshots"].append("a")
+        e.model["one"]["gamma"]["snapshot_guids"] = {"a": "1"}
+        sn = self.capture(e, outgoing_messages, guid="2")
+        by_target = dict((x["target_host"], x) for x in outgoing_messages)
+        self.assertFalse("transport" in by_target["beta"])
+        self.assertFalse("incremental_base" in by_target["beta"])
+        self.assertEqual(by_target["gamma"]["transport"], "zfs_send")
+        self.assertEqual(by_target["gamma"]["incremental_base"], "a")
+
+    def test_rsync_send_done_forgets_guid(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["a", ("ffs:transport", "zfs_send")]},
+                "beta": {"one": ["a", ("ffs:transport", "zfs_send")]},
+            }
+        )
+        self.set_guids(e, "one", "alpha", {"a": "1"})
+        self.set_guids(e, "one", "beta", {"a": "1"})
+        sn = self.capture(e, outgoing_messages, guid="2")
+        e.incoming_node(
+            {
+                "msg": "send_snapshot_done",
+                "from": "alpha",
+                "ffs": "one",
+                "snapshot": sn,
+                "target_node": "beta",
+                "transport": "zfs_send",
+            }
+        )
+        self.assertEqual(e.model["one"]["beta"]["snapshot_guids"][sn], "2")
+        sn2 = self.capture(e, outgoing_messages, guid="3", postfix="-2")
+        e.incoming_node(
+            {
+                "msg": "send_snapshot_done",
+                "from": "alpha",
+                "ffs": "one",
+                "snapshot": sn2,
+                "target_node": "beta",
+                "transport": "rsync",
+            }
+        )
+        self.assertFalse(sn2 in e.model["one"]["beta"]["snapshot_guids"])
+
+    def test_zfs_send_no_common_snapshot_falls_back_to_rsync(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["b", ("ffs:transport", "zfs_send")]},
+                "beta": {"one": ["a", ("ffs:transport", "zfs_send")]},
+            }
+        )
+        outgoing_messages.clear()
+        self.capture(e, outgoing_messages)
+        self.assertEqual(outgoing_messages[0]["msg"], "send_snapshot")
+        self.assertFalse("transport" in outgoing_messages[0])
+
+    def test_zfs_send_empty_target_full_stream(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": [("ffs:transport", "zfs_send")]},
+                "beta": {"one": [("ffs:transport", "zfs_send")]},
+            }
+        )
+        outgoing_messages.clear()
+        self.capture(e, outgoing_messages)
+        self.assertEqual(outgoing_messages[0]["msg"], "send_snapshot")
+        self.assertEqual(outgoing_messages[0]["transport"], "zfs_send")
+        self.assertFalse("incremental_base" in outgoing_messages[0])
+        self.assertTrue(outgoing_messages[0]["seed"])  # the fallback
+
+    def test_seed_only_for_empty_target(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["a", "b"]}, "beta": {"one": []}}
+        )
+        self.assertEqual(len(outgoing_messages), 2)
+        self.assertTrue(outgoing_messages[0]["seed"])
+        self.assertFalse("seed" in outgoing_messages[1])
+
+    def test_no_seed_on_populated_target(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["a"]}, "beta": {"one": ["a"]}}
+        )
+        self.capture(e, outgoing_messages)
+        self.assertFalse("seed" in outgoing_messages[0])
+
+    def test_zfs_send_ignored_with_config_excludes(self):
+        config = self._get_test_config()
+        config.exclude_subdirs_callback = lambda ffs, source_node, target_node: [
+            "donotsync"
+        ]
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["a", ("ffs:transport", "zfs_send")]},
+                "beta": {"one": ["a", ("ffs:transport", "zfs_send")]},
+            },
+            config=config,
+        )
+        self.capture(e, outgoing_messages)
+        self.assertFalse("transport" in outgoing_messages[0])
+
+    def test_invalid_transport_raises_on_startup(self):
+        def inner():
+            e, outgoing_messages = self.get_engine(
+                {"beta": {"_one": ["1", ("ffs:transport", "carrier_pigeon")]}}
+            )
+
+        self.assertRaises(engine.ManualInterventionNeeded, inner)
+
+    def test_client_set_transport(self):
+        e, outgoing_messages = self.get_engine(
+            {"beta": {"_one": ["1"]}, "alpha": {"one": ["1"]}}
+        )
+        e.incoming_client(
+            {"msg": "set_transport", "ffs": "one", "transport": "zfs_send"}
+        )
+        self.assertEqual(len(outgoing_messages), 2)
+        self.assertMsgEqual(
+            outgoing_messages[0],
+            {
+                "msg": "set_properties",
+                "to": "alpha",
+                "ffs": "one",
+                "properties": {"ffs:transport": "zfs_send"},
+            },
+        )
+
+        def inner():
+            e.incoming_client(
+                {"msg": "set_transport", "ffs": "one", "transport": "ftp"}
+            )
+
+        self.assertRaises(ValueError, inner)
+
+
+class ReplicaSourceTests(PostStartupTests):
+    def _get_replica_config(self):
+        cfg = self._get_test_config()
+        cfg.use_replicas_as_source = lambda: True
+        return cfg
+
+    def test_off_by_default(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1", "2"], "_two": ["1", "2"]},
+                "beta": {"one": ["1", "2"], "two": ["1", "2"]},
+                "gamma": {"one": ["1"], "two": ["1"]},
+            }
+        )
+        self.assertEqual(len(outgoing_messages), 2)
+        self.assertEqual(set([x["to"] for x in outgoing_messages]), set(["alpha"]))
+
+    def test_tie_goes_to_main(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1", "2"]},
+                "beta": {"one": ["1", "2"]},
+                "gamma": {"one": ["1"]},
+            },
+            config=self._get_replica_config(),
+        )
+        self.assertEqual(len(outgoing_messages), 1)
+        self.assertEqual(outgoing_messages[0]["to"], "alpha")
+        self.assertFalse("source_is_readonly" in outgoing_messages[0])
+
+    def test_least_loaded_replica_sends(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1", "2"], "_two": ["1", "2"]},
+                "beta": {"one": ["1", "2"], "two": ["1", "2"]},
+                "gamma": {"one": ["1"], "two": ["1"]},
+            },
+            config=self._get_replica_config(),
+        )
+        self.assertEqual(len(outgoing_messages), 2)
+        by_sender = {x["to"]: x for x in outgoing_messages}
+        self.assertEqual(set(by_sender), set(["alpha", "beta"]))
+        self.assertTrue(by_sender["beta"]["source_is_readonly"])
+        self.assertEqual(by_sender["beta"]["target_node"], "gamma")
+        ffs = by_sender["beta"]["ffs"]
+        # further sends to gamma stay with beta - no two rsyncs into one target
+        self.assertEqual(e._pick_sending_node(ffs, "gamma", ["2"]), "beta")
+        # replicas lacking a snapshot are no candidates
+        self.assertEqual(e._pick_sending_node(ffs, "beta", ["3"]), "alpha")
+
+        e.incoming_node(
+            {
+                "msg": "send_snapshot_done",
+                "ffs": ffs,
+                "snapshot": "2",
+                "from": "beta",
+                "target_node": "gamma",
+            }
+        )
+        self.assertFalse(e.faulted)
+        self.assertEqual(e.model[ffs]["gamma"]["snapshots"], ["1", "2"])
+
+
+class ReplicationTopologyTests(PostStartupTests):
+    def _get_fanout_config(self, fanout):
+        cfg = self._get_test_config()
+        cfg.get_replication_fanout = lambda ffs: fanout
+        return cfg
+
+    def capture(self, e, outgoing_messages):
+        e.incoming_client({"msg": "capture", "ffs": "one"})
+        sn = outgoing_messages[-1]["snapshot"]
+        outgoing_messages.clear()
+        e.incoming_node(
+            {"msg": "capture_done", "from": "alpha", "ffs": "one", "snapshot": sn}
+        )
+        return sn
+
+    def send_done(self, e, sender, target, sn):
+        e.incoming_node(
+            {
+                "msg": "send_snapshot_done",
+                "ffs": "one",
+                "snapshot": sn,
+                "from": sender,
+                "target_node": target,
+            }
+        )
+
+    def test_chain(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"]},
+                "beta": {"one": ["1"]},
+                "gamma": {"one": ["1"]},
+                "delta": {"one": ["1"]},
+            },
+            config=self._get_fanout_config(1),
+        )
+        sn = self.capture(e, outgoing_messages)
+        sends = [x for x in outgoing_messages if x["msg"] == "send_snapshot"]
+        self.assertEqual(len(sends), 1)
+        self.assertEqual((sends[0]["to"], sends[0]["target_node"]), ("alpha", "beta"))
+        outgoing_messages.clear()
+        self.send_done(e, "alpha", "beta", sn)
+        sends = [x for x in outgoing_messages if x["msg"] == "send_snapshot"]
+        self.assertEqual(len(sends), 1)
+        self.assertEqual((sends[0]["to"], sends[0]["target_node"]), ("beta", "delta"))
+        self.assertTrue(sends[0]["source_is_readonly"])
+        # still in transit - must not be pruned in between hops
+        self.assertEqual(e.model["one"]["_snapshots_in_transit"][sn], 1)
+        outgoing_messages.clear()
+        self.send_done(e, "beta", "delta", sn)
+        sends = [x for x in outgoing_messages if x["msg"] == "send_snapshot"]
+        self.assertEqual((sends[0]["to"], sends[0]["target_node"]), ("delta", "gamma"))
+        outgoing_messages.clear()
+        self.send_done(e, "delta", "gamma", sn)
+        sends = [x for x in outgoing_messages if x["msg"] == "send_snapshot"]
+        self.assertEqual(sends, [])
+        self.assertFalse(sn in e.model["one"]["_snapshots_in_transit"])
+
+    def test_tree(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"]},
+                "beta": {"one": ["1"]},
+                "gamma": {"one": ["1"]},
+                "delta": {"one": ["1"]},
+                "epsilon": {"one": ["1"]},
+            },
+            config=self._get_fanout_config(2),
+        )
+        sn = self.capture(e, outgoing_messages)
+        sends = [x for x in outgoing_messages if x["msg"] == "send_snapshot"]
+        self.assertEqual(sorted([x["target_node"] for x in sends]), ["beta", "delta"])
+        outgoing_messages.clear()
+        self.send_done(e, "alpha", "delta", sn)
+        sends = [x for x in outgoing_messages if x["msg"] == "send_snapshot"]
+        self.assertEqual([x["target_node"] for x in sends], [])
+        self.send_done(e, "alpha", "beta", sn)
+        sends = [x for x in outgoing_messages if x["msg"] == "send_snapshot"]
+        self.assertEqual(
+            sorted([(x["to"], x["target_node"]) for x in sends]),
+            [("beta", "epsilon"), ("beta", "gamma")],
+        )
+
+    def test_catch_up_from_parent(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1", "2"]},
+                "beta": {"one": ["1", "2"]},
+                "gamma": {"one": ["1"]},
+            },
+            config=self._get_fanout_config(1),
+        )
+        self.assertEqual(len(outgoing_messages), 1)
+        self.assertEqual(outgoing_messages[0]["to"], "beta")
+        self.assertEqual(outgoing_messages[0]["target_node"], "gamma")
+
+    def test_no_forward_while_catching_up_from_main(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1", "2"]},
+                "beta": {"one": ["1"]},
+                "gamma": {"one": []},
+            },
+            config=self._get_fanout_config(1),
+        )
+        self.assertEqual(
+            sorted(
+                [(x["to"], x["target_node"], x["snapshot"]) for x in outgoing_messages]
+            ),
+            [("alpha", "beta", "2"), ("alpha", "gamma", "1"), ("alpha", "gamma", "2")],
+        )
+        # the gamma sends are still queued
+        e.incoming_client({"msg": "capture", "ffs": "one"})
+        sn = outgoing_messages[-1]["snapshot"]
+        e.incoming_node(
+            {"msg": "capture_done", "from": "alpha", "ffs": "one", "snapshot": sn}
+        )
+        self.send_done(e, "alpha", "beta", "2")
+        self.send_done(e, "alpha", "beta", sn)
+        # gamma is still being fed by alpha - beta must not write into it as well
+        self.assertEqual(
+            [
+                (x["to"], x["snapshot"])
+                for x in outgoing_messages
+                if x["msg"] == "send_snapshot" and x["target_node"] == "gamma"
+            ],
+            [("alpha", "1"), ("alpha", "2"), ("alpha", sn)],
+        )
+
+    def test_lagging_parent_falls_back_to_main(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1", "2"]},
+                "beta": {"one": ["1"]},
+                "gamma": {"one": ["1"]},
+            },
+            config=self._get_fanout_config(1),
+        )
+        self.assertEqual(
+            sorted([(x["to"], x["target_node"]) for x in outgoing_messages]),
+            [("alpha", "beta"), ("alpha", "gamma")],
+        )
+        before = len(outgoing_messages)
+        # gamma's copy is already on it's way - beta does not forward it
+        self.send_done(e, "alpha", "beta", "2")
+        self.assertEqual(
+            [x for x in outgoing_messages[before:] if x["msg"] == "send_snapshot"],
+            [],
+        )
+
+
+class SizeEstimateTests(PostStartupTests):
+    def _get_sjf_config(self):
+        cfg = self._get_test_config()
+        cfg.get_send_scheduling = lambda: "shortest_first"
+        return cfg
+
+    def _send(self, ffs, estimated_bytes=None, target="beta", **kwargs):
+        msg = {
+            "msg": "send_snapshot",
+            "ffs": ffs,
+            "snapshot": "a",
+            "target_node": target,
+        }
+        if estimated_bytes is not None:
+            msg["estimated_bytes"] = estimated_bytes
+        msg.update(kwargs)
+        return ssh_message_que.MessageInProgress("alpha", {}, msg)
+
+    def test_capture_done_stores_sizes(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {"one": ["1"]}}
+        )
+        e.incoming_client({"msg": "capture", "ffs": "one"})
+        sn = outgoing_messages[-1]["snapshot"]
+        outgoing_messages.clear()
+        e.incoming_node(
+            {
+                "msg": "capture_done",
+                "from": "alpha",
+                "ffs": "one",
+                "snapshot": sn,
+                "used": 50,
+                "written": 100,
+            }
+        )
+        self.assertEqual(
+            e.model["one"]["alpha"]["snapshot_sizes"][sn], {"used": 50, "written": 100}
+        )
+        self.assertEqual(outgoing_messages[0]["msg"], "send_snapshot")
+        self.assertEqual(outgoing_messages[0]["estimated_bytes"], 100)
+        e.incoming_node(
+            {
+                "msg": "send_snapshot_done",
+                "from": "alpha",
+                "ffs": "one",
+                "target_node": "beta",
+                "snapshot": sn,
+            }
+        )
+        self.assertEqual(
+            e.model["one"]["beta"]["snapshot_sizes"][sn], {"used": 50, "written": 100}
+        )
+        e.incoming_node(
+            {
+                "msg": "remove_snapshot_done",
+                "from": "beta",
+                "ffs": "one",
+                "snapshot": sn,
+            }
+        )
+        self.assertFalse(sn in e.model["one"]["beta"]["snapshot_sizes"])
+
+    def test_no_estimate_without_sizes(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1", "2"]}, "beta": {"one": ["1"]}}
+        )
+        self.assertEqual(len(outgoing_messages), 1)
+        self.assertFalse("estimated_bytes" in outgoing_messages[0])
+        self.assertEqual(e._estimate_send_bytes("alpha", "beta", "one", "2"), None)
+
+    def test_estimate_sums_written(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1", "2", "3"]},
+                "beta": {"one": []},
+                "gamma": {"one": ["1"]},
+            }
+        )
+        outgoing_messages.clear()
+        e.model["one"]["alpha"]["snapshot_sizes"] = {
+            "1": {"used": 0, "written": 1000},
+            "2": {"used": 0, "written": 20},
+            "3": {"used": 0, "written": 3},
+        }
+        # full send: everything up to the snapshot
+        self.assertEqual(e._estimate_send_bytes("alpha", "beta", "one", "2"), 1020)
+        # incremental: only what came after the receiver's newest snapshot
+        self.assertEqual(e._estimate_send_bytes("alpha", "gamma", "one", "3"), 23)
+
+    def test_default_is_first_come_first_served(self):
+        e, outgoing_messages = self.get_engine({"alpha": {"_one": ["1"]}})
+        o = ssh_message_que.OutgoingMessages(None, e, None)
+        msgs = [self._send("a", 1000), self._send("b", 10)]
+        self.assertEqual(o.prioritize(msgs), msgs)
+
+    def test_smallest_first(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}}, config=self._get_sjf_config()
+        )
+        o = ssh_message_que.OutgoingMessages(None, e, None)
+        msgs = [
+            self._send("unknown"),
+            self._send("a", 1000),
+            self._send("b", 10),
+            ssh_message_que.MessageInProgress(
+                "alpha", {}, {"msg": "capture", "ffs": "b"}
+            ),
+        ]
+        self.assertEqual(o.prioritize(msgs), [msgs[3], msgs[2], msgs[1], msgs[0]])
+
+    def test_priority_beats_size(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}}, config=self._get_sjf_config()
+        )
+        o = ssh_message_que.OutgoingMessages(None, e, None)
+        msgs = [self._send("a", 10), self._send("b", 1000, priority=1)]
+        self.assertEqual(o.prioritize(msgs), [msgs[1], msgs[0]])
+
+    def test_same_target_keeps_snapshot_order(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}}, config=self._get_sjf_config()
+        )
+        o = ssh_message_que.OutgoingMessages(None, e, None)
+        msgs = [
+            self._send("a", 10),
+            self._send("a", 1),
+            self._send("b", 5),
+            self._send("a", 1, target="gamma"),
+        ]
+        # the second 'a' to beta can not go before the first one
+        self.assertEqual(o.prioritize(msgs), [msgs[3], msgs[2], msgs[0], msgs[1]])
+
+    def test_aging(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}}, config=self._get_sjf_config()
+        )
+        o = ssh_message_que.OutgoingMessages(None, e, None)
+        msgs = [self._send("a", 1000), self._send("b", 10)]
+        self.assertEqual(o.prioritize(msgs), [msgs[1], msgs[0]])
+        # waited ten half lifes -> 1000 / 1024 < 10
+        msgs[0].queued_time -= 10 * o.sjf_aging_half_life
+        self.assertEqual(o.prioritize(msgs), [msgs[0], msgs[1]])
+
+    def test_invalid_scheduling(self):
+        cfg = self._get_test_config()
+        cfg.get_send_scheduling = lambda: "random"
+        e, outgoing_messages = self.get_engine({"alpha": {"_one": ["1"]}}, config=cfg)
+        self.assertRaises(
+            ValueError, lambda: ssh_message_que.OutgoingMessages(None, e, None)
+        )
+
+
+class ReplicationLagTests(PostStartupTests):
+    def capture(self, e, outgoing_messages):
+        e.incoming_client({"msg": "capture", "ffs": "one"})
+        sn = outgoing_messages[-1]["snapshot"]
+        outgoing_messages.clear()
+        e.incoming_node(
+            {"msg": "capture_done", "from": "alpha", "ffs": "one", "snapshot": sn}
+        )
+        return sn
+
+    def _send(self, ffs, priority=1000, **kwargs):
+        msg = {
+            "msg": "send_snapshot",
+            "ffs": ffs,
+            "snapshot": "a",
+            "priority": priority,
+        }
+        msg.update(kwargs)
+        return ssh_message_que.MessageInProgress("alpha", {}, msg)
+
+    def test_set_max_lag(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {"one": ["1"]}}
+        )
+        outgoing_messages.clear()
+        e.incoming_client({"msg": "set_max_lag", "ffs": "one", "max_lag": 600})
+        self.assertEqual(len(outgoing_messages), 2)
+        for x in outgoing_messages:
+            self.assertEqual(x["msg"], "set_properties")
+            self.assertEqual(x["properties"], {"ffs:max_lag": "600"})
+        outgoing_messages.clear()
+        e.incoming_client({"msg": "set_max_lag", "ffs": "one", "max_lag": 0})
+        self.assertEqual(outgoing_messages[0]["properties"], {"ffs:max_lag": "-"})
+        self.assertRaises(
+            ValueError,
+            e.incoming_client,
+            {"msg": "set_max_lag", "ffs": "one", "max_lag": -1},
+        )
+        self.assertRaises(
+            ValueError,
+            e.incoming_client,
+            {"msg": "set_max_lag", "ffs": "one", "max_lag": "600"},
+        )
+
+    def test_invalid_max_lag_property(self):
+        def inner():
+            self.get_engine(
+                {
+                    "alpha": {"_one": ["1", ("ffs:max_lag", "soon")]},
+                    "beta": {"one": ["1", ("ffs:max_lag", "soon")]},
+                }
+            )
+
+        self.assertRaises(engine.ManualInterventionNeeded, inner)
+
+    def test_lag_report(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1", ("ffs:max_lag", "600")]},
+                "beta": {"one": ["1", ("ffs:max_lag", "600")]},
+            }
+        )
+        res = e.incoming_client({"msg": "service_replication_lag"})
+        self.assertEqual(res["one"]["lag"], 0)
+        self.assertEqual(res["one"]["max_lag"], 600)
+        self.assertEqual(
+            res["one"]["targets"]["beta"],
+            {
+                "lag": 0,
+                "oldest_missing": None,
+                "last_arrival": None,
+                "over_max_lag": False,
+            },
+        )
+        sn = self.capture(e, outgoing_messages)
+        e.capture_times["one", sn] -= 1000
+        res = e.incoming_client({"msg": "service_replication_lag", "ffs": "one"})
+        beta = res["one"]["targets"]["beta"]
+        self.assertEqual(beta["oldest_missing"], sn)
+        self.assertTrue(beta["lag"] >= 1000)
+        self.assertTrue(beta["over_max_lag"])
+        e.incoming_node(
+            {
+                "msg": "send_snapshot_done",
+                "from": "alpha",
+                "ffs": "one",
+                "target_node": "beta",
+                "snapshot": sn,
+            }
+        )
+        res = e.incoming_client({"msg": "service_replication_lag"})
+        beta = res["one"]["targets"]["beta"]
+        self.assertEqual(beta["lag"], 0)
+        self.assertFalse(beta["over_max_lag"])
+        self.assertTrue(beta["last_arrival"] is not None)
+
+    def test_lag_from_snapshot_name(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["ffs-2020-01-01-00-00-00", "unparsable"]},
+                "beta": {"one": []},
+                "gamma": {"one": ["ffs-2020-01-01-00-00-00"]},
+            }
+        )
+        res = e.incoming_client({"msg": "service_replication_lag"})
+        self.assertTrue(res["one"]["targets"]["beta"]["lag"] > 365 * 24 * 3600)
+        self.assertEqual(res["one"]["targets"]["gamma"]["lag"], None)
+        self.assertEqual(res["one"]["max_lag"], None)
+        self.assertFalse(res["one"]["targets"]["beta"]["over_max_lag"])
+
+    def test_send_carries_deadline(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1", ("ffs:max_lag", "600")]},
+                "beta": {"one": ["1", ("ffs:max_lag", "600")]},
+            }
+        )
+        sn = self.capture(e, outgoing_messages)
+        self.assertEqual(outgoing_messages[0]["msg"], "send_snapshot")
+        self.assertEqual(outgoing_messages[0]["max_lag"], 600)
+        self.assertEqual(
+            outgoing_messages[0]["deadline"], e.capture_times["one", sn] + 600
+        )
+
+    def test_no_deadline_without_max_lag(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {"one": ["1"]}}
+        )
+        self.capture(e, outgoing_messages)
+        self.assertFalse("deadline" in outgoing_messages[0])
+
+    def test_max_lag_cloned_to_new_targets(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1", ("ffs:max_lag", "600")]}, "beta": {}}
+        )
+        outgoing_messages.clear()
+        e.incoming_client({"msg": "add_targets", "ffs": "one", "targets": ["beta"]})
+        self.assertEqual(outgoing_messages[0]["msg"], "new")
+        self.assertEqual(outgoing_messages[0]["properties"]["ffs:max_lag"], "600")
+
+    def test_prio_deadline_boost(self):
+        e, outgoing_messages = self.get_engine({"alpha": {"_one": ["1"]}})
+        o = ssh_message_que.OutgoingMessages(None, e, None)
+        now = time.time()
+        msgs = [
+            self._send("a", priority=1),
+            # plenty of time left - stays in its priority place
+            self._send("b", priority=2000, max_lag=600, deadline=now + 500),
+            # close to the deadline, jumps the priority
+            self._send("c", priority=2000, max_lag=600, deadline=now + 200),
+            # already late - earliest deadline first
+            self._send("d", priority=2000, max_lag=600, deadline=now - 100),
+            ssh_message_que.MessageInProgress(
+                "alpha", {}, {"msg": "capture", "ffs": "b"}
+            ),
+        ]
+        self.assertEqual(
+            o.prioritize(msgs), [msgs[4], msgs[3], msgs[2], msgs[0], msgs[1]]
+        )
+
+
+class FairQueuingTests(PostStartupTests):
+    def _send(self, ffs, priority=1000):
+        return ssh_message_que.MessageInProgress(
+            "alpha",
+            {},
+            {
+                "msg": "send_snapshot",
+                "ffs": ffs,
+                "snapshot": "a",
+                "priority": priority,
+            },
+        )
+
+    def test_round_robin_between_ffs(self):
+        cfg = self._get_test_config()
+        cfg.get_send_scheduling = lambda: "fair"
+        e, outgoing_messages = self.get_engine({"alpha": {"_one": ["1"]}}, config=cfg)
+        o = ssh_message_que.OutgoingMessages(None, e, None)
+        msgs = [
+            self._send("a"),
+            self._send("a"),
+            self._send("a"),
+            self._send("b"),
+            self._send("c", priority=10),
+        ]
+        self.assertEqual(
+            o.prioritize(msgs), [msgs[4], msgs[0], msgs[3], msgs[1], msgs[2]]
+        )
+
+    def test_off_by_default(self):
+        e, outgoing_messages = self.get_engine({"alpha": {"_one": ["1"]}})
+        o = ssh_message_que.OutgoingMessages(None, e, None)
+        msgs = [self._send("a"), self._send("a"), self._send("b")]
+        self.assertEqual(o.prioritize(msgs), msgs)
+
+    def test_late_group_does_not_wait_for_backlog(self):
+        cfg = self._get_test_config()
+        cfg.get_send_scheduling = lambda: "fair"
+        e, outgoing_messages = self.get_engine({"alpha": {"_one": ["1"]}}, config=cfg)
+        o = ssh_message_que.OutgoingMessages(None, e, None)
+        msgs = [self._send("a"), self._send("a"), self._send("a")]
+        self.assertEqual(o.prioritize(msgs), msgs)
+        msgs[0].status = "in_progress"  # started
+        late = self._send("b")
+        # 'b' only waits for one of a's sends, not for a's whole backlog
+        self.assertEqual(o.prioritize(msgs[1:] + [late]), [msgs[1], late, msgs[2]])
+
+    def test_weighted_groups(self):
+        cfg = self._get_test_config()
+        cfg.get_send_scheduling = lambda: "fair"
+        cfg.get_fair_queuing_group = lambda ffs: ffs.split("/")[0]
+        cfg.get_fair_queuing_weight = lambda group: 2 if group == "big" else 1
+        e, outgoing_messages = self.get_engine({"alpha": {"_one": ["1"]}}, config=cfg)
+        o = ssh_message_que.OutgoingMessages(None, e, None)
+        msgs = [self._send("big/a") for ii in range(4)] + [
+            self._send("small/%i" % ii) for ii in range(4)
+        ]
+        ordered = [x.msg["ffs"].split("/")[0] for x in o.prioritize(msgs)]
+        self.assertEqual(ordered[:6], ["big", "big", "small", "big", "big", "small"])
+
+    def test_invalid_weight(self):
+        cfg = self._get_test_config()
+        cfg.get_send_scheduling = lambda: "fair"
+        cfg.get_fair_queuing_weight = lambda group: 0
+        e, outgoing_messages = self.get_engine({"alpha": {"_one": ["1"]}}, config=cfg)
+        o = ssh_message_que.OutgoingMessages(None, e, None)
+        self.assertRaises(ValueError, o.prioritize, [self._send("a")])
+
+    def simulate(self, config):
+        """One send is served per tick. 'busy' is captured three times per tick
+        for the first 200 ticks, three quiet ffs once every 20 ticks.
+        Returns the maximum wait (in ticks) of the quiet ffs' sends"""
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}}, config=config
+        )
+        o = ssh_message_que.OutgoingMessages(None, e, None)
+        que = []
+        max_wait = 0
+        for tick in range(400):
+            if tick < 200:
+                for ii in range(3):
+                    que.append((tick, self._send("busy")))
+            if tick % 20 == 0:
+                for name in ("quiet_1", "quiet_2", "quiet_3"):
+                    que.append((tick, self._send(name)))
+            queued = dict((id(x), t) for (t, x) in que)
+            head = o.prioritize([x for (t, x) in que])[0]
+            que = [(t, x) for (t, x) in que if x is not head]
+            if head.msg["ffs"] != "busy":
+                max_wait = max(max_wait, tick - queued[id(head)])
+        return max_wait
+
+    def test_simulation_no_starvation(self):
+        # first come first served: quiet ffs wait behind the whole busy backlog
+        self.assertTrue(self.simulate(self._get_test_config()) > 100)
+        # fair: at most one busy send per quiet send in front of them
+        cfg = self._get_test_config()
+        cfg.get_send_scheduling = lambda: "fair"
+        self.assertTrue(self.simulate(cfg) <= 4)
+
+
+class MovePreseedTests(PostStartupTests):
+    def _round(self, e, outgoing_messages, bytes_transferred):
+        """capture_done & send_snapshot_done for the pending pre-seed capture"""
+        capture = [x for x in outgoing_messages if x["msg"] == "capture"][-1]
+        sn = capture["snapshot"]
+        outgoing_messages.clear()
+        e.incoming_node(
+            {"msg": "capture_done", "from": "alpha", "ffs": "one", "snapshot": sn}
+        )
+        sends = [x for x in outgoing_messages if x["msg"] == "send_snapshot"]
+        self.assertEqual(set([x["target_node"] for x in sends]), set(["beta", "gamma"]))
+        outgoing_messages.clear()
+        for target in ("gamma", "beta"):
+            e.incoming_node(
+                {
+                    "msg": "send_snapshot_done",
+                    "from": "alpha",
+                    "ffs": "one",
+                    "target_node": target,
+                    "snapshot": sn,
+                    "bytes_transferred": bytes_transferred,
+                }
+            )
+        return sn
+
+    def _assert_read_only_step(self, outgoing_messages):
+        steps = [x for x in outgoing_messages if x["msg"] == "set_properties"]
+        self.assertEqual(len(steps), 1)
+        self.assertMsgEqual(
+            steps[0],
+            {
+                "to": "alpha",
+                "msg": "set_properties",
+                "ffs": "one",
+                "properties": {"readonly": "on", "ffs:moving_to": "beta"},
+            },
+        )
+
+    def test_off_by_default(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {"one": ["1"]}}
+        )
+        outgoing_messages.clear()
+        e.incoming_client({"msg": "move_main", "ffs": "one", "target": "beta"})
+        self._assert_read_only_step(outgoing_messages)
+        self.assertFalse(e.is_ffs_preseeding("one"))
+
+    def test_preseed_until_delta_small(self):
+        cfg = self._get_test_config()
+        cfg.get_move_preseed_rounds = lambda: 3
+        cfg.get_move_preseed_threshold = lambda: 1000
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"]},
+                "beta": {"one": ["1"]},
+                "gamma": {"one": ["1"]},
+            },
+            config=cfg,
+        )
+        outgoing_messages.clear()
+        e.incoming_client({"msg": "move_main", "ffs": "one", "target": "beta"})
+        # old main stays writable, capture instead
+        self.assertEqual([x["msg"] for x in outgoing_messages], ["capture"])
+        self.assertTrue(e.is_ffs_preseeding("one"))
+        self.assertFalse(e.is_ffs_moving("one"))
+        self._round(e, outgoing_messages, 10 * 1024 ** 3)
+        # delta too large - another round
+        self.assertEqual([x["msg"] for x in outgoing_messages], ["capture"])
+        self.assertEqual(e.model["one"]["_preseeding"]["round"], 2)
+        self._round(e, outgoing_messages, 100)
+        self._assert_read_only_step(outgoing_messages)
+        self.assertFalse(e.is_ffs_preseeding("one"))
+        self.assertEqual(e.model["one"]["_moving"], "beta")
+        # and on with the usual move steps
+        outgoing_messages.clear()
+        e.incoming_node(
+            {
+                "msg": "set_properties_done",
+                "from": "alpha",
+                "ffs": "one",
+                "properties": {"readonly": "on", "ffs:moving_to": "beta"},
+            }
+        )
+        self.assertEqual(outgoing_messages[0]["msg"], "capture")
+        self.assertEqual(
+            e.model["one"]["_move_snapshot"], outgoing_messages[0]["snapshot"]
+        )
+
+    def test_preseed_round_limit(self):
+        cfg = self._get_test_config()
+        cfg.get_move_preseed_rounds = lambda: 1
+        cfg.get_move_preseed_threshold = lambda: 1000
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"]},
+                "beta": {"one": ["1"]},
+                "gamma": {"one": ["1"]},
+            },
+            config=cfg,
+        )
+        outgoing_messages.clear()
+        e.incoming_client({"msg": "move_main", "ffs": "one", "target": "beta"})
+        self._round(e, outgoing_messages, 10 * 1024 ** 3)
+        self._assert_read_only_step(outgoing_messages)
+
+    def test_preseed_delta_from_snapshot_size(self):
+        cfg = self._get_test_config()
+        cfg.get_move_preseed_rounds = lambda: 3
+        cfg.get_move_preseed_threshold = lambda: 1000
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"]},
+                "beta": {"one": ["1"]},
+                "gamma": {"one": ["1"]},
+            },
+            config=cfg,
+        )
+        outgoing_messages.clear()
+        e.incoming_client({"msg": "move_main", "ffs": "one", "target": "beta"})
+        sn = outgoing_messages[-1]["snapshot"]
+        outgoing_messages.clear()
+        e.incoming_node(
+            {
+                "msg": "capture_done",
+                "from": "alpha",
+                "ffs": "one",
+                "snapshot": sn,
+                "used": 0,
+                "written": 5,
+            }
+        )
+        outgoing_messages.clear()
+        e.incoming_node(
+            {
+                "msg": "send_snapshot_done",
+                "from": "alpha",
+                "ffs": "one",
+                "target_node": "beta",
+                "snapshot": sn,
+            }
+        )
+        self._assert_read_only_step(outgoing_messages)
+
+    def test_preseed_skipped_on_request(self):
+        cfg = self._get_test_config()
+        cfg.get_move_preseed_rounds = lambda: 3
+        cfg.get_move_preseed_threshold = lambda: 1000
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"]},
+                "beta": {"one": ["1"]},
+                "gamma": {"one": ["1"]},
+            },
+            config=cfg,
+        )
+        outgoing_messages.clear()
+        e.incoming_client(
+            {"msg": "move_main", "ffs": "one", "target": "beta", "preseed": False}
+        )
+        self._assert_read_only_step(outgoing_messages)
+
+    def test_preseed_blocks_other_changes(self):
+        cfg = self._get_test_config()
+        cfg.get_move_preseed_rounds = lambda: 3
+        cfg.get_move_preseed_threshold = lambda: 1000
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"]},
+                "beta": {"one": ["1"]},
+                "gamma": {"one": ["1"]},
+            },
+            config=cfg,
+        )
+        outgoing_messages.clear()
+        e.incoming_client({"msg": "move_main", "ffs": "one", "target": "beta"})
+
+        def move_again():
+            e.incoming_client({"msg": "move_main", "ffs": "one", "target": "gamma"})
+
+        def rename():
+            e.incoming_client({"msg": "rename", "ffs": "one", "new_name": "two"})
+
+        def remove_target():
+            e.incoming_client({"msg": "remove_target", "ffs": "one", "target": "beta"})
+
+        self.assertRaises(engine.MoveInProgress, move_again)
+        self.assertRaises(engine.MoveInProgress, rename)
+        self.assertRaises(engine.MoveInProgress, remove_target)
+        # other targets may still go
+        outgoing_messages.clear()
+        e.incoming_client({"msg": "remove_target", "ffs": "one", "target": "gamma"})
+        self.assertEqual(outgoing_messages[-1]["msg"], "remove")
+
+
+class NodeDrainTests(PostStartupTests):
+    def _run_nodes(self, e, outgoing_messages, max_rounds=50):
+        """Answer every outgoing message as a well behaved node would"""
+        for ii in range(max_rounds):
+            if not outgoing_messages:
+                return
+            todo = outgoing_messages[:]
+            outgoing_messages.clear()
+            for msg in todo:
+                reply = {"from": msg["to"], "ffs": msg.get("ffs")}
+                if msg["msg"] == "set_properties":
+                    # nodes report all of the ffs' properties
+                    properties = e.model[msg["ffs"]][msg["to"]]["properties"].copy()
+                    properties.update(msg["properties"])
+                    reply.update(
+                        {"msg": "set_properties_done", "properties": properties}
+                    )
+                elif msg["msg"] == "capture":
+                    reply.update({"msg": "capture_done", "snapshot": msg["snapshot"]})
+                elif msg["msg"] == "send_snapshot":
+                    reply.update(
+                        {
+                            "msg": "send_snapshot_done",
+                            "snapshot": msg["snapshot"],
+                            "target_node": msg["target_node"],
+                        }
+                    )
+                elif msg["msg"] == "new":
+                    reply.update({"msg": "new_done", "properties": msg["properties"]})
+                elif msg["msg"] == "remove_snapshot":
+                    reply.update(
+                        {"msg": "remove_snapshot_done", "snapshot": msg["snapshot"]}
+                    )
+                else:
+                    raise ValueError("unexpected message %s" % msg)
+                e.incoming_node(reply)
+        raise ValueError("nodes did not settle")
+
+    def test_drain_plan(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {
+                    "_one": ["1", "2"],
+                    "_two": ["1", ("ffs:priority", "10")],
+                    "_three": ["1"],
+                },
+                "beta": {"one": ["1"], "two": ["1", ("ffs:priority", "10")]},
+                "gamma": {"one": ["1", "2"], "two": ["1", ("ffs:priority", "10")]},
+            }
+        )
+        # beta is still missing one@2 - gamma is fresher
+        outgoing_messages.clear()
+        res = e.incoming_client(
+            {"msg": "service_drain_node", "node": "alpha", "concurrency": 1}
+        )
+        # two, being freshest everywhere, goes to the least planned node
+        self.assertEqual(res["moves"], {"one": "gamma", "two": "beta"})
+        self.assertEqual(res["unmovable"], ["three"])
+        # ffs:priority 10 first - only one at a time
+        self.assertEqual(len(outgoing_messages), 1)
+        self.assertMsgEqual(
+            outgoing_messages[0],
+            {
+                "to": "alpha",
+                "msg": "set_properties",
+                "ffs": "two",
+                "properties": {"readonly": "on", "ffs:moving_to": "beta"},
+            },
+        )
+        status = e.incoming_client({"msg": "service_drain_status"})
+        self.assertEqual(status["drains"]["alpha"]["running"], ["two"])
+        self.assertEqual(status["drains"]["alpha"]["pending"], ["one"])
+
+    def test_drain_runs_to_completion(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {
+                    "_one": ["1", "2"],
+                    "_two": ["1", ("ffs:priority", "10")],
+                    "_three": ["1"],
+                },
+                "beta": {"one": ["1"], "two": ["1", ("ffs:priority", "10")]},
+                "gamma": {"one": ["1", "2"], "two": ["1", ("ffs:priority", "10")]},
+            }
+        )
+        self._run_nodes(e, outgoing_messages)
+        e.incoming_client(
+            {"msg": "service_drain_node", "node": "alpha", "concurrency": 1}
+        )
+        self._run_nodes(e, outgoing_messages)
+        self.assertEqual(e.model["one"]["_main"], "gamma")
+        self.assertEqual(e.model["two"]["_main"], "beta")
+        self.assertEqual(e.model["three"]["_main"], "alpha")
+        job = e.incoming_client({"msg": "service_drain_status"})["drains"]["alpha"]
+        self.assertEqual(job["done"], ["two", "one"])
+        self.assertEqual(job["running"], [])
+        self.assertEqual(job["pending"], [])
+
+    def test_drain_twice_raises(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {
+                    "_one": ["1", "2"],
+                    "_two": ["1", ("ffs:priority", "10")],
+                    "_three": ["1"],
+                },
+                "beta": {"one": ["1"], "two": ["1", ("ffs:priority", "10")]},
+                "gamma": {"one": ["1", "2"], "two": ["1", ("ffs:priority", "10")]},
+            }
+        )
+        self._run_nodes(e, outgoing_messages)
+        e.incoming_client({"msg": "service_drain_node", "node": "alpha"})
+        self.assertRaises(
+            engine.MoveInProgress,
+            e.incoming_client,
+            {"msg": "service_drain_node", "node": "alpha"},
+        )
+        self.assertRaises(
+            ValueError,
+            e.incoming_client,
+            {"msg": "service_drain_node", "node": "beta", "concurrency": 0},
+        )
+
+    def test_drain_retries_busy_ffs(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"]},
+                "beta": {"one": ["1"]},
+                "gamma": {"one": ["1"]},
+            }
+        )
+        e.incoming_client({"msg": "remove_target", "ffs": "one", "target": "gamma"})
+        outgoing_messages.clear()
+        e.incoming_client({"msg": "service_drain_node", "node": "alpha"})
+        job = e.incoming_client({"msg": "service_drain_status"})["drains"]["alpha"]
+        # RemoveInProgress - not a failure, try again later
+        self.assertEqual(job["pending"], ["one"])
+        self.assertEqual(job["running"], [])
+        self.assertEqual(job["failed"], {})
+        self.assertFalse(outgoing_messages)
+        e.incoming_node({"msg": "remove_done", "ffs": "one", "from": "gamma"})
+        e.one_minute_passed()
+        self.assertEqual(job["pending"], [])
+        self.assertEqual(job["running"], ["one"])
+        self.assertTrue(e.is_ffs_moving("one"))
+
+    def test_drain_step_timeout(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {"one": ["1"]}}
+        )
+        e.incoming_client({"msg": "service_drain_node", "node": "alpha"})
+        job = e.incoming_client({"msg": "service_drain_status"})["drains"]["alpha"]
+        self.assertEqual(job["running"], ["one"])
+        # the move never completes...
+        e.one_minute_passed()
+        self.assertEqual(job["running"], ["one"])
+        job["started"]["one"] -= e.config.get_drain_step_timeout() + 1
+        e.one_minute_passed()
+        self.assertEqual(job["running"], [])
+        self.assertEqual(list(job["failed"].keys()), ["one"])
+        # and the node may be drained again
+        e.incoming_client({"msg": "service_drain_node", "node": "alpha"})
+
+    def test_rebuild_node(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {
+                    "_one": ["1", "2"],
+                    "_two": ["1", ("ffs:priority", "10")],
+                    "_three": ["1"],
+                },
+                "beta": {},
+            }
+        )
+        outgoing_messages.clear()
+        res = e.incoming_client(
+            {
+                "msg": "service_rebuild_node",
+                "node": "beta",
+                "ffs": ["one", "two", "three"],
+                "concurrency": 2,
+            }
+        )
+        # ffs:priority first, then by name
+        self.assertEqual(res["order"], ["two", "one", "three"])
+        news = [x["ffs"] for x in outgoing_messages if x["msg"] == "new"]
+        self.assertEqual(news, ["two", "one"])
+        job = e.incoming_client({"msg": "service_drain_status"})["rebuilds"]["beta"]
+        self.assertEqual(job["pending"], ["three"])
+        self._run_nodes(e, outgoing_messages)
+        for ffs in ("one", "two", "three"):
+            self.assertEqual(
+                e.model[ffs]["beta"]["snapshots"], e.model[ffs]["alpha"]["snapshots"]
+            )
+        self.assertEqual(job["done"], ["two", "one", "three"])
+
+    def test_rebuild_unknown_ffs(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {
+                    "_one": ["1", "2"],
+                    "_two": ["1", ("ffs:priority", "10")],
+                    "_three": ["1"],
+                },
+                "beta": {"one": ["1"], "two": ["1", ("ffs:priority", "10")]},
+                "gamma": {"one": ["1", "2"], "two": ["1", ("ffs:priority", "10")]},
+            }
+        )
+        self._run_nodes(e, outgoing_messages)
+        self.assertRaises(
+            ValueError,
+            e.incoming_client,
+            {"msg": "service_rebuild_node", "node": "beta", "ffs": ["nope"]},
+        )
+
+
+class PoolStatsTests(PostStartupTests):
+    def test_stats_time_series(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {}, "gamma": {}}
+        )
+        self.zpool_status(e, "alpha", free=500, capacity=10, write_bytes=0)
+        self.zpool_status(e, "beta", free=800, capacity=10)
+        e.incoming_node(
+            {
+                "from": "alpha",
+                "msg": "zpool_status",
+                "status": "  pool: alpha\n state: ONLINE\n",
+                "pools": {
+                    "alpha": {
+                        "size": 1000,
+                        "alloc": 600,
+                        "free": 400,
+                        "fragmentation": 5,
+                        "capacity": 10,
+                        "read_ops": 0,
+                        "write_ops": 0,
+                        "read_bytes": 0,
+                        "write_bytes": 100,
+                    },
+                    "other_pool": {"free": 10 ** 9, "capacity": 0},
+                },
+            }
+        )
+        self.assertEqual(len(e.pool_stats["alpha"]), 2)
+        stats = e.get_node_stats()
+        self.assertEqual(sorted(stats), ["alpha", "beta"])
+        # the storage_prefix' pool, not other_pool
+        self.assertEqual(stats["alpha"]["free"], 400)
+        # io is averaged
+        self.assertEqual(stats["alpha"]["write_bytes"], 50)
+        res = e.incoming_client({"msg": "service_pool_stats", "node": "alpha"})
+        self.assertEqual(len(res["alpha"]), 2)
+        self.assertEqual(res["alpha"][1]["pools"]["alpha"]["free"], 400)
+
+    def test_zpool_status_without_pools(self):
+        e, outgoing_messages = self.get_engine({"alpha": {"_one": ["1"]}})
+        e.incoming_node(
+            {"from": "alpha", "msg": "zpool_status", "status": "state: ONLINE"}
+        )
+        self.assertEqual(e.get_node_stats(), {})
+
+    def test_pick_targets_by_headroom(self):
+        stats = {
+            "alpha": {"free": 500, "capacity": 10},
+            "beta": {"free": 800, "capacity": 10},
+            "gamma": {"free": 900, "capacity": 85},
+            "delta": {
+                "free": 1000,
+                "capacity": 10,
+                "write_bytes": 300 * 1024 ** 2,
+            },
+        }
+        pick = default_config.pick_targets_by_headroom
+        # gamma is full, delta busy
+        self.assertEqual(pick(stats, 2), ["beta", "alpha"])
+        self.assertEqual(pick(stats, 4), ["beta", "alpha", "delta", "gamma"])
+        self.assertEqual(pick(stats, 1, candidates=["gamma", "delta"]), ["delta"])
+        self.assertEqual(pick(stats, 5), None)
+
+    def test_new_placed_by_headroom(self):
+        cfg = self._get_test_config()
+        cfg.decide_targets_by_load = (
+            lambda ffs, node_stats: default_config.pick_targets_by_headroom(
+                node_stats, 2
+            )
+        )
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {}, "gamma": {}}, config=cfg
+        )
+        outgoing_messages.clear()
+        self.zpool_status(e, "alpha", free=500, capacity=10)
+        self.zpool_status(e, "beta", free=800, capacity=10)
+        self.zpool_status(e, "gamma", free=900, capacity=85)
+        e.incoming_client({"msg": "new", "ffs": "two", "targets": []})
+        self.assertEqual(e.model["two"]["_main"], "beta")
+        self.assertEqual(
+            sorted([x["to"] for x in outgoing_messages if x["msg"] == "new"]),
+            ["alpha", "beta"],
+        )
+
+    def test_new_falls_back_to_decide_targets(self):
+        cfg = self._get_test_config()
+        cfg.decide_targets = lambda ffs: ["gamma"]
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {}, "gamma": {}}, config=cfg
+        )
+        outgoing_messages.clear()
+        self.zpool_status(e, "alpha", free=500, capacity=10)
+        self.zpool_status(e, "beta", free=800, capacity=10)
+        self.zpool_status(e, "gamma", free=900, capacity=85)
+        e.incoming_client({"msg": "new", "ffs": "two", "targets": []})
+        self.assertEqual(e.model["two"]["_main"], "gamma")
+
+    def test_add_targets_by_count(self):
+        cfg = self._get_test_config()
+        cfg.decide_targets_by_load = (
+            lambda ffs, node_stats: default_config.pick_targets_by_headroom(
+                node_stats, 1
+            )
+        )
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {}, "gamma": {}}, config=cfg
+        )
+        outgoing_messages.clear()
+        self.zpool_status(e, "alpha", free=500, capacity=10)
+        self.zpool_status(e, "beta", free=800, capacity=10)
+        self.zpool_status(e, "gamma", free=900, capacity=85)
+        e.incoming_client({"msg": "add_targets", "ffs": "one", "count": 1})
+        # alpha already has it
+        self.assertEqual(outgoing_messages[0]["to"], "beta")
+        self.assertEqual(outgoing_messages[0]["msg"], "new")
+
+    def test_new_by_headroom_skips_readonly_nodes(self):
+        cfg = self._get_test_config()
+        cfg.decide_targets_by_load = (
+            lambda ffs, node_stats: default_config.pick_targets_by_headroom(
+                node_stats, 2
+            )
+        )
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {}, "gamma": {}},
+            config=cfg,
+            additional_node_config={"beta": {"readonly_node": True}},
+        )
+        self.zpool_status(e, "alpha", free=500, capacity=10)
+        self.zpool_status(e, "beta", free=800, capacity=10)
+        self.zpool_status(e, "gamma", free=900, capacity=10)
+        e.incoming_client({"msg": "new", "ffs": "two", "targets": []})
+        self.assertEqual(e.model["two"]["_main"], "gamma")
+        self.assertEqual(
+            sorted([x for x in e.model["two"] if not x.startswith("_")]),
+            ["alpha", "gamma"],
+        )
+
+    def test_nested_new_by_headroom_only_where_parent_is(self):
+        cfg = self._get_test_config()
+        cfg.decide_targets_by_load = (
+            lambda ffs, node_stats: default_config.pick_targets_by_headroom(
+                node_stats, 1
+            )
+        )
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {}, "gamma": {"one": ["1"]}},
+            config=cfg,
+        )
+        self.zpool_status(e, "alpha", free=500, capacity=10)
+        self.zpool_status(e, "beta", free=800, capacity=10)
+        self.zpool_status(e, "gamma", free=400, capacity=10)
+        e.incoming_client({"msg": "new", "ffs": "one/sub", "targets": []})
+        # beta has the most headroom, but not one
+        self.assertEqual(e.model["one/sub"]["_main"], "alpha")
+        new = [x for x in outgoing_messages if x["msg"] == "new"][-1]
+        e.incoming_node(
+            {
+                "msg": "new_done",
+                "from": "alpha",
+                "ffs": "one/sub",
+                "properties": new["properties"],
+            }
+        )
+        e.incoming_client({"msg": "add_targets", "ffs": "one/sub", "count": 1})
+        self.assertTrue("gamma" in e.model["one/sub"])
+        self.assertFalse("beta" in e.model["one/sub"])
+
+    def test_add_targets_by_count_needs_config(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {}, "gamma": {}}
+        )
+        self.zpool_status(e, "beta", free=800, capacity=10)
+        self.assertRaises(
+            ValueError,
+            e.incoming_client,
+            {"msg": "add_targets", "ffs": "one", "count": 1},
+        )
+
+
+class PressureRetentionTests(PostStartupTests):
+    def history(self, e, node, frees, step=3600):
+        """free bytes of node's pool, one sample per step seconds, ending now"""
+        now = time.time()
+        e.pool_stats[node] = collections.deque(
+            [
+                (now - step * (len(frees) - ii), {node: {"free": free, "capacity": 50}})
+                for (ii, free) in enumerate(frees)
+            ]
+        )
+
+    def test_forecast(self):
+        cfg = self._get_test_config()
+        cfg.get_pressure_time_to_full = lambda: 10 * 3600
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {
+                    "_one": ["1", "2", "3", "4", ("ffs:priority", "10")],
+                    "_two": ["1", "2", "3", "4"],
+                },
+                "beta": {
+                    "one": ["1", "2", "3", "4", ("ffs:priority", "10")],
+                    "two": ["1", "2", "3", "4"],
+                },
+            },
+            config=cfg,
+        )
+        outgoing_messages.clear()
+        self.history(e, "beta", [1000, 900, 800, 700])
+        forecast = e.get_node_forecast("beta")
+        self.assertEqual(forecast["free"], 700)
+        self.assertAlmostEqual(forecast["fill_rate"], 100 / 3600.0)
+        self.assertAlmostEqual(forecast["time_to_full"], 7 * 3600)
+
+    def test_forecast_not_filling(self):
+        cfg = self._get_test_config()
+        cfg.get_pressure_time_to_full = lambda: 10 * 3600
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {
+                    "_one": ["1", "2", "3", "4", ("ffs:priority", "10")],
+                    "_two": ["1", "2", "3", "4"],
+                },
+                "beta": {
+                    "one": ["1", "2", "3", "4", ("ffs:priority", "10")],
+                    "two": ["1", "2", "3", "4"],
+                },
+            },
+            config=cfg,
+        )
+        outgoing_messages.clear()
+        self.assertEqual(e.get_node_forecast("beta")["time_to_full"], None)
+        self.history(e, "beta", [700])
+        self.assertEqual(e.get_node_forecast("beta")["time_to_full"], None)
+        self.history(e, "beta", [700, 800, 900])
+        self.assertEqual(e.get_node_forecast("beta")["time_to_full"], None)
+        res = e.incoming_client({"msg": "service_capacity_forecast"})
+        self.assertFalse(res["beta"]["pressure"])
+
+    def test_forecast_window(self):
+        cfg = self._get_test_config()
+        cfg.get_pressure_time_to_full = lambda: 10 * 3600
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {
+                    "_one": ["1", "2", "3", "4", ("ffs:priority", "10")],
+                    "_two": ["1", "2", "3", "4"],
+                },
+                "beta": {
+                    "one": ["1", "2", "3", "4", ("ffs:priority", "10")],
+                    "two": ["1", "2", "3", "4"],
+                },
+            },
+            config=cfg,
+        )
+        outgoing_messages.clear()
+        # the steep decline was two days ago
+        self.history(e, "beta", [10000, 1000] + [1000] * 48)
+        self.assertEqual(e.get_node_forecast("beta")["time_to_full"], None)
+
+    def test_pressure_prunes_replicas_by_priority(self):
+        cfg = self._get_test_config()
+        cfg.get_pressure_time_to_full = lambda: 10 * 3600
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {
+                    "_one": ["1", "2", "3", "4", ("ffs:priority", "10")],
+                    "_two": ["1", "2", "3", "4"],
+                },
+                "beta": {
+                    "one": ["1", "2", "3", "4", ("ffs:priority", "10")],
+                    "two": ["1", "2", "3", "4"],
+                },
+            },
+            config=cfg,
+        )
+        outgoing_messages.clear()
+        errors = []
+        e.error_callback = lambda x: errors.append(x)
+        self.history(e, "beta", [1000, 900, 800])
+        self.zpool_status(e, "beta", free=700, capacity=50)
+        self.assertEqual(e.pressure_nodes, set(["beta"]))
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(
+            [(x["to"], x["msg"], x["ffs"], x["snapshots"]) for x in outgoing_messages],
+            [
+                # unset priority (1000) goes before ffs:priority=10
+                ("beta", "remove_snapshots", "two", ["1", "2"]),
+                ("beta", "remove_snapshots", "one", ["1", "2"]),
+            ],
+        )
+        self.assertEqual(e.model["two"]["beta"]["snapshots"], ["3", "4"])
+        self.assertEqual(e.model["two"]["alpha"]["snapshots"], ["1", "2", "3", "4"])
+        e.incoming_node(
+            {
+                "from": "beta",
+                "msg": "remove_snapshots_done",
+                "ffs": "two",
+                "removed": ["1", "2"],
+                "snapshots": ["3", "4"],
+            }
+        )
+        self.assertEqual(e.model["two"]["beta"]["snapshots"], ["3", "4"])
+
+    def test_main_is_not_pruned(self):
+        cfg = self._get_test_config()
+        cfg.get_pressure_time_to_full = lambda: 10 * 3600
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {
+                    "_one": ["1", "2", "3", "4", ("ffs:priority", "10")],
+                    "_two": ["1", "2", "3", "4"],
+                },
+                "beta": {
+                    "one": ["1", "2", "3", "4", ("ffs:priority", "10")],
+                    "two": ["1", "2", "3", "4"],
+                },
+            },
+            config=cfg,
+        )
+        outgoing_messages.clear()
+        self.history(e, "alpha", [1000, 900, 800])
+        self.zpool_status(e, "alpha", free=700, capacity=50)
+        self.assertEqual(e.pressure_nodes, set(["alpha"]))
+        self.assertEqual(outgoing_messages, [])
+
+    def test_pressure_ends(self):
+        cfg = self._get_test_config()
+        cfg.get_pressure_time_to_full = lambda: 10 * 3600
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {
+                    "_one": ["1", "2", "3", "4", ("ffs:priority", "10")],
+                    "_two": ["1", "2", "3", "4"],
+                },
+                "beta": {
+                    "one": ["1", "2", "3", "4", ("ffs:priority", "10")],
+                    "two": ["1", "2", "3", "4"],
+                },
+            },
+            config=cfg,
+        )
+        outgoing_messages.clear()
+        self.history(e, "beta", [1000, 900, 800])
+        self.zpool_status(e, "beta", free=700, capacity=50)
+        self.assertTrue("beta" in e.pressure_nodes)
+        outgoing_messages.clear()
+        # snapshots got removed, space is back
+        self.history(e, "beta", [700, 800, 900])
+        self.zpool_status(e, "beta", free=1000, capacity=50)
+        self.assertFalse("beta" in e.pressure_nodes)
+        self.assertEqual(outgoing_messages, [])
+
+    def test_pressure_off_by_default(self):
+        cfg = self._get_test_config()
+        cfg.get_pressure_time_to_full = lambda: 0
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {
+                    "_one": ["1", "2", "3", "4", ("ffs:priority", "10")],
+                    "_two": ["1", "2", "3", "4"],
+                },
+                "beta": {
+                    "one": ["1", "2", "3", "4", ("ffs:priority", "10")],
+                    "two": ["1", "2", "3", "4"],
+                },
+            },
+            config=cfg,
+        )
+        outgoing_messages.clear()
+        self.history(e, "beta", [1000, 900, 800])
+        self.zpool_status(e, "beta", free=1, capacity=50)
+        self.assertEqual(e.pressure_nodes, set())
+        self.assertEqual(outgoing_messages, [])
+
+    def test_remove_snapshots_failed(self):
+        cfg = self._get_test_config()
+        cfg.get_pressure_time_to_full = lambda: 10 * 3600
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {
+                    "_one": ["1", "2", "3", "4", ("ffs:priority", "10")],
+                    "_two": ["1", "2", "3", "4"],
+                },
+                "beta": {
+                    "one": ["1", "2", "3", "4", ("ffs:priority", "10")],
+                    "two": ["1", "2", "3", "4"],
+                },
+            },
+            config=cfg,
+        )
+        outgoing_messages.clear()
+        e.incoming_node(
+            {
+                "from": "beta",
+                "msg": "remove_snapshots_failed",
+                "ffs": "two",
+                "removed": ["1"],
+                "failed": ["2"],
+                "error_msg": "dependent clones",
+            }
+        )
+        self.assertEqual(e.model["two"]["beta"]["snapshots"], ["2", "3", "4"])
+
+
+class DeletionQueTests(PostStartupTests):
+    def removals(self, outgoing_messages):
+        res = []
+        for x in outgoing_messages:
+            if x["msg"] == "remove_snapshot":
+                res.append((x["to"], x["ffs"], [x["snapshot"]]))
+            elif x["msg"] == "remove_snapshots":
+                res.append((x["to"], x["ffs"], x["snapshots"]))
+        return res
+
+    def reply(self, e, msg):
+        if msg["msg"] == "remove_snapshot":
+            e.incoming_node(
+                {
+                    "from": msg["to"],
+                    "msg": "remove_snapshot_done",
+                    "ffs": msg["ffs"],
+                    "snapshot": msg["snapshot"],
+                }
+            )
+        else:
+            e.incoming_node(
+                {
+                    "from": msg["to"],
+                    "msg": "remove_snapshots_done",
+                    "ffs": msg["ffs"],
+                    "removed": msg["snapshots"],
+                }
+            )
+
+    def test_unlimited_sends_right_away(self):
+        cfg = self._get_test_config()
+        cfg.decide_snapshots_to_keep = lambda ffs, snapshots: snapshots[-1:]
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"], "_two": ["1"]},
+                "beta": {"one": ["1"], "two": ["1"]},
+            },
+            config=cfg,
+        )
+        for ffs in ["one", "two"]:
+            e.model[ffs]["alpha"]["snapshots"] = ["1", "2", "3", "4", "5"]
+            e.model[ffs]["beta"]["snapshots"] = ["1", "2", "3", "4", "5"]
+        e._prune_snapshots_for_ffs("one", "beta")
+        self.assertEqual(
+            self.removals(outgoing_messages),
+            [("beta", "one", [x]) for x in ["1", "2", "3", "4"]],
+        )
+        self.assertEqual(e.model["one"]["beta"]["snapshots"], ["5"])
+        for msg in list(outgoing_messages):
+            self.reply(e, msg)
+        res = e.incoming_client({"msg": "service_deletion_que"})
+        self.assertEqual(res["beta"]["queued"], 0)
+        self.assertEqual(res["beta"]["in_flight"], 0)
+        self.assertEqual(res["beta"]["removed_in_window"], 4)
+
+    def test_batched(self):
+        cfg = self._get_test_config()
+        cfg.decide_snapshots_to_keep = lambda ffs, snapshots: snapshots[-1:]
+        cfg.get_deletion_batch_size = lambda: 3
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"], "_two": ["1"]},
+                "beta": {"one": ["1"], "two": ["1"]},
+            },
+            config=cfg,
+        )
+        for ffs in ["one", "two"]:
+            e.model[ffs]["alpha"]["snapshots"] = ["1", "2", "3", "4", "5"]
+            e.model[ffs]["beta"]["snapshots"] = ["1", "2", "3", "4", "5"]
+        e._prune_snapshots_for_ffs("one", "beta")
+        e._prune_snapshots_for_ffs("two", "beta")
+        self.assertEqual(
+            self.removals(outgoing_messages),
+            [
+                ("beta", "one", ["1", "2", "3"]),
+                ("beta", "one", ["4"]),
+                ("beta", "two", ["1", "2", "3"]),
+                ("beta", "two", ["4"]),
+            ],
+        )
+
+    def test_rate_limit(self):
+        cfg = self._get_test_config()
+        cfg.decide_snapshots_to_keep = lambda ffs, snapshots: snapshots[-1:]
+        cfg.get_deletion_rate_limit = lambda: 3
+        cfg.get_deletion_batch_size = lambda: 10
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"], "_two": ["1"]},
+                "beta": {"one": ["1"], "two": ["1"]},
+            },
+            config=cfg,
+        )
+        for ffs in ["one", "two"]:
+            e.model[ffs]["alpha"]["snapshots"] = ["1", "2", "3", "4", "5"]
+            e.model[ffs]["beta"]["snapshots"] = ["1", "2", "3", "4", "5"]
+        e._prune_snapshots_for_ffs("one", "beta")
+        e._prune_snapshots_for_ffs("two", "beta")
+        self.assertEqual(
+            self.removals(outgoing_messages), [("beta", "one", ["1", "2", "3"])]
+        )
+        # forgotten nevertheless - they're on their way out
+        self.assertEqual(e.model["two"]["beta"]["snapshots"], ["5"])
+        res = e.incoming_client({"msg": "service_deletion_que"})
+        self.assertEqual(res["beta"]["queued"], 5)
+        self.assertEqual(res["beta"]["in_flight"], 3)
+        self.reply(e, outgoing_messages[0])
+        self.assertEqual(len(outgoing_messages), 1)  # still over the rate
+        e.one_minute_passed()
+        self.assertEqual(len(self.removals(outgoing_messages)), 1)
+        # an hour later
+        e.deletions_sent["beta"] = collections.deque(
+            [(t - e.deletion_window - 1, c) for (t, c) in e.deletions_sent["beta"]]
+        )
+        e.one_minute_passed()
+        self.assertEqual(
+            self.removals(outgoing_messages)[1:],
+            [("beta", "one", ["4"]), ("beta", "two", ["1", "2"])],
+        )
+
+    def test_concurrency(self):
+        cfg = self._get_test_config()
+        cfg.decide_snapshots_to_keep = lambda ffs, snapshots: snapshots[-1:]
+        cfg.get_concurrent_deletion_limit = lambda: 1
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"], "_two": ["1"]},
+                "beta": {"one": ["1"], "two": ["1"]},
+            },
+            config=cfg,
+        )
+        for ffs in ["one", "two"]:
+            e.model[ffs]["alpha"]["snapshots"] = ["1", "2", "3", "4", "5"]
+            e.model[ffs]["beta"]["snapshots"] = ["1", "2", "3", "4", "5"]
+        e._prune_snapshots_for_ffs("one", "beta")
+        e._prune_snapshots_for_ffs("one", "alpha")
+        self.assertEqual(
+            self.removals(outgoing_messages),
+            [("beta", "one", ["1"]), ("alpha", "one", ["1"])],
+        )
+        self.reply(e, outgoing_messages[0])
+        self.assertEqual(self.removals(outgoing_messages)[2:], [("beta", "one", ["2"])])
+        e.incoming_node(
+            {
+                "from": "beta",
+                "msg": "remove_snapshot_failed",
+                "ffs": "one",
+                "snapshot": "2",
+                "error_msg": "Snapshot had dependent clones.",
+            }
+        )
+        self.assertEqual(self.removals(outgoing_messages)[3:], [("beta", "one", ["3"])])
+
+    def test_window(self):
+        cfg = self._get_test_config()
+        cfg.decide_snapshots_to_keep = lambda ffs, snapshots: snapshots[-1:]
+        self.window_open = False
+        cfg.deletion_window_open = lambda node: self.window_open
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"], "_two": ["1"]},
+                "beta": {"one": ["1"], "two": ["1"]},
+            },
+            config=cfg,
+        )
+        for ffs in ["one", "two"]:
+            e.model[ffs]["alpha"]["snapshots"] = ["1", "2", "3", "4", "5"]
+            e.model[ffs]["beta"]["snapshots"] = ["1", "2", "3", "4", "5"]
+        e._prune_snapshots_for_ffs("one", "beta")
+        self.assertEqual(outgoing_messages, [])
+        res = e.incoming_client({"msg": "service_deletion_que"})
+        self.assertEqual(res["beta"]["queued"], 4)
+        self.assertFalse(res["beta"]["window_open"])
+        e.one_minute_passed()
+        self.assertEqual(self.removals(outgoing_messages), [])
+        self.window_open = True
+        e.one_minute_passed()
+        self.assertEqual(len(self.removals(outgoing_messages)), 4)
+
+    def test_removed_ffs_is_dropped_from_que(self):
+        cfg = self._get_test_config()
+        cfg.decide_snapshots_to_keep = lambda ffs, snapshots: snapshots[-1:]
+        self.window_open = False
+        cfg.deletion_window_open = lambda node: self.window_open
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"], "_two": ["1"]},
+                "beta": {"one": ["1"], "two": ["1"]},
+            },
+            config=cfg,
+        )
+        for ffs in ["one", "two"]:
+            e.model[ffs]["alpha"]["snapshots"] = ["1", "2", "3", "4", "5"]
+            e.model[ffs]["beta"]["snapshots"] = ["1", "2", "3", "4", "5"]
+        e._prune_snapshots_for_ffs("one", "beta")
+        e._prune_snapshots_for_ffs("two", "beta")
+        del e.model["one"]
+        self.window_open = True
+        e.one_minute_passed()
+        self.assertEqual(
+            self.removals(outgoing_messages),
+            [("beta", "two", [x]) for x in ["1", "2", "3", "4"]],
+        )
+
+    def test_renamed_ffs_keeps_its_que(self):
+        cfg = self._get_test_config()
+        cfg.decide_snapshots_to_keep = lambda ffs, snapshots: snapshots[-1:]
+        self.window_open = False
+        cfg.deletion_window_open = lambda node: self.window_open
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {"one": ["1"]}}, config=cfg
+        )
+        e.model["one"]["alpha"]["snapshots"] = ["1", "2", "3"]
+        e.model["one"]["beta"]["snapshots"] = ["1", "2", "3"]
+        e._prune_snapshots_for_ffs("one", "beta")
+        e.incoming_client({"msg": "rename", "ffs": "one", "new_name": "two"})
+        outgoing_messages.clear()
+        self.window_open = True
+        e.one_minute_passed()  # not while renaming
+        self.assertEqual(self.removals(outgoing_messages), [])
+        for node in ["beta", "alpha"]:
+            e.incoming_node(
+                {"msg": "rename_done", "ffs": "one", "from": node, "new_name": "two"}
+            )
+        e.one_minute_passed()
+        self.assertEqual(
+            self.removals(outgoing_messages),
+            [("beta", "two", ["1"]), ("beta", "two", ["2"])],
+        )
+
+    def test_pressure_removals_are_urgent(self):
+        cfg = self._get_test_config()
+        cfg.decide_snapshots_to_keep = lambda ffs, snapshots: snapshots[-1:]
+        cfg.decide_snapshots_to_keep_under_pressure = lambda ffs, snapshots: set()
+        cfg.get_concurrent_deletion_limit = lambda: 1
+        cfg.get_deletion_rate_limit = lambda: 1
+        window = [True]
+        cfg.deletion_window_open = lambda node: window[0]
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"], "_two": ["1"]},
+                "beta": {"one": ["1"], "two": ["1"]},
+            },
+            config=cfg,
+        )
+        for ffs in ["one", "two"]:
+            e.model[ffs]["alpha"]["snapshots"] = ["1", "2", "3", "4", "5"]
+            e.model[ffs]["beta"]["snapshots"] = ["1", "2", "3", "4", "5"]
+        e._prune_snapshots_for_ffs("one", "beta")
+        self.assertEqual(self.removals(outgoing_messages), [("beta", "one", ["1"])])
+        window[0] = False
+        e._pressure_prune("beta")
+        # queued in front of the regular removals, despite window & rate limit
+        self.assertEqual(
+            [(x[0], x[1], x[3]) for x in e.deletion_que["beta"]],
+            [("two", x, True) for x in ["1", "2", "3", "4"]]
+            + [("one", x, False) for x in ["2", "3", "4"]],
+        )
+        status = e.client_service_deletion_que()["beta"]
+        self.assertEqual(status["queued"], 7)
+        self.assertEqual(status["urgent_queued"], 4)
+        self.reply(e, outgoing_messages[0])  # the concurrency limit still holds
+        self.assertEqual(
+            self.removals(outgoing_messages)[1:],
+            [("beta", "two", ["1", "2", "3", "4"])],
+        )
+        self.reply(e, outgoing_messages[-1])
+        self.assertEqual(len(self.removals(outgoing_messages)), 2)
+        self.assertEqual(
+            e.client_service_deletion_que()["beta"]["removed_in_window"], 5
+        )
+
+    def test_invalid_config(self):
+        cfg = self._get_test_config()
+        cfg.get_deletion_batch_size = lambda: 0
+        self.assertRaises(
+            ValueError, default_config.CheckedConfig(cfg).get_deletion_batch_size
+        )
+
+
+class ScrubTests(PostStartupTests):
+    def scrubs_sent(self, outgoing_messages):
+        return [x["to"] for x in outgoing_messages if x["msg"] == "zpool_scrub"]
+
+    def test_scrub_limits_dispatched_sends(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {"one": ["1"]}, "gamma": {}}
+        )
+        self.assertEqual(self.sends_started(e, "alpha", "beta"), 4)
+        self.zpool_status(
+            e, "beta", "scrub in progress since Sun Oct 13 00:24:02 2019"
+        )
+        # into the scrubbing node
+        self.assertEqual(self.sends_started(e, "alpha", "beta"), 1)
+        self.assertEqual(self.sends_started(e, "alpha", "gamma"), 4)
+        # out of it
+        self.assertEqual(self.sends_started(e, "beta", "gamma"), 1)
+
+    def test_parse_scrub_status(self):
+        e, outgoing_messages = self.get_engine({"alpha": {"_one": ["1"]}})
+        status = (
+            "  pool: alpha\n state: ONLINE\n"
+            "  scan: scrub repaired 0B in 0 days 00:00:01 with 0 errors on "
+            "Sun Oct 13 00:24:02 2019\nconfig:\n\n"
+            "  pool: other\n state: ONLINE\n"
+            "  scan: scrub in progress since Sun Oct 13 00:24:02 2019\n"
+        )
+        in_progress, finished = e._parse_scrub_status(status, "alpha")
+        self.assertFalse(in_progress)
+        self.assertEqual(time.localtime(finished)[:6], (2019, 10, 13, 0, 24, 2))
+        self.assertEqual(e._parse_scrub_status(status, "other")[0], True)
+        self.assertEqual(
+            e._parse_scrub_status(status.replace("alpha", "beta"), "alpha"),
+            (False, None),
+        )
+
+    def test_off_by_default(self):
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"], "_two": ["1"]},
+                "beta": {"one": ["1"], "two": ["1"]},
+                "gamma": {"_three": ["1"]},
+                "delta": {"three": ["1"]},
+            }
+        )
+        for node in ["alpha", "beta", "gamma", "delta"]:
+            self.zpool_status(e, node)
+        self.assertEqual(self.scrubs_sent(outgoing_messages), [])
+
+    def test_limit_and_overlap(self):
+        cfg = self._get_test_config()
+        cfg.get_scrub_interval = lambda: 7 * 24 * 3600
+        cfg.get_concurrent_scrub_limit = lambda: 2
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"], "_two": ["1"]},
+                "beta": {"one": ["1"], "two": ["1"]},
+                "gamma": {"_three": ["1"]},
+                "delta": {"three": ["1"]},
+            },
+            config=cfg,
+        )
+        for node in ["alpha", "beta", "gamma", "delta"]:
+            self.zpool_status(e, node)
+        # beta shares all ffs with alpha, delta would be the third
+        self.assertEqual(self.scrubs_sent(outgoing_messages), ["alpha", "gamma"])
+        self.assertEqual(e.get_node_rsync_cap("alpha"), 1)
+        self.assertEqual(e.get_node_rsync_cap("beta"), None)
+        e.incoming_node(
+            {"from": "alpha", "msg": "zpool_scrub_started", "pool": "alpha"}
+        )
+        self.zpool_status(
+            e, "alpha", "scrub in progress since Sun Oct 13 00:24:02 2019"
+        )
+        self.assertTrue("alpha" in e.scrubs)
+        self.zpool_status(
+            e,
+            "alpha",
+            "scrub repaired 0B in 0 days 00:00:01 with 0 errors on "
+            "Sun Oct 13 00:24:02 2019",
+        )
+        self.assertFalse("alpha" in e.scrubs)
+        self.assertTrue(e.last_scrubs["alpha"] > time.time() - 60)
+        # beta no longer overlaps with a running scrub
+        self.assertEqual(
+            self.scrubs_sent(outgoing_messages), ["alpha", "gamma", "beta"]
+        )
+        res = e.incoming_client({"msg": "service_scrub_status"})
+        self.assertEqual(sorted(res["scrubbing"]), ["beta", "gamma"])
+
+    def test_requested_scrub_not_yet_running(self):
+        cfg = self._get_test_config()
+        cfg.get_scrub_interval = lambda: 7 * 24 * 3600
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"], "_two": ["1"]},
+                "beta": {"one": ["1"], "two": ["1"]},
+                "gamma": {"_three": ["1"]},
+                "delta": {"three": ["1"]},
+            },
+            config=cfg,
+        )
+        self.zpool_status(e, "alpha")
+        self.assertEqual(self.scrubs_sent(outgoing_messages), ["alpha"])
+        # status before the scrub command ran
+        self.zpool_status(e, "alpha")
+        self.assertTrue("alpha" in e.scrubs)
+        self.assertEqual(self.scrubs_sent(outgoing_messages), ["alpha"])
+
+    def test_requested_scrub_never_started_expires(self):
+        cfg = self._get_test_config()
+        cfg.get_scrub_interval = lambda: 7 * 24 * 3600
+        cfg.get_zpool_frequency_check = lambda: 60
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {"one": ["1"]}}, config=cfg
+        )
+        self.zpool_status(e, "alpha")
+        self.assertEqual(self.scrubs_sent(outgoing_messages), ["alpha"])
+        e.scrubs["alpha"]["since"] -= (
+            e.scrub_start_reports * e.config.get_zpool_frequency_check() + 1
+        )
+        self.zpool_status(e, "alpha")
+        # given up on - and being still due, requested again
+        self.assertEqual(self.scrubs_sent(outgoing_messages), ["alpha", "alpha"])
+        self.assertFalse("alpha" in e.last_scrubs)
+
+    def test_paused_scrub_is_in_progress(self):
+        cfg = self._get_test_config()
+        cfg.get_scrub_interval = lambda: 7 * 24 * 3600
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"], "_two": ["1"]},
+                "beta": {"one": ["1"], "two": ["1"]},
+                "gamma": {"_three": ["1"]},
+                "delta": {"three": ["1"]},
+            },
+            config=cfg,
+        )
+        self.zpool_status(e, "alpha")
+        e.incoming_node(
+            {"from": "alpha", "msg": "zpool_scrub_started", "pool": "alpha"}
+        )
+        self.zpool_status(
+            e,
+            "alpha",
+            "scrub paused since Sun Oct 13 00:24:02 2019\n"
+            "\tscrub started on Sun Oct 13 00:20:02 2019",
+        )
+        self.assertTrue("alpha" in e.scrubs)
+        self.assertFalse("alpha" in e.last_scrubs)
+
+    def test_recently_scrubbed_is_not_due(self):
+        cfg = self._get_test_config()
+        cfg.get_scrub_interval = lambda: 7 * 24 * 3600
+        cfg.get_concurrent_scrub_limit = lambda: 2
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"], "_two": ["1"]},
+                "beta": {"one": ["1"], "two": ["1"]},
+                "gamma": {"_three": ["1"]},
+                "delta": {"three": ["1"]},
+            },
+            config=cfg,
+        )
+        recent = time.strftime(
+            "%a %b %d %H:%M:%S %Y", time.localtime(time.time() - 3600)
+        )
+        self.zpool_status(
+            e, "alpha", "scrub repaired 0B in 00:00:01 with 0 errors on " + recent
+        )
+        self.assertEqual(self.scrubs_sent(outgoing_messages), [])
+
+    def test_host_started_scrubs_count(self):
+        cfg = self._get_test_config()
+        cfg.get_scrub_interval = lambda: 7 * 24 * 3600
+        e, outgoing_messages = self.get_engine(
+            {
+                "alpha": {"_one": ["1"], "_two": ["1"]},
+                "beta": {"one": ["1"], "two": ["1"]},
+                "gamma": {"_three": ["1"]},
+                "delta": {"three": ["1"]},
+            },
+            config=cfg,
+        )
+        self.zpool_status(
+            e, "delta", "scrub in progress since Sun Oct 13 00:24:02 2019"
+        )
+        self.assertEqual(e.scrubs["delta"]["requested"], False)
+        self.assertEqual(e.get_node_rsync_cap("delta"), 1)
+        self.zpool_status(e, "alpha")
+        self.assertEqual(self.scrubs_sent(outgoing_messages), [])
+        self.zpool_status(
+            e, "delta", "scrub repaired 0B in 00:00:01 with 0 errors on x"
+        )
+        self.assertEqual(self.scrubs_sent(outgoing_messages), ["alpha"])
+
+
+class NodeLoadTests(PostStartupTests):
+    def test_saturation_limits_dispatched_sends(self):
+        cfg = self._get_test_config()
+        cfg.get_saturated_rsync_limit = lambda: 2
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {"one": ["1"]}, "gamma": {}},
+            config=cfg,
+        )
+        self.assertEqual(self.sends_started(e, "alpha", "beta"), 4)
+        e.incoming_node(
+            {
+                "from": "alpha",
+                "msg": "load",
+                "loadavg": [9.0, 9.0, 9.0],
+                "cpus": 4,
+                "pool": {},
+            }
+        )
+        self.assertEqual(self.sends_started(e, "alpha", "beta"), 2)
+        self.assertEqual(self.sends_started(e, "gamma", "alpha"), 2)
+        self.assertEqual(self.sends_started(e, "gamma", "beta"), 4)
+
+    def test_load_check(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {"one": ["1"]}}
+        )
+        e.do_load_check()
+        self.assertEqual(
+            sorted([(x["to"], x["msg"]) for x in outgoing_messages]),
+            [("alpha", "load"), ("beta", "load")],
+        )
+
+    def test_saturated_by_disk_wait(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {"one": ["1"]}}
+        )
+        e.incoming_node(
+            {
+                "from": "alpha",
+                "msg": "load",
+                "loadavg": [0.5, 0.5, 0.5],
+                "cpus": 4,
+                "pool": {"write_bytes": 10, "write_wait_ns": 500 * 1000 * 1000},
+            }
+        )
+        e.incoming_node(
+            {
+                "from": "beta",
+                "msg": "load",
+                "loadavg": [0.5, 0.5, 0.5],
+                "cpus": 4,
+                "pool": {"write_bytes": 10, "write_wait_ns": 1000 * 1000},
+            }
+        )
+        self.assertEqual(e.get_node_rsync_cap("alpha"), 1)
+        self.assertEqual(e.get_node_rsync_cap("beta"), None)
+        res = e.incoming_client({"msg": "service_node_load"})
+        self.assertTrue(res["alpha"]["saturated"])
+        self.assertFalse(res["beta"]["saturated"])
+        e.incoming_node(
+            {
+                "from": "alpha",
+                "msg": "load",
+                "loadavg": [0.5, 0.5, 0.5],
+                "cpus": 4,
+                "pool": {"write_bytes": 10, "write_wait_ns": 1000 * 1000},
+            }
+        )
+        self.assertEqual(e.get_node_rsync_cap("alpha"), None)
+
+    def test_saturated_by_load_average(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {"one": ["1"]}}
+        )
+        e.incoming_node(
+            {
+                "from": "alpha",
+                "msg": "load",
+                "loadavg": [9.0, 9.0, 9.0],
+                "cpus": 4,
+                "pool": {},
+            }
+        )
+        self.assertEqual(e.get_node_rsync_cap("alpha"), 1)
+
+    def test_stale_samples_are_ignored(self):
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {"one": ["1"]}}
+        )
+        e.incoming_node(
+            {
+                "from": "alpha",
+                "msg": "load",
+                "loadavg": [9.0, 9.0, 9.0],
+                "cpus": 4,
+                "pool": {},
+            }
+        )
+        e.node_loads["alpha"]["time"] -= e.load_stale_after + 1
+        self.assertEqual(e.get_node_rsync_cap("alpha"), None)
+
+    def test_config_decides(self):
+        cfg = self._get_test_config()
+        cfg.is_node_saturated = lambda node, load: load["pool"]["read_ops"] > 100
+        cfg.get_saturated_rsync_limit = lambda: 2
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {"one": ["1"]}}, config=cfg
+        )
+        e.incoming_node(
+            {
+                "from": "alpha",
+                "msg": "load",
+                "loadavg": [0.5, 0.5, 0.5],
+                "cpus": 4,
+                "pool": {"read_ops": 1000},
+            }
+        )
+        self.assertEqual(e.get_node_rsync_cap("alpha"), 2)
+
+    def test_scrubbing_and_saturated(self):
+        cfg = self._get_test_config()
+        cfg.get_scrub_rsync_limit = lambda: 3
+        cfg.get_saturated_rsync_limit = lambda: 2
+        e, outgoing_messages = self.get_engine(
+            {"alpha": {"_one": ["1"]}, "beta": {"one": ["1"]}}, config=cfg
+        )
+        e.scrubs["alpha"] = {"since": time.time(), "requested": False, "started": True}
+        self.assertEqual(e.get_node_rsync_cap("alpha"), 3)
+        e.incoming_node(
+            {
+                "from": "alpha",
+                "msg": "load",
+                "loadavg": [9.0, 9.0, 9.0],
+                "cpus": 4,
+                "pool": {},
+            }
+        )
+        self.assertEqual(e.get_node_rsync_cap("alpha"), 2)
+
+
 class RollbackTests(EngineTests):
     def test_rollback(self):
         e, outgoing_messages = self.get_engine(
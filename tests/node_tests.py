@@ -208,6 +208,261 @@ class RPsTests(unittest.TestCase):
         self.assertEqual(rc, 0)
         self.assertEqual(read_file(os.path.join(target_path, "file1")), "hello")
 
+    def test_partitioned_deep_tree(self):
+        source_path = "/tmp/RPsTests/partitioned_from"
+        target_path = "/tmp/RPsTests/partitioned_to"
+        self.ensure_path(source_path)
+        self.ensure_path(target_path)
+        os.makedirs(os.path.join(source_path, "big", "a", "x"))
+        os.makedirs(os.path.join(source_path, "big", "b"))
+        os.makedirs(os.path.join(target_path, "big", "c"))
+        write_file(os.path.join(source_path, "file1"), "hello")
+        write_file(os.path.join(source_path, "big", "file2"), "hello2")
+        write_file(os.path.join(source_path, "big", "a", "x", "file3"), "hello3")
+        write_file(os.path.join(source_path, "big", "b", "file4"), "hello4")
+        write_file(os.path.join(target_path, "big", "c", "file5"), "to be deleted")
+        rc, stdout, stderr = run_rsync(
+            {
+                "source_path": source_path,
+                "target_path": target_path,
+                "target_host": "127.0.0.1",
+                "target_ssh_cmd": target_ssh_cmd,
+                "target_user": "ffs",
+                "partition_min_weight": 0,  # split everything
+            }
+        )
+        self.assertEqual(rc, 0)
+        self.assertEqual(read_file(os.path.join(target_path, "file1")), "hello")
+        self.assertEqual(read_file(os.path.join(target_path, "big", "file2")), "hello2")
+        self.assertEqual(
+            read_file(os.path.join(target_path, "big", "a", "x", "file3")), "hello3"
+        )
+        self.assertEqual(
+            read_file(os.path.join(target_path, "big", "b", "file4")), "hello4"
+        )
+        self.assertFalse(os.path.exists(os.path.join(target_path, "big", "c")))
+
+    def test_large_file_chunks(self):
+        source_path = "/tmp/RPsTests/large_file_chunks_from"
+        target_path = "/tmp/RPsTests/large_file_chunks_to"
+        self.ensure_path(source_path)
+        self.ensure_path(target_path)
+        os.makedirs(os.path.join(source_path, "1"))
+        os.makedirs(os.path.join(target_path, "1"))
+        data = os.urandom(5 * 1024 * 1024 + 17)
+        with open(os.path.join(source_path, "1", "large"), "wb") as op:
+            op.write(data)
+        # a partial, slightly different, too long copy on the target
+        with open(os.path.join(target_path, "1", "large"), "wb") as op:
+            op.write(
+                data[: 1024 * 1024] + b"changed" + data[1024 * 1024 + 7 :] + b"tail"
+            )
+        write_file(os.path.join(source_path, "1", "small"), "hello")
+        chmod(os.path.join(source_path, "1", "large"), "0640")
+        rc, stdout, stderr = run_rsync(
+            {
+                "source_path": source_path,
+                "target_path": target_path,
+                "target_host": "127.0.0.1",
+                "target_ssh_cmd": target_ssh_cmd,
+                "target_user": "ffs",
+                "large_file_threshold": 1024 * 1024,
+                "chunk_size": 1024 * 1024,
+            }
+        )
+        self.assertEqual(rc, 0)
+        with open(os.path.join(target_path, "1", "large"), "rb") as op:
+            self.assertEqual(op.read(), data)
+        self.assertEqual(read_file(os.path.join(target_path, "1", "small")), "hello")
+        self.assertEqual(
+            get_file_rights(os.path.join(target_path, "1", "large")) & 0o777, 0o640
+        )
+        self.assertEqual(
+            os.stat(os.path.join(target_path, "1", "large")).st_mtime,
+            os.stat(os.path.join(source_path, "1", "large")).st_mtime,
+        )
+
+    def test_ssh_multiplex_cleans_up(self):
+        import glob
+
+        source_path = "/tmp/RPsTests/multiplex_from"
+        target_path = "/tmp/RPsTests/multiplex_to"
+        self.ensure_path(source_path)
+        self.ensure_path(target_path)
+        for i in range(5):
+            os.makedirs(os.path.join(source_path, str(i)))
+            write_file(os.path.join(source_path, str(i), "file"), "hello%i" % i)
+        before = set(glob.glob("/tmp/rprsync_*"))
+        for multiplex in (True, False):
+            rc, stdout, stderr = run_rsync(
+                {
+                    "source_path": source_path,
+                    "target_path": target_path,
+                    "target_host": "127.0.0.1",
+                    "target_ssh_cmd": target_ssh_cmd,
+                    "target_user": "ffs",
+                    "ssh_multiplex": multiplex,
+                }
+            )
+            self.assertEqual(rc, 0)
+            self.assertFalse(b"ssh master failed" in stderr)
+            for i in range(5):
+                self.assertEqual(
+                    read_file(os.path.join(target_path, str(i), "file")), "hello%i" % i
+                )
+        self.assertEqual(set(glob.glob("/tmp/rprsync_*")), before)
+
+    def test_resume_skips_finished_units(self):
+        source_path = "/tmp/RPsTests/resume_from"
+        target_path = "/tmp/RPsTests/resume_to"
+        state_file = "/tmp/RPsTests/resume_state"
+        self.ensure_path(source_path)
+        self.ensure_path(target_path)
+        os.makedirs(os.path.join(source_path, "1"))
+        os.makedirs(os.path.join(source_path, "2"))
+        write_file(os.path.join(source_path, "1", "file1"), "hello1")
+        write_file(os.path.join(source_path, "2", "file2"), "hello2")
+        # as if an earlier run had finished '1/' - which we then won't resend
+        write_file(state_file, json.dumps(["do_rsync", "1/", True]) + "\n")
+        rc, stdout, stderr = run_rsync(
+            {
+                "source_path": source_path,
+                "target_path": target_path,
+                "target_host": "127.0.0.1",
+                "target_ssh_cmd": target_ssh_cmd,
+                "target_user": "ffs",
+                "resume_state": state_file,
+            }
+        )
+        self.assertEqual(rc, 0)
+        self.assertTrue(os.path.exists(os.path.join(target_path, "1")))
+        self.assertFalse(os.path.exists(os.path.join(target_path, "1", "file1")))
+        self.assertEqual(read_file(os.path.join(target_path, "2", "file2")), "hello2")
+        finished = read_file(state_file)
+        self.assertTrue(json.dumps(["do_rsync", "2/", True]) in finished)
+        self.assertTrue(json.dumps(["do_rsync", ".", False]) in finished)
+
+    def test_failed_unit_isolated(self):
+        import robust_parallel_rsync as rps
+
+        source_path = "/tmp/RPsTests/isolate_from"
+        self.ensure_path(source_path)
+        for d in ["1", "2", "2/a", "3"]:
+            os.makedirs(os.path.join(source_path, d))
+
+        def fake_rsync(args):
+            rel_path, recursive, cmd, excluded = args
+            if rel_path.startswith("2"):
+                return "rsync", 23, b"", b"failed", 3
+            return "rsync", 0, b"", b"", 0
+
+        org = rps.do_rsync
+        rps.do_rsync = fake_rsync
+        try:
+            cmd = {
+                "source_path": source_path,
+                "target_path": "/tmp/RPsTests/isolate_to",
+                "partition_min_weight": 0,
+            }
+            root = rps.build_units(cmd, 1)
+            results = dict(rps.run_units(root, 1))
+        finally:
+            rps.do_rsync = org
+        failed = [json.loads(k)[1] for k, res in results.items() if res[1] != 0]
+        self.assertEqual(failed, ["2/"])
+        self.assertEqual(results[json.dumps(["fake_rsync", "2/", False])][4], 3)
+        # the siblings still ran, the failed unit's children did not
+        ran = set(json.loads(k)[1] for k in results)
+        self.assertEqual(ran, set([".", "1/", "2/", "3/"]))
+        self.assertEqual(rps.count_units(root) - len(results), 1)
+
+    def test_progress_and_summary(self):
+        source_path = "/tmp/RPsTests/progress_from"
+        target_path = "/tmp/RPsTests/progress_to"
+        self.ensure_path(source_path)
+        self.ensure_path(target_path)
+        os.makedirs(os.path.join(source_path, "1"))
+        write_file(os.path.join(source_path, "1", "file1"), "hello1")
+        write_file(os.path.join(source_path, "file2"), "hello")
+        rc, stdout, stderr = run_rsync(
+            {
+                "source_path": source_path,
+                "target_path": target_path,
+                "target_host": "127.0.0.1",
+                "target_ssh_cmd": target_ssh_cmd,
+                "target_user": "ffs",
+                "progress_interval": 0,
+            }
+        )
+        self.assertEqual(rc, 0)
+        progress = [
+            json.loads(x[len("FFS_PROGRESS ") :])
+            for x in stderr.decode("utf-8").split("\n")
+            if x.startswith("FFS_PROGRESS ")
+        ]
+        self.assertTrue(progress)
+        self.assertEqual(progress[-1]["bytes"], len("hello1") + len("hello"))
+        self.assertEqual(progress[-1]["files"], 2)
+        summary = node.parse_rsync_summary(stdout)
+        self.assertEqual(summary["bytes"], len("hello1") + len("hello"))
+        self.assertEqual(summary["files"], 2)
+        self.assertEqual(summary["failed_units"], [])
+
+    def test_seed(self):
+        source_path = "/tmp/RPsTests/seed_from"
+        target_path = "/tmp/RPsTests/seed_to"
+        self.ensure_path(source_path)
+        self.ensure_path(target_path)
+        os.makedirs(os.path.join(source_path, "1"))
+        os.makedirs(os.path.join(source_path, "donotsync"))
+        write_file(os.path.join(source_path, "file1"), "hello")
+        write_file(os.path.join(source_path, "1", "file2"), "hello1")
+        write_file(os.path.join(source_path, "donotsync", "file3"), "hello2")
+        rc, stdout, stderr = run_rsync(
+            {
+                "source_path": source_path,
+                "target_path": target_path,
+                "target_host": "127.0.0.1",
+                "target_ssh_cmd": target_ssh_cmd,
+                "target_user": "ffs",
+                "excluded_subdirs": ["donotsync"],
+                "seed": True,
+            }
+        )
+        self.assertEqual(rc, 0)
+        self.assertFalse(b"seeding failed" in stderr)
+        self.assertEqual(read_file(os.path.join(target_path, "file1")), "hello")
+        self.assertEqual(read_file(os.path.join(target_path, "1", "file2")), "hello1")
+        self.assertFalse(os.path.exists(os.path.join(target_path, "donotsync")))
+        summary = node.parse_rsync_summary(stdout)
+        self.assertEqual(summary["units"], 1)
+        self.assertEqual(summary["failed_units"], [])
+        self.assertEqual(summary["files"], 2)
+        # tar headers and padding included
+        self.assertTrue(summary["bytes"] >= len("hello") + len("hello1"))
+
+    def test_seed_non_empty_target_falls_back_to_rsync(self):
+        source_path = "/tmp/RPsTests/seed_non_empty_from"
+        target_path = "/tmp/RPsTests/seed_non_empty_to"
+        self.ensure_path(source_path)
+        self.ensure_path(target_path)
+        write_file(os.path.join(source_path, "file1"), "hello")
+        write_file(os.path.join(target_path, "file2"), "to be deleted")
+        rc, stdout, stderr = run_rsync(
+            {
+                "source_path": source_path,
+                "target_path": target_path,
+                "target_host": "127.0.0.1",
+                "target_ssh_cmd": target_ssh_cmd,
+                "target_user": "ffs",
+                "seed": True,
+            }
+        )
+        self.assertEqual(rc, 0)
+        self.assertTrue(b"seeding failed" in stderr)
+        self.assertEqual(read_file(os.path.join(target_path, "file1")), "hello")
+        self.assertFalse(os.path.exists(os.path.join(target_path, "file2")))
+
     def test_sub_dirs(self):
         source_path = "/tmp/RPsTests/sub_dirs_from"
         target_path = "/tmp/RPsTests/sub_dirs_to"
@@ -772,6 +1027,142 @@ class RPsTests(unittest.TestCase):
         self.assertEqual(read_file(os.path.join(target_path, "file1")), "A" * size)
 
 
+class ZfsSendTransportTests(unittest.TestCase):
+    """zfs send | zfs receive against a fake zfs executable"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.fake_zfs = os.path.join(self.tmp, "zfs")
+        self.received = os.path.join(self.tmp, "received")
+        write_file(
+            self.fake_zfs,
+            """#!/usr/bin/python3
+import sys
+if sys.argv[1] == 'send':
+    sys.stdout.write('stream ' + ' '.join(sys.argv[2:]))
+elif sys.argv[1] == 'receive':
+    data = sys.stdin.read()
+    if 'fail' in sys.argv[-1]:
+        sys.stderr.write('cannot receive incremental stream')
+        sys.exit(1)
+    with open(%s, 'w') as op:
+        op.write(' '.join(sys.argv[2:]) + '|' + data)
+"""
+            % repr(self.received),
+        )
+        os.chmod(self.fake_zfs, 0o755)
+        self.org_zfs_cmd = node.zfs_cmd
+        node.zfs_cmd = [self.fake_zfs]
+
+    def tearDown(self):
+        node.zfs_cmd = self.org_zfs_cmd
+        shutil.rmtree(self.tmp)
+
+    def test_send_receive(self):
+        error = node.send_snapshot_via_zfs(
+            "pool/ffs/one", "a", "b", [self.fake_zfs, "receive", "-F", "pool2/ffs/one"]
+        )
+        self.assertEqual(error, None)
+        self.assertEqual(
+            read_file(self.received),
+            "-F pool2/ffs/one|stream -i pool/ffs/one@a pool/ffs/one@b",
+        )
+
+    def test_receive_failure_is_reported(self):
+        error = node.send_snapshot_via_zfs(
+            "pool/ffs/one", "a", "b", [self.fake_zfs, "receive", "-F", "pool2/fail"]
+        )
+        self.assertTrue("cannot receive incremental stream" in error)
+        self.assertFalse(os.path.exists(self.received))
+
+    def test_zfs_receive_rejects_malformed_commands(self):
+        for cmd_line in [
+            "zfs_receive",
+            "zfs_receive pool/ffs/one pool/ffs/two",
+            "zfs_receive pool/ffs/one@a",
+            "zfs_receive /pool/ffs/one",
+            "zfs_receive pool/ffs/.ffs_sync_clones",
+        ]:
+            self.assertRaises(ValueError, node.shell_cmd_zfs_receive, cmd_line)
+
+
+class ThrottledCopyTests(unittest.TestCase):
+    def test_throttled_copy(self):
+        import io
+        import time
+
+        class Target(io.BytesIO):
+            def close(self):
+                self.closed_by_copy = True
+
+        source = io.BytesIO(b"x" * 200 * 1024)
+        target = Target()
+        start = time.time()
+        node.throttled_copy(source, target, 400)
+        self.assertTrue(time.time() - start >= 0.45)
+        self.assertEqual(len(target.getvalue()), 200 * 1024)
+        self.assertTrue(target.closed_by_copy)
+
+
+class FfsRootCacheTests(unittest.TestCase):
+    """is_inside_ffs_root against a faked zfs get"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.org_cache_filename = node.ffs_root_cache_filename
+        self.org_zfs_output = node.zfs_output
+        node.ffs_root_cache_filename = os.path.join(self.tmp, "cache.json")
+        self.zfs_calls = []
+        self.zfs_get = (
+            "pool\toff\tdefault\n"
+            "pool/ffs\ton\tlocal\n"
+            "pool/ffs/one\ton\tinherited from pool/ffs\n"
+            "pool/other\t-\t-\n"
+        )
+
+        def fake_zfs_output(cmd_line):
+            self.zfs_calls.append(cmd_line)
+            return self.zfs_get
+
+        node.zfs_output = fake_zfs_output
+
+    def tearDown(self):
+        node.ffs_root_cache_filename = self.org_cache_filename
+        node.zfs_output = self.org_zfs_output
+        shutil.rmtree(self.tmp)
+
+    def test_decisions(self):
+        self.assertTrue(node.is_inside_ffs_root("/pool/ffs/one/sub/dir"))
+        self.assertTrue(node.is_inside_ffs_root("/pool/ffs"))
+        self.assertFalse(node.is_inside_ffs_root("/pool/other/ffs"))
+        self.assertFalse(node.is_inside_ffs_root("/pool"))
+        self.assertFalse(node.is_inside_ffs_root("pool/ffs/one"))
+
+    def test_positive_answers_are_cached(self):
+        self.assertTrue(node.is_inside_ffs_root("/pool/ffs/one"))
+        self.assertEqual(len(self.zfs_calls), 1)
+        self.assertTrue(node.is_inside_ffs_root("/pool/ffs/two/sub"))
+        self.assertEqual(len(self.zfs_calls), 1)
+
+    def test_negative_answers_are_not_cached(self):
+        self.assertTrue(node.is_inside_ffs_root("/pool/ffs/one"))
+        self.assertFalse(node.is_inside_ffs_root("/pool/other"))
+        self.assertEqual(len(self.zfs_calls), 2)
+        self.zfs_get += "pool/other\ton\tlocal\n"
+        self.assertTrue(node.is_inside_ffs_root("/pool/other"))
+        self.assertEqual(len(self.zfs_calls), 3)
+
+    def test_cache_expires(self):
+        self.assertTrue(node.is_inside_ffs_root("/pool/ffs/one"))
+        with open(node.ffs_root_cache_filename) as op:
+            cache = json.load(op)
+        cache["time"] -= node.ffs_root_cache_ttl + 1
+        with open(node.ffs_root_cache_filename, "w") as op:
+            json.dump(cache, op)
+        self.zfs_get = "pool/ffs\toff\tlocal\n"
+        self.assertFalse(node.is_inside_ffs_root("/pool/ffs/one"))
+
+
 def touch(filename):
     with open(filename, "w"):
         pass
@@ -907,6 +1298,10 @@ class NodeTests(unittest.TestCase):
         self.assertTrue(any_snapshots)
         self.assertTrue("list_test" in out_msg["ffs"])  # the root
         self.assertTrue("a" in out_msg["ffs"]["list_test"]["snapshots"])  # the root
+        sizes = out_msg["ffs"]["list_test"]["snapshot_sizes"]["a"]
+        self.assertTrue(isinstance(sizes["used"], int))
+        self.assertTrue(isinstance(sizes["written"], int))
+        self.assertTrue(out_msg["ffs"]["list_test"]["snapshot_guids"]["a"].isdigit())
         self.assertFalse("" in out_msg["ffs"])  # can't have the root in this!
         self.assertEqual(
             out_msg["ffs"]["inherit_test"]["properties"].get("ffs:root", "-"), "-"
@@ -988,6 +1383,60 @@ class NodeTests(unittest.TestCase):
         out_msg = self.dispatch(in_msg)
         self.assertError(out_msg, "invalid property value")
 
+    def test_receive_begin_and_commit(self):
+        subprocess.check_call(
+            ["sudo", "zfs", "create", self.get_test_prefix() + "receiving"]
+        )
+        subprocess.check_call(
+            ["sudo", "zfs", "set", "readonly=on", self.get_test_prefix() + "receiving"]
+        )
+        subprocess.check_call(
+            ["sudo", "zfs", "unmount", self.get_test_prefix() + "receiving"]
+        )
+        out_msg = self.dispatch({"msg": "receive_begin", "ffs": "receiving"})
+        self.assertNotError(out_msg)
+        self.assertEqual(out_msg["msg"], "receive_begin_done")
+        self.assertEqual(
+            node.get_zfs_property(self.get_test_prefix() + "receiving", "readonly"),
+            "off",
+        )
+        self.assertTrue(os.path.ismount("/" + self.get_test_prefix() + "receiving"))
+        out_msg = self.dispatch(
+            {"msg": "receive_commit", "ffs": "receiving", "snapshot": "a"}
+        )
+        self.assertNotError(out_msg)
+        self.assertEqual(out_msg["msg"], "receive_commit_done")
+        self.assertEqual(
+            node.get_zfs_property(self.get_test_prefix() + "receiving", "readonly"),
+            "on",
+        )
+        self.assertSnapshot("receiving", "a")
+
+    def test_receive_begin_resumable(self):
+        subprocess.check_call(
+            ["sudo", "zfs", "create", self.get_test_prefix() + "resuming"]
+        )
+        begin = {"msg": "receive_begin", "ffs": "resuming", "resume_key": "resume_a"}
+        out_msg = self.dispatch(begin)
+        self.assertNotError(out_msg)
+        self.assertFalse(out_msg["resumable"])
+        out_msg = self.dispatch(begin)  # same transfer again
+        self.assertTrue(out_msg["resumable"])
+        out_msg = self.dispatch(dict(begin, resume_key="resume_b"))
+        self.assertFalse(out_msg["resumable"])
+        out_msg = self.dispatch(
+            {"msg": "receive_commit", "ffs": "resuming", "snapshot": "a"}
+        )
+        self.assertNotError(out_msg)
+        out_msg = self.dispatch(dict(begin, resume_key="resume_b"))
+        self.assertFalse(out_msg["resumable"])
+
+    def test_receive_begin_invalid_ffs(self):
+        out_msg = self.dispatch({"msg": "receive_begin", "ffs": "does_not_exist"})
+        self.assertError(out_msg, "invalid ffs")
+        out_msg = self.dispatch({"msg": "receive_begin", "ffs": ".ffs_sync_clones"})
+        self.assertError(out_msg, "invalid ffs")
+
     def assertNotError(self, msg):
         if "error" in msg:
             pprint.pprint(msg)
@@ -1058,6 +1507,9 @@ class NodeTests(unittest.TestCase):
         self.assertEqual(out_msg["msg"], "capture_done")
         self.assertEqual(out_msg["ffs"], "five")
         self.assertEqual(out_msg["snapshot"], "b")
+        self.assertTrue(out_msg["written"] >= 0)
+        self.assertTrue(out_msg["used"] >= 0)
+        self.assertTrue(out_msg["guid"].isdigit())
 
     def test_capture_if_changed(self):
         subprocess.check_call(
@@ -1178,6 +1630,71 @@ class NodeTests(unittest.TestCase):
         self.assertSnapshot("three", "b")
         self.assertNotSnapshot("three", "c")
 
+    def test_remove_snapshots_batched(self):
+        subprocess.check_call(
+            ["sudo", "zfs", "create", NodeTests.get_test_prefix() + "threec"]
+        )
+        subprocess.check_call(
+            ["sudo", "chmod", "777", "/" + NodeTests.get_test_prefix() + "threec"]
+        )
+        for sn in "abcd":
+            touch("/" + NodeTests.get_test_prefix() + "threec/file_" + sn)
+            subprocess.check_call(
+                [
+                    "sudo",
+                    "zfs",
+                    "snapshot",
+                    NodeTests.get_test_prefix() + "threec@" + sn,
+                ]
+            )
+        in_msg = {
+            "msg": "remove_snapshots",
+            "ffs": "threec",
+            "snapshots": ["a", "c", "no_such_snapshot"],
+        }
+        out_msg = self.dispatch(in_msg)
+        self.assertNotError(out_msg)
+        self.assertEqual(out_msg["msg"], "remove_snapshots_done")
+        self.assertEqual(out_msg["removed"], ["a", "c", "no_such_snapshot"])
+        self.assertEqual(out_msg["snapshots"], ["b", "d"])
+        self.assertNotSnapshot("threec", "a")
+        self.assertSnapshot("threec", "b")
+        self.assertNotSnapshot("threec", "c")
+        self.assertSnapshot("threec", "d")
+
+    def test_remove_snapshot_destroys_abandoned_resume_clone(self):
+        ffs = NodeTests.get_test_prefix() + "threed"
+        clone_dir = NodeTests.get_test_prefix() + ".ffs_sync_clones"
+        subprocess.check_call(["sudo", "zfs", "create", ffs])
+        subprocess.call(["sudo", "zfs", "create", clone_dir])
+        for sn in "ab":
+            subprocess.check_call(["sudo", "zfs", "snapshot", ffs + "@" + sn])
+        # an interrupted transfer of a, one of b still running
+        for sn in "ab":
+            subprocess.check_call(
+                [
+                    "sudo",
+                    "zfs",
+                    "clone",
+                    ffs + "@" + sn,
+                    clone_dir + "/resume_threed_" + sn,
+                ]
+            )
+        out_msg = self.dispatch(
+            {"msg": "remove_snapshot", "ffs": "threed", "snapshot": "a"}
+        )
+        self.assertNotError(out_msg)
+        self.assertEqual(out_msg["msg"], "remove_snapshot_done")
+        self.assertNotSnapshot("threed", "a")
+        clones = subprocess.check_output(
+            ["sudo", "zfs", "list", "-H", "-o", "name", "-d", "1", clone_dir]
+        ).decode("utf-8")
+        self.assertFalse("resume_threed_a" in clones)
+        self.assertTrue("resume_threed_b" in clones)
+        subprocess.check_call(
+            ["sudo", "zfs", "destroy", clone_dir + "/resume_threed_b"]
+        )
+
     def test_remove_snapshot_invalid_snapshot(self):
         subprocess.check_call(
             ["sudo", "zfs", "create", NodeTests.get_test_prefix() + "threeb"]
@@ -1253,6 +1770,33 @@ class NodeTests(unittest.TestCase):
         self.assertTrue("pool:" in out_msg["status"])
         self.assertTrue("state:" in out_msg["status"])
         self.assertTrue("status:" in out_msg["status"])
+        self.assertTrue(out_msg["pools"])
+        for pool, info in out_msg["pools"].items():
+            self.assertTrue(info["size"] > 0)
+            self.assertTrue(info["free"] <= info["size"])
+            self.assertTrue(0 <= info["capacity"] <= 100)
+            self.assertTrue("write_bytes" in info)
+
+    def test_load(self):
+        in_msg = {"msg": "load"}
+        out_msg = self.dispatch(in_msg)
+        self.assertNotError(out_msg)
+        self.assertEqual(out_msg["msg"], "load")
+        self.assertEqual(len(out_msg["loadavg"]), 3)
+        self.assertTrue(out_msg["cpus"] >= 1)
+        self.assertTrue("write_bytes" in out_msg["pool"])
+
+    def test_zpool_scrub(self):
+        in_msg = {"msg": "zpool_scrub"}
+        out_msg = self.dispatch(in_msg)
+        self.assertNotError(out_msg)
+        self.assertEqual(out_msg["msg"], "zpool_scrub_started")
+        pool = self.get_pool()[:-1]
+        self.assertEqual(out_msg["pool"], pool)
+        # already running is fine
+        out_msg = self.dispatch(in_msg)
+        self.assertNotError(out_msg)
+        subprocess.call(["sudo", "zpool", "scrub", "-s", pool])
 
     def test_chown_and_chmod(self):
         subprocess.check_call(
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+"""Benchmark robust_parallel_rsync on synthetic, skewed trees.
+
+Runs in no_sudo mode against localhost, like the node tests,
+once with the size aware partitioner and once with plain
+one-rsync-per-top-level-dir (partition=False).
+
+usage: rps_benchmark.py [--cores 4] [--size-mb 512] [--ssh 'ssh -p 223 ...']
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+rps = os.path.abspath(
+    os.path.join(
+        os.path.dirname(__file__),
+        "..",
+        "src",
+        "FloatingFileSystemCentral",
+        "node",
+        "home",
+        "robust_parallel_rsync.py",
+    )
+)
+
+
+def write_random(path, size):
+    with open(path, "wb") as op:
+        op.write(os.urandom(size))
+
+
+def make_tree(root, total_bytes, skew):
+    """skew of the data goes into one top level directory (nested 3 levels deep),
+    the rest is spread over 9 small ones. Plus one directory of many tiny files."""
+    big = int(total_bytes * skew)
+    small = (total_bytes - big) // 9
+    for i in range(8):
+        for j in range(8):
+            d = os.path.join(root, "big", "level_%i" % i, "sub_%i" % j)
+            os.makedirs(d)
+            for k in range(4):
+                write_random(os.path.join(d, "file_%i" % k), big // (8 * 8 * 4))
+    for i in range(9):
+        d = os.path.join(root, "small_%i" % i)
+        os.makedirs(d)
+        write_random(os.path.join(d, "file"), small)
+    d = os.path.join(root, "many_tiny")
+    os.makedirs(d)
+    for i in range(5000):
+        write_random(os.path.join(d, "tiny_%i" % i), 128)
+
+
+def run(source, target, args, partition):
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    os.makedirs(target)
+    cmd = {
+        "source_path": source,
+        "target_path": target,
+        "target_host": args.host,
+        "target_user": args.user,
+        "target_ssh_cmd": args.ssh.split(),
+        "cores": args.cores,
+        "no_sudo": True,
+        "partition": partition,
+    }
+    start = time.time()
+    p = subprocess.Popen(
+        [sys.executable, rps],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    stdout, stderr = p.communicate(json.dumps(cmd).encode("utf-8"))
+    if p.returncode != 0:
+        print(stderr.decode("utf-8"))
+        raise ValueError("robust_parallel_rsync failed")
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cores", type=int, default=4)
+    parser.add_argument("--size-mb", type=int, default=512)
+    parser.add_argument("--skew", type=float, default=0.9)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--user", default="ffs")
+    parser.add_argument(
+        "--ssh",
+        default="ssh -p 223 -o StrictHostKeyChecking=no -i /home/ffs/.ssh/id_rsa",
+    )
+    args = parser.parse_args()
+    tmp = tempfile.mkdtemp(prefix="rps_benchmark")
+    try:
+        source = os.path.join(tmp, "source")
+        target = os.path.join(tmp, "target")
+        make_tree(source, args.size_mb * 1024 * 1024, args.skew)
+        for partition in (False, True):
+            times = [run(source, target, args, partition) for _ in range(args.repeats)]
+            print(
+                "partition=%s: best %.2fs, mean %.2fs"
+                % (partition, min(times), sum(times) / len(times))
+            )
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()